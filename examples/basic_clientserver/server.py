@@ -12,14 +12,12 @@ def main():
     t = time.time()
 
     while True:
-        s.update()
+        s.poll(0.1)
 
         if time.time() > t + 1.0:
             t = time.time()
             for peer in s.peers:
                 print peer.address, peer.latency
 
-        time.sleep(0.0001)
-
 if __name__ == '__main__':
     main()
@@ -110,7 +110,7 @@ class BallServer(shared.BallEnvironment):
         for ball in self._balls.itervalues():
             logging.debug('**** sending update for ball # %s' % ball.ball_id)
             print('Sending update for ball # %s' % ball.ball_id)
-            server.send_reliable_message_to_all(ball.get_message())
+            server.send_latest_message_to_all(ball.get_message(), ball.ball_id)
 
     def send_initial_state(self, endpoint):
         for ball in self._balls.itervalues():
@@ -12,6 +12,14 @@ from legume import serverpeer
 from legume import connection
 from legume import servicelocator
 from legume import exceptions
+from legume import pingsampler
+from legume import rttestimator
+from legume import congestion
+from legume import fragments
+from legume import aio
+from legume import sharding
+from legume import handshake
+from legume import dispatch
 
 servicelocator.add('Connection', connection.Connection)
 servicelocator.add('Peer', serverpeer.Peer)
@@ -0,0 +1,88 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+'''
+Packet level acknowledgements. Every packet carries a header holding the
+packet's own sequence number, the most recent sequence number received from
+the remote end and a bitfield of the ACK_BITFIELD_SIZE sequence numbers
+before it. Bit n of the bitfield is set if sequence number ack-(n+1) was
+received.
+
+Packet sequence numbers use the same 1 to 65535 range as in-order sequence
+numbers. A sequence number of 0 marks a packet that only carries acks and
+does not need acknowledging, an ack of 0 means nothing has been received.
+'''
+
+from legume.reorderbuffer import SEQUENCE_NUMBER_MAX, sequence_distance
+
+ACK_BITFIELD_SIZE = 32
+ACK_BITFIELD_MASK = (1 << ACK_BITFIELD_SIZE) - 1
+
+def previous_sequence_number(sequence_number):
+    '''
+    Returns the sequence number before sequence_number.
+    '''
+    return (sequence_number - 2) % SEQUENCE_NUMBER_MAX + 1
+
+def acked_sequence_numbers(ack, ack_bits):
+    '''
+    Yields the sequence numbers acknowledged by an ack and ack bitfield.
+    '''
+    if ack == 0:
+        return
+    yield ack
+    sequence_number = ack
+    while ack_bits:
+        sequence_number = previous_sequence_number(sequence_number)
+        if ack_bits & 1:
+            yield sequence_number
+        ack_bits >>= 1
+
+class SentPacket(object):
+    '''
+    A record of a sent packet, kept until the packet is acknowledged or
+    falls out of the sent packet history. in_flight is True while a
+    packet carrying reliable messages is neither acked nor presumed lost.
+    '''
+    __slots__ = ['sequence_number', 'message_ids', 'timestamp', 'length',
+                 'in_flight']
+
+    def __init__(self, sequence_number, message_ids, timestamp, length):
+        self.sequence_number = sequence_number
+        self.message_ids = message_ids
+        self.timestamp = timestamp
+        self.length = length
+        self.in_flight = len(message_ids) > 0
+
+class ReceivedPackets(object):
+    '''
+    Tracks the packet sequence numbers received from the remote end as the
+    most recent sequence number and a bitfield of the ones before it.
+    '''
+    def __init__(self):
+        self.ack = 0
+        self.ack_bits = 0
+
+    def add(self, sequence_number):
+        '''
+        Record the receipt of a packet sequence number.
+        '''
+        if sequence_number == 0:
+            return
+        if self.ack == 0:
+            self.ack = sequence_number
+            return
+
+        distance = sequence_distance(sequence_number, self.ack)
+        if distance > 0:
+            if distance <= ACK_BITFIELD_SIZE:
+                self.ack_bits = ((self.ack_bits << distance) |
+                    (1 << (distance - 1))) & ACK_BITFIELD_MASK
+            else:
+                self.ack_bits = 0
+            self.ack = sequence_number
+        elif 0 < -distance <= ACK_BITFIELD_SIZE:
+            self.ack_bits |= 1 << (-distance - 1)
@@ -0,0 +1,290 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+'''
+Run a `Client` or `Server` on an asyncio event loop. Datagrams are
+delivered by a DatagramProtocol and fed to the same `Connection` objects
+used in polled mode. update() is called when datagrams arrive, when
+messages are sent and at the endpoint's next deadline, so there is no
+polling::
+
+    async def main():
+        client = legume.aio.AsyncClient()
+        await client.connect(('localhost', 4000), timeout=5.0)
+        client.send_message(message, reliable=True)
+        async for message in client:
+            print(message)
+'''
+
+__docformat__ = 'restructuredtext'
+
+import asyncio
+import errno
+import logging
+from legume import timing as time
+from legume import messages
+from legume.client import Client
+from legume.server import Server
+from legume.datagrams import DatagramQueue
+from legume.exceptions import ClientError
+
+class _TransportSocket(object):
+    '''
+    Stands in for an endpoint's socket. Packets are sent through the
+    asyncio transport. Received datagrams are pushed in by the protocol,
+    so recvfrom_into always reports that there is nothing to read.
+    '''
+    def __init__(self, transport):
+        self._transport = transport
+
+    def sendto(self, data, flags, address):
+        self._transport.sendto(data, address)
+        return len(data)
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        raise BlockingIOError(errno.EWOULDBLOCK,
+            'Datagrams are delivered by the asyncio protocol')
+
+    def setsockopt(self, level, option, value):
+        self._transport.get_extra_info('socket').setsockopt(
+            level, option, value)
+
+    def close(self):
+        if not self._transport.is_closing():
+            try:
+                self._transport.close()
+            except RuntimeError:
+                # The event loop has already been closed.
+                pass
+
+class _EndpointProtocol(asyncio.DatagramProtocol):
+    def __init__(self, adapter):
+        self._adapter = adapter
+
+    def datagram_received(self, data, addr):
+        self._adapter._datagram_received(data, addr)
+
+    def error_received(self, exc):
+        self._adapter._log.warning('Socket error: %s' % exc)
+
+class _TransportEndpointMixin(object):
+    '''
+    Makes a NetworkEndpoint use the _TransportSocket it is given instead
+    of creating and binding a socket of its own.
+    '''
+    _transport_socket = None
+
+    def _create_socket(self):
+        self._socket = self._transport_socket
+        self._configure_socket_buffers()
+        self._datagrams = DatagramQueue(self._socket, self.SEND_BACKLOG_LIMIT)
+        return self._socket
+
+    def _connect_socket(self, addr):
+        pass
+
+    def _bind_socket(self, addr, reuse_port=False):
+        pass
+
+class _TransportClient(_TransportEndpointMixin, Client):
+    pass
+
+class _TransportServer(_TransportEndpointMixin, Server):
+    pass
+
+class _AsyncEndpoint(object):
+    '''
+    Schedules update() calls for an endpoint on the running loop and
+    collects received messages for the async iterator.
+    '''
+    _log = logging.getLogger('legume.aio')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self._loop = None
+        self._timer = None
+        self._update_requested = False
+        self._messages = asyncio.Queue()
+        self._closed = False
+
+    async def _create_transport(self, local_addr):
+        self._loop = asyncio.get_running_loop()
+        transport, protocol = await self._loop.create_datagram_endpoint(
+            lambda: _EndpointProtocol(self), local_addr=local_addr)
+        self.endpoint._transport_socket = _TransportSocket(transport)
+
+    def flush(self):
+        '''
+        Schedule an update() to send messages queued directly on the
+        endpoint or its peers. The adapter's own send methods and the
+        async iterator do this automatically.
+        '''
+        if self._loop is not None and not self._update_requested:
+            self._update_requested = True
+            self._loop.call_soon(self._update)
+
+    def _update(self):
+        self._update_requested = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.endpoint.is_active():
+            self._close()
+            return
+
+        self.endpoint.update()
+
+        if not self.endpoint.is_active():
+            self._close()
+            return
+        deadline = self.endpoint.next_deadline()
+        if deadline is not None:
+            self._timer = self._loop.call_later(
+                max(0.0, deadline - time.time()), self._update)
+
+    def _datagram_received(self, data, addr):
+        self._feed(data, addr)
+        # Datagrams that arrive in the same loop iteration share an update.
+        self.flush()
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._messages.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # Replies sent while handling the previous message go out now.
+        self.flush()
+        item = await self._messages.get()
+        if item is None:
+            self._messages.put_nowait(None)
+            raise StopAsyncIteration
+        return item
+
+class AsyncClient(_AsyncEndpoint):
+    '''
+    A `Client` driven by an asyncio event loop. The wrapped client is
+    available as .endpoint for its events and metrics. Iterating over an
+    AsyncClient with async for yields received messages until the
+    connection is closed.
+    '''
+    def __init__(self, message_factory=messages.message_factory):
+        _AsyncEndpoint.__init__(self, _TransportClient(message_factory))
+        self.endpoint.OnMessage += self._Client_OnMessage
+        self.endpoint.OnConnectRequestAccepted += self._Client_OnConnected
+        self.endpoint.OnConnectRequestRejected += self._Client_OnRejected
+        self.endpoint.OnError += self._Client_OnError
+        self._connected = None
+
+    async def connect(self, address, timeout=None):
+        '''
+        Connect to the server at address, a (host, port) tuple, and wait
+        until the server accepts the connection. Raises ClientError if the
+        connection is rejected or fails, and asyncio.TimeoutError if the
+        timeout, in seconds, passes first.
+        '''
+        await self._create_transport(('0.0.0.0', 0))
+        self._connected = self._loop.create_future()
+        self.endpoint.connect(address)
+        self.flush()
+        await asyncio.wait_for(self._connected, timeout)
+
+    def send_message(self, message, ordered=False, reliable=False, channel=0):
+        result = self.endpoint.send_message(message, ordered, reliable, channel)
+        self.flush()
+        return result
+
+    def send_reliable_message(self, message):
+        result = self.endpoint.send_reliable_message(message)
+        self.flush()
+        return result
+
+    def disconnect(self):
+        '''
+        Gracefully disconnect. The socket is closed once the Disconnected
+        message has been sent.
+        '''
+        self.endpoint.disconnect()
+        self.flush()
+
+    def close(self):
+        '''Close the socket without notifying the server.'''
+        if self.endpoint.is_active():
+            self.endpoint._disconnect(raise_event=False)
+        self.flush()
+
+    def _feed(self, data, addr):
+        if self.endpoint.is_active():
+            self.endpoint._connection._on_socket_data(data, addr)
+
+    def _resolve_connect(self, error=None):
+        if self._connected is not None and not self._connected.done():
+            if error is None:
+                self._connected.set_result(None)
+            else:
+                self._connected.set_exception(ClientError(error))
+
+    def _Client_OnMessage(self, sender, message):
+        self._messages.put_nowait(message)
+
+    def _Client_OnConnected(self, sender, event_args):
+        self._resolve_connect()
+
+    def _Client_OnRejected(self, sender, event_args):
+        self._resolve_connect('Connection rejected by server')
+
+    def _Client_OnError(self, sender, error_string):
+        self._resolve_connect(error_string)
+
+class AsyncServer(_AsyncEndpoint):
+    '''
+    A `Server` driven by an asyncio event loop. The wrapped server is
+    available as .endpoint for its events and peers. Iterating over an
+    AsyncServer with async for yields (peer, message) tuples.
+    '''
+    def __init__(self, message_factory=messages.message_factory):
+        _AsyncEndpoint.__init__(self, _TransportServer(message_factory))
+        self.endpoint.OnMessage += self._Server_OnMessage
+
+    async def listen(self, address):
+        '''
+        Begin listening for connections on address, a (host, port) tuple.
+        '''
+        host, port = address
+        await self._create_transport((host or '0.0.0.0', port))
+        self.endpoint.listen(address)
+        self.flush()
+
+    @property
+    def address(self):
+        '''The (host, port) address the server is bound to.'''
+        return self.endpoint._transport_socket._transport.get_extra_info(
+            'sockname')
+
+    def send_message_to_all(self, message, ordered=False, reliable=False,
+                            channel=0, predicate=None):
+        self.endpoint.send_message_to_all(
+            message, ordered, reliable, channel, predicate)
+        self.flush()
+
+    def send_reliable_message_to_all(self, message, predicate=None):
+        self.endpoint.send_reliable_message_to_all(message, predicate)
+        self.flush()
+
+    def close(self):
+        '''Stop listening and close the socket.'''
+        if self.endpoint.is_active():
+            self.endpoint._state = self.endpoint.DISCONNECTED
+            self.endpoint._shutdown_socket()
+        self.flush()
+
+    def _feed(self, data, addr):
+        if self.endpoint.is_active():
+            self.endpoint._on_socket_data(data, addr)
+
+    def _Server_OnMessage(self, peer, message):
+        self._messages.put_nowait((peer, message))
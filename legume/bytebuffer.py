@@ -5,62 +5,85 @@
 import struct
 from legume.exceptions import BufferError
 
+# Compiled structs by format string, shared by all buffers.
+STRUCT_CACHE_SIZE = 256
+_struct_cache = {}
+
+def compile_struct(struct_format):
+    '''
+    Returns a network byte order struct.Struct for struct_format. Structs
+    are cached so repeated reads using the same format are not recompiled.
+    '''
+    try:
+        return _struct_cache[struct_format]
+    except KeyError:
+        if len(_struct_cache) >= STRUCT_CACHE_SIZE:
+            _struct_cache.clear()
+        compiled_struct = struct.Struct('!'+struct_format)
+        _struct_cache[struct_format] = compiled_struct
+        return compiled_struct
+
 class ByteBuffer(object):
     '''
     Provides a simplified method of reading struct packed data from
     a string buffer.
 
-    read_bytes and read_struct remove the read data from the string buffer.
+    The buffer is read through a memoryview and a read offset, so reading
+    never copies the unread part of the buffer. read_bytes and read_struct
+    advance the read offset past the read data.
     '''
     def __init__(self, bytes):
-        self._bytes = bytes
+        self._view = memoryview(bytes)
+        self._offset = 0
 
-    def read_bytes(self, bytes_to_read):
-        if bytes_to_read > len(self._bytes):
+    def _check_length(self, byte_count, action):
+        if byte_count > len(self._view) - self._offset:
             raise BufferError(
-                'Cannot read %d bytes, buffer too small (%d bytes)' \
-                % (bytes_to_read, len(self._bytes)))
-        result = self._bytes[:bytes_to_read]
-        self._bytes = self._bytes[bytes_to_read:]
-        return result
+                'Cannot %s %d bytes, buffer too small (%d bytes)' \
+                % (action, byte_count, len(self._view) - self._offset))
+
+    def read_bytes(self, bytes_to_read):
+        self._check_length(bytes_to_read, 'read')
+        offset = self._offset
+        self._offset = offset + bytes_to_read
+        return self._view[offset:self._offset].tobytes()
 
     def peek_bytes(self, bytes_to_peek):
-        if bytes_to_peek > len(self._bytes):
-            raise BufferError(
-                'Cannot peek %d bytes, buffer too small (%d bytes)' \
-                % (bytes_to_peek, len(self._bytes)))
-        return self._bytes[:bytes_to_peek]
+        self._check_length(bytes_to_peek, 'peek')
+        return self._view[self._offset:self._offset+bytes_to_peek].tobytes()
 
     def push_bytes(self, bytes):
-        self._bytes += bytes
+        self._view = memoryview(self._view[self._offset:].tobytes() + bytes)
+        self._offset = 0
 
     def read_struct(self, struct_format):
-        struct_size = struct.calcsize('!'+struct_format)
-        try:
-            struct_bytes = self.read_bytes(struct_size)
-            bytes = struct.unpack('!'+struct_format, struct_bytes)
-        except struct.error:
-            raise BufferError('Unable to unpack data')
-        except BufferError as e:
-            raise BufferError(
-                'Could not unpack using format %s' % struct_format, e)
-        return bytes
+        return self.read_compiled_struct(compile_struct(struct_format))
+
+    def read_compiled_struct(self, compiled_struct):
+        '''
+        As read_struct but using a precompiled struct.Struct instance.
+        '''
+        values = self._unpack(compiled_struct)
+        self._offset += compiled_struct.size
+        return values
 
     def peek_struct(self, struct_format):
-        struct_size = struct.calcsize('!'+struct_format)
+        return self._unpack(compile_struct(struct_format))
+
+    def _unpack(self, compiled_struct):
         try:
-            struct_bytes = self.peek_bytes(struct_size)
-            bytes = struct.unpack('!'+struct_format, struct_bytes)
+            self._check_length(compiled_struct.size, 'read')
+            values = compiled_struct.unpack_from(self._view, self._offset)
         except struct.error:
             raise BufferError('Unable to unpack data')
         except BufferError as e:
             raise BufferError(
-                'Could not unpack using format %s' % struct_format, e)
-        return bytes
+                'Could not unpack using format %s' % compiled_struct.format, e)
+        return values
 
     def is_empty(self):
-        return len(self._bytes) == 0
+        return self._offset == len(self._view)
 
     @property
     def length(self):
-        return len(self._bytes)
\ No newline at end of file
+        return len(self._view) - self._offset
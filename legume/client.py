@@ -5,9 +5,11 @@
 __docformat__ = 'restructuredtext'
 
 import logging
+from legume import timing as time
 from legume import messages
 from legume import netshared
 from legume import metrics
+from legume.dispatch import MessageDispatcher
 from legume.servicelocator import Service
 from legume.nevent import Event, NEventError
 from legume.exceptions import ClientError, ArgumentError
@@ -28,6 +30,12 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
             # Add a small time delay to prevent pegging the CPU.
             time.sleep(0.0001)
 
+    Alternatively .poll() blocks until a packet arrives or the connection
+    has work to do, then calls .update()::
+
+        while True:
+            client.poll(0.05)
+
     The `Client` has a number of events that can be hooked into that provide
     notifications of data sent from the server and state changes. An event
     consists of the sender and the argument(in the example below, this
@@ -38,6 +46,11 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
 
         my_client.OnMessage += my_message_handler
 
+    Handlers for a single message class are registered with `Client.on`,
+    and messages with a handler of their own don't raise OnMessage::
+
+        my_client.on(GreetingMessage, my_message_handler)
+
     For the `Client.OnMessage` handler example above the argument part of the
     event received is a re-assembled instance of the message that was sent, and
     the greeting field in the message is obtained via
@@ -54,6 +67,10 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
     * `Client.OnDisconnect` - The connection was gracefully closed by the
         Server. If the connection was severed due to a time-out, the
         `Client.OnError` event would fire.
+    * `Client.OnBackpressure` - A send would take the outgoing queue over
+        `max_queued_bytes` or `max_queued_messages`. The event argument is
+        the number of bytes the send would have queued, what happens to
+        the send depends on `backpressure_policy`.
     '''
 
     _log = logging.getLogger('legume.client')
@@ -82,6 +99,8 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         self._OnConnectRequestAccepted = Event()
         self._OnError = Event()
         self._OnDisconnect = Event()
+        self._OnBackpressure = Event()
+        self._dispatcher = MessageDispatcher()
 
     # ------------- Properties -------------
 
@@ -118,6 +137,34 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         else:
             return 0
 
+    @property
+    def smoothed_rtt(self):
+        if self._connection is not None:
+            return self._connection.smoothed_rtt
+        else:
+            return 0
+
+    @property
+    def rtt_variance(self):
+        if self._connection is not None:
+            return self._connection.rtt_variance
+        else:
+            return 0
+
+    @property
+    def jitter(self):
+        if self._connection is not None:
+            return self._connection.jitter
+        else:
+            return 0
+
+    @property
+    def rto(self):
+        if self._connection is not None:
+            return self._connection.rto
+        else:
+            return 0
+
     @property
     def out_buffer_bytes(self):
         if self._connection is not None:
@@ -209,10 +256,9 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         self._connection.OnError += self._Connection_OnError
         self._connection.OnDisconnect += self._Connection_OnDisconnect
         self._connection.OnMessage += self._Connection_OnMessage
+        self._connection.OnBackpressure += self._Connection_OnBackpressure
 
-        request_message = self.message_factory.get_by_name('ConnectRequest')()
-        request_message.protocol.value = netshared.PROTOCOL_VERSION
-        self._send_reliable_message(request_message)
+        self._connection.send_connect_request()
         self._state = self.CONNECTING
 
     def disconnect(self):
@@ -227,7 +273,7 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
                 self.message_factory.get_by_name('Disconnected')())
             self._disconnecting = True
 
-    def send_message(self, message):
+    def send_message(self, message, ordered=False, reliable=False, channel=0):
         '''
         Send a message to the server. The message is added to the output buffer.
         To flush the output buffer call the .update() method. If the client
@@ -236,9 +282,18 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         :Parameters:
             message : `BaseMessage`
                 The message to be sent
+            ordered : `bool`
+                Deliver the message reliably and in the order it was sent
+                relative to other ordered messages on the same channel.
+            reliable : `bool`
+                Guarantee delivery of the message.
+            channel : `int`
+                The ordered channel, from 0 to
+                `Connection.ORDERED_CHANNEL_COUNT`-1. A lost message only
+                delays later messages on its own channel.
         '''
         if self._state == self.CONNECTED:
-            return self._send_message(message)
+            return self._send_message(message, ordered, reliable, channel)
         else:
             raise ClientError('Cannot send packet - not connected')
 
@@ -257,6 +312,66 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         else:
             raise ClientError('Cannot send message - not connected')
 
+    def send_latest_message(self, message, key, ttl=None):
+        '''
+        Send an unreliable message to the server that replaces any queued
+        message of the same class and key, so only the newest value is
+        sent. If the client is not connected to the server a `ClientError`
+        exception is raised.
+
+        :Parameters:
+            message : `BaseMessage`
+                The message to be sent
+            key : hashable
+                Identifies what the message is the latest value of, such
+                as an entity id.
+            ttl : `float`
+                Seconds after which the message is dropped if it hasn't
+                been sent, or None to keep it until it is sent.
+        '''
+        if self._state == self.CONNECTED:
+            return self._connection.send_latest_message(message, key, ttl)
+        else:
+            raise ClientError('Cannot send message - not connected')
+
+    def can_send(self, length):
+        '''
+        Returns True if a message of length encoded bytes can be sent
+        without exceeding `max_queued_bytes` or `max_queued_messages`.
+        Returns False if the client is not connected.
+
+        :Parameters:
+            length : `int`
+                The length of the encoded message, as returned by
+                `BaseMessage.get_packet_bytes`.
+        '''
+        if self._state == self.CONNECTED:
+            return self._connection.can_send(length)
+        else:
+            return False
+
+    def on(self, message_class, handler):
+        '''
+        Call handler(client, message) for each message of message_class
+        received, instead of raising OnMessage for it.
+        '''
+        self._dispatcher.on(message_class, handler)
+
+    def off(self, message_class, handler):
+        '''
+        Remove a handler added with `on`.
+        '''
+        self._dispatcher.off(message_class, handler)
+
+    def flush(self):
+        '''
+        Send the messages queued by send_message now, without waiting for
+        the next update. Messages are sent by update anyway, this is only
+        needed to send them sooner.
+        '''
+        if self._state in [self.CONNECTING, self.CONNECTED]:
+            self._connection.flush()
+
     def update(self):
         '''
         This method should be called frequently to process incoming data,
@@ -264,16 +379,32 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         '''
         self._log.debug('update')
         if self._state in [self.CONNECTING, self.CONNECTED]:
+            # Packets backed up by a full socket go before new ones.
+            self._flush_datagrams()
             self._log.debug('connection.update')
             self._connection.update()
+            self._flush_datagrams()
 
         if self._disconnecting and not self._connection.has_outgoing_packets():
             self._disconnect(raise_event=False)
 
+    def next_deadline(self):
+        '''
+        The time at which .update() next has work to do, or None if the
+        client is not connected.
+        '''
+        if self._state not in [self.CONNECTING, self.CONNECTED]:
+            return None
+        if self._disconnecting and not self._connection.has_outgoing_packets():
+            return time.time()
+        return self._connection.next_deadline()
+
     # ------------- Private Methods -------------
 
-    def _send_message(self, message):
-        return self._connection.send_message(message)
+    def _send_message(self, message, ordered=False, reliable=False,
+                      channel=0):
+        return self._connection.send_message(
+            message, ordered, reliable, channel)
 
     def _send_reliable_message(self, message):
         return self._connection.send_reliable_message(message)
@@ -337,6 +468,16 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
     OnDisconnect = property(
         _getOnDisconnect, _setOnDisconnect)
 
+    def _getOnBackpressure(self):
+        return self._OnBackpressure
+    def _setOnBackpressure(self, event):
+        if isinstance(event, Event):
+            self._OnBackpressure = event
+        else:
+            raise NEventError('Event must subclass nevent.Event')
+    OnBackpressure = property(
+        _getOnBackpressure, _setOnBackpressure)
+
     # ------------- Connection Event Handlers -------------
 
     def _Connection_OnConnectRequestRejected(self, sender, event_args):
@@ -345,7 +486,8 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
         self.OnConnectRequestRejected(self, event_args)
 
     def _Connection_OnMessage(self, sender, message):
-        self.OnMessage(self, message)
+        if not self._dispatcher.dispatch(self, message):
+            self.OnMessage(self, message)
 
     def _Connection_OnConnectRequestAccepted(self, sender, event_args):
         self._state = self.CONNECTED
@@ -358,3 +500,6 @@ class Client(netshared.NetworkEndpoint, metrics.Metrics):
 
     def _Connection_OnDisconnect(self, sender, event_args):
         self._disconnect()
+
+    def _Connection_OnBackpressure(self, sender, queued_bytes):
+        self.OnBackpressure(self, queued_bytes)
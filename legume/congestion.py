@@ -0,0 +1,106 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+class TokenBucket(object):
+    '''
+    Paces sending to an average of rate bytes per second. Tokens build up
+    to burst bytes while idle. Sending is allowed while any tokens remain,
+    and the cost of each packet is taken after it is sent. A rate of None
+    means sending is not limited.
+    '''
+    BURST_SECONDS = 0.1
+
+    def __init__(self, rate=None, minimum_burst=0):
+        self._minimum_burst = minimum_burst
+        self._rate = None
+        self._burst = 0
+        self._tokens = 0
+        self._timestamp = None
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        if rate == self._rate:
+            return
+        self._rate = rate
+        if rate is not None:
+            self._burst = max(self._minimum_burst, rate * self.BURST_SECONDS)
+            self._tokens = self._burst
+
+    def _refill(self, now):
+        if self._timestamp is not None:
+            self._tokens = min(self._burst,
+                self._tokens + (now - self._timestamp) * self._rate)
+        self._timestamp = now
+
+    def can_send(self, now):
+        '''
+        Returns True if a packet can be sent now.
+        '''
+        if self._rate is None:
+            return True
+        self._refill(now)
+        return self._tokens > 0
+
+    def consume(self, byte_count):
+        '''
+        Take the cost of a sent packet from the bucket.
+        '''
+        if self._rate is not None:
+            self._tokens -= byte_count
+
+    def time_until_send(self, now):
+        '''
+        Returns the number of seconds until a packet can be sent.
+        '''
+        if self._rate is None or self.can_send(now):
+            return 0
+        return -self._tokens / self._rate
+
+class CongestionWindow(object):
+    '''
+    An additive increase, multiplicative decrease (AIMD) limit on the bytes
+    of reliable data in flight. The window grows by the bytes acked while
+    below the slow start threshold and by about one MTU per window of acked
+    bytes above it. A loss halves the window, at most once per round trip.
+    '''
+    def __init__(self, mtu, initial_window, minimum_window, maximum_window):
+        self._mtu = mtu
+        self._minimum_window = minimum_window
+        self._maximum_window = maximum_window
+        self._window = initial_window
+        self._slow_start_threshold = maximum_window
+        self._recovery_until = None
+        self.loss_count = 0
+
+    @property
+    def window(self):
+        return int(self._window)
+
+    def on_ack(self, byte_count):
+        '''
+        Grow the window after byte_count bytes of reliable data are acked.
+        '''
+        if self._window < self._slow_start_threshold:
+            self._window += byte_count
+        else:
+            self._window += self._mtu * byte_count / float(self._window)
+        self._window = min(self._window, self._maximum_window)
+
+    def on_loss(self, now, rtt):
+        '''
+        Shrink the window after reliable data is lost. Losses within a
+        round trip of the previous decrease are treated as the same event.
+        '''
+        self.loss_count += 1
+        if self._recovery_until is not None and now < self._recovery_until:
+            return
+        self._window = max(self._minimum_window, self._window / 2.0)
+        self._slow_start_threshold = self._window
+        self._recovery_until = now + rtt
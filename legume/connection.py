@@ -4,25 +4,38 @@
 
 __docformat__ = 'restructuredtext'
 
-import struct
 import random
 import logging
+from collections import OrderedDict, deque
 from legume import netshared
 from legume import timing as time
 from legume.nevent import Event
-from legume.pingsampler import PingSampler
+from legume.rttestimator import RttEstimator
+from legume.congestion import TokenBucket, CongestionWindow
+from legume.recentids import RecentIdWindow
+from legume.reorderbuffer import ReorderBuffer, next_sequence_number
+from legume.fragments import Fragment, FragmentReassembler, split_message, \
+    FRAGMENT_HEADER, MAX_FRAGMENT_COUNT
+from legume.acks import ReceivedPackets, SentPacket, acked_sequence_numbers, \
+    ACK_BITFIELD_SIZE
 from legume.bitfield import bitfield
-from legume.bytebuffer import ByteBuffer
+from legume.bytebuffer import ByteBuffer, compile_struct
 from legume import messages
-import errno
 
 PING_REQUEST_FREQUENCY = 2.0
 CONNECTION_LOSS = 0
 
 class OutgoingMessage(object):
-    def __init__(self, message_id, message_bytes, require_ack):
+    '''
+    A message waiting in the outgoing queue. The transport header is
+    specific to the connection, the payload bytes may be shared with the
+    outgoing queues of other connections.
+    '''
+    def __init__(self, message_id, header_bytes, payload_bytes, require_ack):
         self.message_id = message_id
-        self.message_bytes = message_bytes
+        self.header_bytes = header_bytes
+        self.payload_bytes = payload_bytes
+        self.length = len(header_bytes) + len(payload_bytes)
         self.require_ack = require_ack
 
         '''
@@ -33,17 +46,35 @@ class OutgoingMessage(object):
         has elapsed between send attempts.
         '''
         self.last_send_attempt_timestamp = None
+        self.send_count = 0
 
-    @property
-    def length(self):
-        return len(self.message_bytes)
+        # Set for messages sent with send_latest_message: the key a newer
+        # message replaces this one by, and the time it is dropped unsent.
+        self.coalesce_key = None
+        self.expires_at = None
+
+        # The place of the message in the outgoing queue, set when it is
+        # queued to send.
+        self.queue_order = 0
 
 class Connection(object):
 
     MTU = 1400
+    PACKET_HEADER = 'HHI'
     MESSAGE_TRANSPORT_HEADER = 'HHB'
+    # Bits 3 to 7 of the message transport header flags hold the channel.
+    CHANNEL_SHIFT = 3
+    ORDERED_CHANNEL_COUNT = 32
     RECENT_MESSAGE_LIST_SIZE = 1000
+    SENT_PACKET_HISTORY_SIZE = 1024
+    INITIAL_CONGESTION_WINDOW = 32 * MTU
+    MINIMUM_CONGESTION_WINDOW = 2 * MTU
+    MAXIMUM_CONGESTION_WINDOW = 1024 * MTU
+    FRAGMENTS_PER_UPDATE = 8
+    MAX_REASSEMBLY_GROUPS = 32
+    MAX_REASSEMBLY_BYTES = 1024 * 1024
     MINIMUM_RESEND_DELAY_MS = 10 / 1000.0
+    MAXIMUM_RESEND_DELAY = 2.0
 
     _log = logging.getLogger('legume.Connection')
 
@@ -54,6 +85,10 @@ class Connection(object):
             self.message_factory = message_factory
 
         self.parent = parent
+        self._packet_header = compile_struct(self.PACKET_HEADER)
+        self._message_transport_header = compile_struct(
+            self.MESSAGE_TRANSPORT_HEADER)
+        self._fragment_header = compile_struct(FRAGMENT_HEADER)
         self._last_receive_timestamp = time.time()
         self._last_send_timestamp = time.time()
         self._keep_alive_send_timestamp = time.time()
@@ -65,7 +100,16 @@ class Connection(object):
 
         self._ping_id = 0
         self._ping_send_timestamp = time.time()
-        self._ping_meter = PingSampler()
+
+        # client: message id of the ConnectRequest waiting for a reply
+        self._connect_request_message_id = None
+
+        # The initial resend delay is high - This prevents spamming
+        # of the network prior to obtaining a calculated latency.
+        self._rtt = RttEstimator(
+            initial_rto=0.3,
+            minimum_rto=self.MINIMUM_RESEND_DELAY_MS,
+            maximum_rto=self.MAXIMUM_RESEND_DELAY)
 
         self.OnConnectRequestAccepted = Event()
         self.OnConnectRequestRejected = Event()
@@ -73,20 +117,79 @@ class Connection(object):
         self.OnError = Event()
         self.OnMessage = Event()
         self.OnDisconnect = Event()
+        self.OnBackpressure = Event()
+
+        # System messages are handled here, by MessageTypeID, and all
+        # other messages are passed to OnMessage.
+        self._system_message_handlers = dict(
+            (self.message_factory.get_by_name(name).MessageTypeID, handler)
+            for name, handler in [
+                ('ConnectRequestAccepted', self._on_connect_request_accepted),
+                ('ConnectRequestRejected', self._on_connect_request_rejected),
+                ('ConnectChallenge', self._on_connect_challenge),
+                ('KeepAliveResponse', self._on_keep_alive_response),
+                ('KeepAliveRequest', self._on_keep_alive_request),
+                ('Pong', self._on_pong),
+                ('Ping', self._on_ping),
+                ('Disconnected', self._on_disconnected),
+                ('MessageAck', self._on_message_ack),
+                ('ConnectRequest', self._on_connect_request)])
 
         # Packet instances to be processed go in here
         self._incoming_messages = []
 
-        # List of OutgoingMessages
-        self._outgoing = []
-
-        # In-order packet instances that have arrived early
-        self._incoming_out_of_sequence_messages = []
-
-        self._incoming_ordered_sequence_number = 0
-        self._outgoing_ordered_sequence_number = 1
+        # OutgoingMessages by message_id, in the order they were sent
+        self._outgoing = OrderedDict()
+        self._outgoing_bytes = 0
+        # The queued messages that haven't been sent yet, reliable and
+        # unreliable kept apart so reliable messages blocked by the
+        # congestion window don't hold up unreliable ones, and the reliable
+        # messages that have been sent, in the order they were last sent.
+        self._unsent_reliable = deque()
+        self._unsent_unreliable = deque()
+        self._queued_message_count = 0
+        self._awaiting_ack = OrderedDict()
+        # Unsent latest-value messages by (MessageTypeID, key).
+        self._latest = {}
+        # Set when a send exceeded the queue limits under the
+        # BACKPRESSURE_DISCONNECT policy, the next update raises OnError.
+        self._queue_overflowed = False
+
+        # In-order packet instances that have arrived early, one buffer
+        # for each ordered channel.
+        self._reorder_buffers = [
+            ReorderBuffer() for x in range(self.ORDERED_CHANNEL_COUNT)]
+
+        # Fragments of large messages waiting to be moved into the
+        # outgoing queue, and fragments received from the remote end.
+        self._pending_fragments = deque()
+        self._outgoing_fragment_group_id = 0
+        self._reassembler = FragmentReassembler(
+            self.MAX_REASSEMBLY_GROUPS, self.MAX_REASSEMBLY_BYTES,
+            self.parent.timeout)
+
+        self._outgoing_ordered_sequence_numbers = [0] * self.ORDERED_CHANNEL_COUNT
         self._outgoing_message_id = 0
-        self._recent_message_ids = []
+        self._recent_message_ids = RecentIdWindow(self.RECENT_MESSAGE_LIST_SIZE)
+
+        # Packet acknowledgement. SentPackets by sequence number that are
+        # waiting for an ack, and the packets received from the remote end.
+        self._outgoing_packet_sequence_number = 0
+        self._sent_packets = OrderedDict()
+        self._received_packets = ReceivedPackets()
+        self._ack_pending = False
+        self._unacked_packet_count = 0
+
+        # Congestion control. The window limits the bytes of reliable data
+        # in flight, the pacer limits all packets to the parent's
+        # max_send_rate.
+        self._congestion = CongestionWindow(self.MTU,
+            self.INITIAL_CONGESTION_WINDOW,
+            self.MINIMUM_CONGESTION_WINDOW,
+            self.MAXIMUM_CONGESTION_WINDOW)
+        self._pacer = TokenBucket(minimum_burst=self.MTU)
+        self._in_flight_packets = deque()
+        self._bytes_in_flight = 0
 
         # Metrics
         self._in_bytes = 0
@@ -95,20 +198,39 @@ class Connection(object):
         self._out_packets = 0
         self._in_messages = 0
         self._out_messages = 0
-
-        '''
-        Default transport latency is high - This prevents spamming
-        of the network prior to obtaining a calculated latency.
-        '''
-        self._transport_latency = 0.3 # 0.1 = 100ms
+        self._resent_messages = 0
 
     @property
     def out_buffer_bytes(self):
-        return sum([len(o.message_bytes) for o in self._outgoing])
+        return self._outgoing_bytes
 
     @property
     def latency(self):
-        return self._ping_meter.get_ping()
+        return self._rtt.srtt * 1000
+
+    @property
+    def smoothed_rtt(self):
+        return self._rtt.srtt * 1000
+
+    @property
+    def rtt_variance(self):
+        return self._rtt.rttvar * 1000
+
+    @property
+    def jitter(self):
+        return self._rtt.jitter * 1000
+
+    @property
+    def rto(self):
+        return self._rtt.rto * 1000
+
+    @property
+    def congestion_window(self):
+        return self._congestion.window
+
+    @property
+    def bytes_in_flight(self):
+        return self._bytes_in_flight
 
     @property
     def in_bytes(self):
@@ -120,7 +242,8 @@ class Connection(object):
 
     @property
     def reorder_queue(self):
-        return len(self._incoming_out_of_sequence_messages)
+        return sum(len(reorder_buffer)
+            for reorder_buffer in self._reorder_buffers)
 
     @property
     def keepalive_count(self):
@@ -140,142 +263,212 @@ class Connection(object):
         try:
             self.parent.do_read(self._on_socket_data)
         except netshared.NetworkEndpointError:
-            self.raiseOnError('Connection reset by peer')
+            self.OnError(self, 'Connection reset by peer')
             return
 
-        if self._ping_meter.has_estimate():
-            self._transport_latency = self._ping_meter.get_ping()
-
-        read_messages = self._update(
-                        self.parent._socket, self.parent._address)
+        read_messages = self._update(self.parent._address)
 
+        now = time.time()
         if len(read_messages) != 0:
-            self._last_receive_timestamp = time.time()
+            self._last_receive_timestamp = now
 
+        system_message_handlers = self._system_message_handlers
         for message in read_messages:
-
-            if self.message_factory.is_a(message, 'ConnectRequestAccepted'):
-                self.OnConnectRequestAccepted(self, None)
-
-            elif self.message_factory.is_a(message, 'ConnectRequestRejected'):
-                self.OnConnectRequestRejected(self, None)
-
-            elif self.message_factory.is_a(message, 'KeepAliveResponse'):
-
-                if (message.id.value == self._keep_alive_message_id):
-                    self._ping_meter.add_sample(
-                        (time.time()-self._keep_alive_send_timestamp)*1000)
-                else:
-                    self._log.warning('Received old keep-alive, discarding')
-
-            elif self.message_factory.is_a(message, 'KeepAliveRequest'):
-                self._keepalive_count += 1
-                response = self.message_factory.get_by_name('KeepAliveResponse')()
-                response.id.value = message.id.value
-                self.send_message(response)
-
-            elif self.message_factory.is_a(message, 'Pong'):
-                if (message.id.value == self._ping_id):
-                    self._ping_meter.add_sample(
-                      (time.time()-self._ping_send_timestamp)*1000)
-                else:
-                    self._log.warning('Received old Pong, discarding')
-
-            elif self.message_factory.is_a(message, 'Ping'):
-                self._send_pong(message.id.value)
-
-            elif self.message_factory.is_a(message, 'Disconnected'):
-                self._log.debug('Received `Disconnected` message')
-                self.OnDisconnect(self, None)
-
-            elif self.message_factory.is_a(message, 'MessageAck'):
-                self._process_message_ack(message.message_to_ack.value)
-
-            elif self.message_factory.is_a(message, 'ConnectRequest'):
-                # Unless the connection request is explicitly denied then
-                # a connection is made - OnConnectRequest may return None
-                # if no event handlers are bound.
-                accept = True
-
-                if (message.protocol.value != netshared.PROTOCOL_VERSION):
-                    self._log.error('Invalid protocol version for client')
-                    accept = False
-                if self.OnConnectRequest(self.parent, message) is False:
-                    accept = False
-
-                if accept:
-                    response = self.message_factory.get_by_name('ConnectRequestAccepted')
-                    self.send_reliable_message(response())
-                else:
-                    response = self.message_factory.get_by_name('ConnectRequestRejected')
-                    self.send_reliable_message(response())
-                    self.pendingDisconnect = True
+            handler = system_message_handlers.get(message.MessageTypeID)
+            if handler is not None:
+                handler(message)
             else:
                 self.OnMessage(self, message)
 
 
-        if (time.time() > self._ping_send_timestamp + PING_REQUEST_FREQUENCY):
+        if (now > self._ping_send_timestamp + PING_REQUEST_FREQUENCY):
             if self.parent.is_server:
-                self._keep_alive_send_timestamp = time.time()
+                self._keep_alive_send_timestamp = now
             self._send_ping()
 
 
         if self.parent.is_server:
             # Server sends keep alive requests...
-            if ((time.time()-self._keep_alive_send_timestamp)>
+            if ((now-self._keep_alive_send_timestamp)>
                (self.parent.timeout/2)):
                 self._send_keep_alive()
             # though it will eventually give up...
-            if (time.time()-self._last_receive_timestamp)>(self.parent.timeout):
+            if (now-self._last_receive_timestamp)>(self.parent.timeout):
                 self.OnError(self, 'Connection timed out')
         else:
             # ...Client waits for the connection to timeout
-            if (time.time()-self._last_receive_timestamp)>(self.parent.timeout):
+            if (now-self._last_receive_timestamp)>(self.parent.timeout):
                 self._log.info('Connection has timed out')
                 self.OnError(self, 'Connection timed out')
 
-    def send_message(self, message, ordered=False, reliable=False):
+        if self._queue_overflowed:
+            self.OnError(self, 'Outgoing queue is full')
+
+    def send_message(self, message, ordered=False, reliable=False, channel=0):
         '''
         Send a message and specify any options for the send method used.
         A message sent inOrder is implicitly sent as reliable.
+        Ordered messages are only ordered relative to other messages sent
+        on the same channel, so a lost message only delays later messages
+        on its own channel. channel is from 0 to ORDERED_CHANNEL_COUNT-1.
+        A message too large for a single packet is split into reliable
+        fragments and read as one message by the remote end. An unreliable
+        message sharing a packet with a fragment is lost if the remote end
+        has no room to reassemble the fragment.
         message is an instance of a subclass of packets.BasePacket.
         Returns the number of bytes added to the output queue for this
-        message (header + message).
+        message (header + message), or 0 if the queue is full and the
+        parent's backpressure_policy refused the message. System messages,
+        such as pings and Disconnected, are always queued.
+        '''
+        # The handshake, keep-alives and disconnection must get through
+        # however full the queue is.
+        is_limited = message.MessageTypeID >= messages.BASE_MESSAGETYPEID_USER
+        total_length = self._send_encoded_message(
+            message.get_packet_bytes(), ordered, reliable, channel, is_limited)
+        self._log.debug('Added %d byte %s packet in outgoing buffer' %
+            (total_length, message.__class__.__name__))
+        return total_length
+
+    def send_encoded_message(self, message_bytes, ordered=False,
+                             reliable=False, channel=0):
         '''
+        Send a message that has already been encoded by
+        BaseMessage.get_packet_bytes. Only the transport header is created
+        for this connection, so the same message_bytes can be queued on
+        many connections without encoding the message for each one.
+        Takes the same options as send_message.
+        '''
+        return self._send_encoded_message(
+            message_bytes, ordered, reliable, channel, True)
+
+    def _send_encoded_message(self, message_bytes, ordered, reliable,
+                              channel, is_limited):
+        if not 0 <= channel < self.ORDERED_CHANNEL_COUNT:
+            raise netshared.ArgumentError('Invalid channel %s, must be 0 to %d' %
+                (channel, self.ORDERED_CHANNEL_COUNT-1))
+
+        # Checked before an ordered sequence number is taken, a refused
+        # message mustn't leave a gap in its channel.
+        if is_limited and not self._make_room(len(message_bytes)):
+            return 0
+
         self._last_send_timestamp = time.time()
 
-        self._outgoing_message_id += 1
-        message_id = self._outgoing_message_id
         if ordered:
-            self._outgoing_ordered_sequence_number += 1
-            inorder_sequence_number = self._outgoing_ordered_sequence_number
+            inorder_sequence_number = next_sequence_number(
+                self._outgoing_ordered_sequence_numbers[channel])
+            self._outgoing_ordered_sequence_numbers[channel] = \
+                inorder_sequence_number
         else:
             inorder_sequence_number = 0
 
-        packet_flags = bitfield()
+        if (len(message_bytes) + self._message_transport_header.size >
+          self.MTU - self._packet_header.size):
+            total_length = self._send_fragmented_message(
+                message_bytes, ordered, inorder_sequence_number, channel)
+            self._out_bytes += total_length
+            self._log.debug('Split %d byte message into %d fragments' %
+                (len(message_bytes), len(self._pending_fragments)))
+            return total_length
+
+        message_id = self._next_message_id()
+
+        packet_flags = bitfield(channel << self.CHANNEL_SHIFT)
         packet_flags[0] = int(ordered)
         packet_flags[1] = int(reliable)
 
-        message_transport_header = struct.pack(
-            '!'+self.MESSAGE_TRANSPORT_HEADER,
+        message_transport_header = self._message_transport_header.pack(
             message_id, inorder_sequence_number, int(packet_flags))
 
-        message_bytes = message.get_packet_bytes()
         total_length = len(message_bytes)+len(message_transport_header)
         self._out_bytes += total_length
 
         self._add_message_bytes_to_output_list(
-            message_id,
-            message_transport_header+message_bytes,
+            message_id, message_transport_header, message_bytes,
             ordered or reliable)
 
         self._log.debug('Packet data length = %s' % len(message_bytes))
         self._log.debug('Header length = %s' % len(message_transport_header))
-        self._log.debug('Added %d byte %s packet in outgoing buffer' %
-            (total_length, message.__class__.__name__))
 
         return total_length
 
+    def send_latest_message(self, message, key, ttl=None):
+        '''
+        Send an unreliable message that only matters until a newer one
+        with the same key is sent, such as the position of an entity.
+        If a message of the same class and key is still queued it is
+        replaced in place by this one, so only the latest value goes out.
+        If ttl is given the message is dropped unsent once it has been
+        queued for ttl seconds. Returns the number of bytes added to the
+        output queue.
+        '''
+        return self.send_encoded_latest_message(
+            message.get_packet_bytes(), message.MessageTypeID, key, ttl)
+
+    def send_encoded_latest_message(self, message_bytes, message_type_id,
+                                    key, ttl=None):
+        '''
+        Send a message encoded by BaseMessage.get_packet_bytes as a latest
+        value. message_type_id is the MessageTypeID of the encoded message.
+        See send_latest_message.
+        '''
+        coalesce_key = (message_type_id, key)
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+
+        message = self._latest.get(coalesce_key)
+        if message is not None:
+            length = len(message.header_bytes) + len(message_bytes)
+            if length > self.MTU - self._packet_header.size:
+                raise BufferError('Packet is too large. size=%s, mtu=%s' % (
+                    length, self.MTU - self._packet_header.size))
+            # A larger value is subject to the queue limits. Making room
+            # may drop the queued message itself, which is then sent as
+            # a new one.
+            growth = length - message.length
+            if growth > 0 and not self._make_room_for(growth, 0):
+                return 0
+            if self._latest.get(coalesce_key) is not message:
+                message = None
+
+        if message is not None:
+            # Queued messages are never in a packet, so the payload can
+            # be swapped without changing the message's place in the queue.
+            self._outgoing_bytes += length - message.length
+            self._out_bytes += length - message.length
+            message.payload_bytes = message_bytes
+            message.length = length
+            message.expires_at = expires_at
+            self._last_send_timestamp = now
+            return length
+
+        if not self._make_room(len(message_bytes)):
+            return 0
+
+        self._last_send_timestamp = now
+        message_id = self._next_message_id()
+        header_bytes = self._message_transport_header.pack(message_id, 0, 0)
+        self._add_message_bytes_to_output_list(
+            message_id, header_bytes, message_bytes)
+        message = self._outgoing[message_id]
+        message.coalesce_key = coalesce_key
+        message.expires_at = expires_at
+        self._latest[coalesce_key] = message
+        self._out_bytes += message.length
+        return message.length
+
+    def send_connect_request(self, cookie=''):
+        '''
+        Send a ConnectRequest to the server. cookie is the cookie from the
+        server's ConnectChallenge, the first request is sent without one.
+        '''
+        request = self.message_factory.get_by_name('ConnectRequest')()
+        request.protocol.value = netshared.PROTOCOL_VERSION
+        request.cookie.value = cookie
+        self.send_reliable_message(request)
+        self._connect_request_message_id = self._outgoing_message_id
+
     def send_reliable_message(self, message):
         '''
         Send a message that is guaranteed to be delivered.
@@ -283,22 +476,274 @@ class Connection(object):
         '''
         self.send_message(message, False, True)
 
-    def send_inorder_message(self, message):
+    def send_inorder_message(self, message, channel=0):
         '''
-        Send a message in the in-order channel. Any packets sent in-order will
-        arrive in the order they were sent.
+        Send a message in an in-order channel. Any packets sent in-order on
+        the same channel will arrive in the order they were sent.
         message is an instance of a subclass of packets.BasePacket
         '''
-        self.send_message(message, True)
+        self.send_message(message, True, channel=channel)
+
+    def flush(self):
+        '''
+        Send the queued messages now rather than at the next update, as far
+        as the pacer and congestion window allow.
+        '''
+        self._do_write(self.parent._address)
+        self.parent._flush_datagrams()
+
+    def can_send(self, length):
+        '''
+        Returns True if a message of length encoded bytes can be queued
+        without exceeding the parent's max_queued_bytes or
+        max_queued_messages.
+        '''
+        if self._queue_overflowed:
+            return False
+        return self._fits_in_queue(*self._queue_cost(length))
 
     def has_outgoing_packets(self):
         '''
         Returns whether this buffer has any packets waiting to be sent.
         '''
-        return len(self._outgoing) > 0
+        return len(self._outgoing) > 0 or len(self._pending_fragments) > 0
+
+    def next_deadline(self):
+        '''
+        Returns the time at which update() next has work to do if no
+        packets arrive: sending queued messages or acks, resending an
+        unacked message, sending a ping or keep-alive, or timing out.
+        '''
+        if self._queue_overflowed:
+            return time.time()
+
+        deadline = min(
+            self._ping_send_timestamp + PING_REQUEST_FREQUENCY,
+            self._last_receive_timestamp + self.parent.timeout)
+        if self.parent.is_server:
+            deadline = min(deadline,
+                self._keep_alive_send_timestamp + self.parent.timeout / 2)
+
+        # Queued messages are sent once the socket is writable, which
+        # poll() waits for.
+        if self.parent._send_blocked():
+            return deadline
+
+        now = time.time()
+        send_time = now + self._pacer.time_until_send(now)
+        if self._ack_pending or self._pending_fragments:
+            return send_time
+
+        if self._unsent_unreliable:
+            return send_time
+        # Reliable messages are sent in order, so only the first one needs
+        # to fit in the congestion window. One that doesn't waits for an
+        # ack or for a resend deadline.
+        unsent_reliable = self._unsent_reliable
+        if unsent_reliable and unsent_reliable[0].length <= (
+          self._congestion.window - self._bytes_in_flight):
+            return send_time
+
+        for message in self._awaiting_ack.values():
+            # The first message has the earliest resend deadline.
+            return min(deadline,
+                message.last_send_attempt_timestamp + self._rtt.rto)
+        return deadline
 
     # ------------- Private Methods -------------
 
+    def _on_connect_request_accepted(self, message):
+        self._connect_request_message_id = None
+        self.OnConnectRequestAccepted(self, None)
+
+    def _on_connect_request_rejected(self, message):
+        self._connect_request_message_id = None
+        self.OnConnectRequestRejected(self, None)
+
+    def _on_connect_challenge(self, message):
+        if self._connect_request_message_id is not None:
+            # Replace the request that was challenged.
+            self._remove_outgoing(self._connect_request_message_id)
+            self.send_connect_request(message.cookie.value)
+
+    def _on_keep_alive_response(self, message):
+        if (message.id.value == self._keep_alive_message_id):
+            self._rtt.add_sample(
+                time.time()-self._keep_alive_send_timestamp)
+        else:
+            self._log.warning('Received old keep-alive, discarding')
+
+    def _on_keep_alive_request(self, message):
+        self._keepalive_count += 1
+        response = self.message_factory.get_by_name('KeepAliveResponse')()
+        response.id.value = message.id.value
+        self.send_message(response)
+
+    def _on_pong(self, message):
+        if (message.id.value == self._ping_id):
+            self._rtt.add_sample(
+              time.time()-self._ping_send_timestamp)
+        else:
+            self._log.warning('Received old Pong, discarding')
+
+    def _on_ping(self, message):
+        self._send_pong(message.id.value)
+
+    def _on_disconnected(self, message):
+        self._log.debug('Received `Disconnected` message')
+        self.OnDisconnect(self, None)
+
+    def _on_message_ack(self, message):
+        self._process_message_ack(message.message_to_ack.value)
+
+    def _on_connect_request(self, message):
+        # Unless the connection request is explicitly denied then
+        # a connection is made - OnConnectRequest may return None
+        # if no event handlers are bound.
+        accept = True
+
+        if (message.protocol.value != netshared.PROTOCOL_VERSION):
+            self._log.error('Invalid protocol version for client')
+            accept = False
+        if self.OnConnectRequest(self.parent, message) is False:
+            accept = False
+
+        if accept:
+            response = self.message_factory.get_by_name('ConnectRequestAccepted')
+            self.send_reliable_message(response())
+        else:
+            response = self.message_factory.get_by_name('ConnectRequestRejected')
+            self.send_reliable_message(response())
+            self.pendingDisconnect = True
+
+    def _next_message_id(self):
+        self._outgoing_message_id = next_sequence_number(
+            self._outgoing_message_id)
+        return self._outgoing_message_id
+
+    def _send_fragmented_message(self, message_bytes, ordered,
+                                 inorder_sequence_number, channel):
+        '''
+        Split message_bytes into reliable fragments that each fit in a
+        packet. Fragments wait in _pending_fragments and are moved into
+        the outgoing queue a few at a time by _release_fragments. Returns
+        the number of bytes queued.
+        '''
+        fragment_size = (self.MTU - self._packet_header.size -
+            self._message_transport_header.size - self._fragment_header.size)
+        # The fragments are views of message_bytes, not copies.
+        chunks = split_message(memoryview(message_bytes), fragment_size)
+        if len(chunks) > MAX_FRAGMENT_COUNT:
+            raise BufferError('Message is too large. size=%s, max=%s' % (
+                len(message_bytes), fragment_size * MAX_FRAGMENT_COUNT))
+
+        self._outgoing_fragment_group_id = next_sequence_number(
+            self._outgoing_fragment_group_id)
+        group_id = self._outgoing_fragment_group_id
+
+        packet_flags = bitfield(channel << self.CHANNEL_SHIFT)
+        packet_flags[0] = int(ordered)
+        packet_flags[1] = 1
+        packet_flags[2] = 1
+
+        total_length = 0
+        for index, chunk in enumerate(chunks):
+            message_id = self._next_message_id()
+            header_bytes = (
+                self._message_transport_header.pack(
+                    message_id, inorder_sequence_number, int(packet_flags)) +
+                self._fragment_header.pack(
+                    group_id, index, len(chunks), len(chunk)))
+            self._pending_fragments.append((message_id, header_bytes, chunk))
+            fragment_length = len(header_bytes) + len(chunk)
+            self._outgoing_bytes += fragment_length
+            total_length += fragment_length
+
+        return total_length
+
+    def _queue_cost(self, length):
+        '''
+        Returns the number of bytes and messages that a message of length
+        encoded bytes adds to the outgoing queue, counting each fragment
+        of a large message.
+        '''
+        header_size = self._message_transport_header.size
+        if length + header_size <= self.MTU - self._packet_header.size:
+            return length + header_size, 1
+        header_size += self._fragment_header.size
+        fragment_size = self.MTU - self._packet_header.size - header_size
+        fragment_count = -(-length // fragment_size)
+        return length + fragment_count * header_size, fragment_count
+
+    def _fits_in_queue(self, queued_bytes, queued_messages):
+        max_bytes = self.parent.max_queued_bytes
+        max_messages = self.parent.max_queued_messages
+        return ((max_bytes is None or
+            self._outgoing_bytes + queued_bytes <= max_bytes) and
+            (max_messages is None or
+            len(self._outgoing) + len(self._pending_fragments) +
+            queued_messages <= max_messages))
+
+    def _make_room(self, length):
+        '''
+        Returns True if a message of length encoded bytes may be queued.
+        If it would exceed the queue limits OnBackpressure is raised and
+        the parent's backpressure_policy decides.
+        '''
+        return self._make_room_for(*self._queue_cost(length))
+
+    def _make_room_for(self, queued_bytes, queued_messages):
+        '''
+        Returns True if queued_bytes bytes in queued_messages more messages
+        may be queued, applying the backpressure_policy as _make_room does.
+        '''
+        if self._queue_overflowed:
+            return False
+        if self._fits_in_queue(queued_bytes, queued_messages):
+            return True
+
+        self.OnBackpressure(self, queued_bytes)
+        policy = self.parent.backpressure_policy
+        if policy == netshared.NetworkEndpoint.BACKPRESSURE_DROP_UNRELIABLE:
+            unsent_unreliable = self._unsent_unreliable
+            while unsent_unreliable:
+                message = unsent_unreliable.popleft()
+                self._remove_outgoing(message.message_id)
+                self._log.debug('Dropped unreliable message %s' %
+                    message.message_id)
+                if self._fits_in_queue(queued_bytes, queued_messages):
+                    return True
+        elif policy == netshared.NetworkEndpoint.BACKPRESSURE_DISCONNECT:
+            self._queue_overflowed = True
+
+        self._log.info('Outgoing queue is full, refused %d byte message' %
+            queued_bytes)
+        return False
+
+    def _release_fragments(self):
+        '''
+        Move up to FRAGMENTS_PER_UPDATE pending fragments into the outgoing
+        queue so a large message doesn't hold up other messages.
+        '''
+        pending_fragments = self._pending_fragments
+        for x in range(min(self.FRAGMENTS_PER_UPDATE, len(pending_fragments))):
+            message_id, header_bytes, chunk = pending_fragments.popleft()
+            # The fragment bytes are already counted in _outgoing_bytes.
+            message = OutgoingMessage(message_id, header_bytes, chunk, True)
+            self._outgoing[message_id] = message
+            self._queue_unsent(message)
+
+    def _queue_unsent(self, message):
+        '''
+        Add an OutgoingMessage to the back of the queue of messages to send.
+        '''
+        self._queued_message_count += 1
+        message.queue_order = self._queued_message_count
+        if message.require_ack:
+            self._unsent_reliable.append(message)
+        else:
+            self._unsent_unreliable.append(message)
+
     def _on_socket_data(self, data, addr):
         self._process_inbound_packet(data)
 
@@ -330,37 +775,109 @@ class Connection(object):
         self.send_message(pong)
 
     def _process_message_ack(self, message_id):
-        for m in self._outgoing:
-            if m.message_id == message_id:
-                self._outgoing.remove(m)
-                return
-
-        self._log.warning('Got duplicate ACK for packet. message_id=%s' % (
-            message_id))
+        message = self._remove_outgoing(message_id)
+        if message is None:
+            self._log.warning('Got duplicate ACK for packet. message_id=%s' % (
+                message_id))
+        elif message.send_count == 1:
+            # Karn's rule: an ack for a resent message can't be matched
+            # to a send time, so only first transmissions are sampled.
+            self._rtt.add_sample(
+                time.time() - message.last_send_attempt_timestamp)
+
+    def _remove_outgoing(self, message_id):
+        '''
+        Remove a message from the outgoing queue by message_id. Returns the
+        removed OutgoingMessage or None if the message is not queued.
+        '''
+        message = self._outgoing.pop(message_id, None)
+        if message is not None:
+            self._outgoing_bytes -= message.length
+            self._awaiting_ack.pop(message_id, None)
+            if message.coalesce_key is not None:
+                del self._latest[message.coalesce_key]
+        return message
 
 
-    def _parse_packet(self, packet_bytes):
+    def _process_packet_ack(self, ack, ack_bits):
         '''
-        Parse a raw udp packet and return a list of parsed messages.
+        Retire every reliable message carried by the sent packets that
+        the remote end has acknowledged.
         '''
+        sent_packets = self._sent_packets
+        if not sent_packets:
+            return
 
-        byte_buffer = ByteBuffer(packet_bytes)
+        # Packet sequence numbers are never reused for a resend, so an ack
+        # gives an unambiguous round trip sample. Only packets carrying
+        # reliable messages are sampled, the remote end acks them at once
+        # while the ack for any other packet waits for its next send.
+        sampled = False
+        for sequence_number in acked_sequence_numbers(ack, ack_bits):
+            sent_packet = sent_packets.pop(sequence_number, None)
+            if sent_packet is not None:
+                if sent_packet.message_ids and not sampled:
+                    # The newest acked packet comes first.
+                    self._rtt.add_sample(time.time() - sent_packet.timestamp)
+                    sampled = True
+                if sent_packet.in_flight:
+                    self._land_packet(sent_packet)
+                    self._congestion.on_ack(sent_packet.length)
+                for message_id in sent_packet.message_ids:
+                    self._remove_outgoing(message_id)
+
+    def _land_packet(self, sent_packet):
+        sent_packet.in_flight = False
+        self._bytes_in_flight -= sent_packet.length
+
+    def _detect_lost_packets(self, now):
+        '''
+        Packets carrying reliable messages that have not been acked within
+        the resend delay are presumed lost. Their bytes no longer count as
+        in flight and the congestion window is reduced.
+        '''
+        in_flight_packets = self._in_flight_packets
+        resend_delay = self._rtt.rto
+        # Losses within a round trip are one loss event. Until there is a
+        # round trip sample the resend delay stands in for it.
+        if self._rtt.has_estimate():
+            recovery_period = self._rtt.srtt
+        else:
+            recovery_period = resend_delay
+        while in_flight_packets:
+            sent_packet = in_flight_packets[0]
+            if sent_packet.in_flight:
+                if sent_packet.timestamp + resend_delay >= now:
+                    break
+                self._land_packet(sent_packet)
+                self._congestion.on_loss(now, recovery_period)
+            in_flight_packets.popleft()
+
+    def _parse_packet(self, byte_buffer):
+        '''
+        Parse the messages in a raw udp packet, following the packet
+        header, and return a list of parsed messages.
+        '''
         parsed_messages = []
 
         while not byte_buffer.is_empty():
 
             message_id, sequence_number, message_flags = \
-                byte_buffer.read_struct(self.MESSAGE_TRANSPORT_HEADER)
+                byte_buffer.read_compiled_struct(self._message_transport_header)
+            message_flags_bf = bitfield(message_flags)
 
-            message_type_id = messages.BaseMessage.read_header_from_byte_buffer(
-                byte_buffer)[0]
-            message = self.message_factory.get_by_id(message_type_id)()
-            message.read_from_byte_buffer(byte_buffer)
+            if message_flags_bf[2]:
+                group_id, index, count, length = \
+                    byte_buffer.read_compiled_struct(self._fragment_header)
+                message = Fragment(
+                    group_id, index, count, byte_buffer.read_bytes(length))
+            else:
+                message = self._read_message(byte_buffer)
 
             # - These flags are for consumption by .update()
-            message_flags_bf = bitfield(message_flags)
             message.is_reliable = message_flags_bf[1]
             message.is_ordered = message_flags_bf[0]
+            message.channel = message_flags >> self.CHANNEL_SHIFT
 
             message.sequence_number = sequence_number
             message.message_id = message_id
@@ -369,6 +886,30 @@ class Connection(object):
 
         return parsed_messages
 
+    def _read_message(self, byte_buffer):
+        message_type_id = messages.BaseMessage.read_header_from_byte_buffer(
+            byte_buffer)[0]
+        message = self.message_factory.get_by_id(message_type_id)()
+        message.read_from_byte_buffer(byte_buffer)
+        return message
+
+    def _reassemble(self, fragment):
+        '''
+        Add a received fragment to the reassembler. Returns the complete
+        message once its last fragment arrives, otherwise None.
+        '''
+        message_bytes = self._reassembler.add(fragment, time.time())
+        if message_bytes is None:
+            return None
+
+        message = self._read_message(ByteBuffer(message_bytes))
+        message.is_reliable = fragment.is_reliable
+        message.is_ordered = fragment.is_ordered
+        message.channel = fragment.channel
+        message.sequence_number = fragment.sequence_number
+        message.message_id = fragment.message_id
+        return message
+
     def _process_inbound_packet(self, packet_bytes):
         '''
         Pass raw udp packet data to this method.
@@ -376,28 +917,68 @@ class Connection(object):
         the .incoming list.
         '''
         self._log.debug('%d bytes of packet_bytes read' % len(packet_bytes))
-        messages_to_read = self._parse_packet(packet_bytes)
+        byte_buffer = ByteBuffer(packet_bytes)
+        packet_sequence_number, ack, ack_bits = \
+            byte_buffer.read_compiled_struct(self._packet_header)
+        self._process_packet_ack(ack, ack_bits)
+        messages_to_read = self._parse_packet(byte_buffer)
 
         self._in_bytes += len(packet_bytes)
 
         self._log.debug('parsed %d messages from packet' % len(messages_to_read))
 
+        # A fragment is acked with its packet and is never resent once
+        # acked, so a fragment the reassembler can't hold refuses the whole
+        # packet. The packet isn't acked and the sender resends the fragment
+        # until the reassembler has room. Unreliable messages in the same
+        # packet are dropped with it, reliable ones are resent.
+        # Partial messages are kept as long as the connection would be.
+        now = time.time()
+        self._reassembler.timeout = self.parent.timeout
+        for message in messages_to_read:
+            if (isinstance(message, Fragment) and
+              not message.message_id in self._recent_message_ids and
+              not self._reassembler.accepts(message, now)):
+                self._log.debug('Refused packet with fragment of group %d' %
+                    message.group_id)
+                return 0
+
+        if packet_sequence_number != 0:
+            self._received_packets.add(packet_sequence_number)
+
         for message in messages_to_read:
-            if not message.message_id in self._recent_message_ids:
+            if message.is_ordered or message.is_reliable:
+                # Duplicates are acknowledged again as the ack for the
+                # earlier copy may have been lost.
+                self._ack_pending = True
+
+            # Messages sent outside of a connection have a message id of 0.
+            if (message.message_id == 0 or
+              not message.message_id in self._recent_message_ids):
+                if isinstance(message, Fragment):
+                    self._recent_message_ids.add(message.message_id)
+                    message = self._reassemble(message)
+                    if message is None:
+                        continue
+
                 self._log.debug('Message ordered flag %s' % str(message.is_ordered))
                 if message.is_ordered:
-                    if self._can_read_inorder_message(message.sequence_number):
-                        self._insert_message(message)
-                    else:
-                        self._incoming_out_of_sequence_messages.append(message)
-                        self._recent_message_ids.append(message.message_id)
-
+                    self._recent_message_ids.add(message.message_id)
+                    reorder_buffer = self._reorder_buffers[message.channel]
+                    for released_message in reorder_buffer.add(message):
+                        self._insert_message(released_message)
                 else:
                     self._insert_message(message)
 
+        if self._ack_pending:
+            self._unacked_packet_count += 1
+            if self._unacked_packet_count >= ACK_BITFIELD_SIZE:
+                # Older packets are about to fall out of the ack bitfield.
+                self._send_ack_packet(self.parent._address)
+
         return len(messages_to_read)
 
-    def _update(self, sock, address):
+    def _update(self, address):
         '''
         Update this buffer by sending any messages in the output lists
         and read any messages which have been insert into the inputBuffer
@@ -406,154 +987,219 @@ class Connection(object):
         Returns a list of message instances of messages that were read.
         '''
         read_packets = self._do_read()
-        self._truncate_recent_message_list()
-        self._do_write(sock, address)
+        self._do_write(address)
 
         return read_packets
 
-    def _add_message_bytes_to_output_list(self, message_id,
-                                     message_bytes, require_ack=False):
-        if len(message_bytes) > self.MTU:
+    def _add_message_bytes_to_output_list(self, message_id, header_bytes,
+                                     payload_bytes, require_ack=False):
+        message = OutgoingMessage(
+            message_id, header_bytes, payload_bytes, require_ack)
+        if message.length > self.MTU - self._packet_header.size:
             raise BufferError('Packet is too large. size=%s, mtu=%s' % (
-                len(message_bytes), self.MTU))
+                message.length, self.MTU - self._packet_header.size))
         else:
-            self._outgoing.append(
-                OutgoingMessage(message_id, message_bytes, require_ack))
+            self._outgoing[message_id] = message
+            self._outgoing_bytes += message.length
+            self._queue_unsent(message)
 
-    def _can_read_inorder_message(self, sequence_number):
+    def _create_packet(self, now=None, resend_delay=None):
         '''
-        Can the in-order message with the specified sequence number be
-        insert into the .incoming list for processing?
+        Build one packet in a single pass, first from the reliable messages
+        that are due to be resent and then from the messages not sent yet,
+        until the next message doesn't fit. Returns the packet as a list of
+        buffers, the packet header followed by the transport header and
+        payload of each message, or None if there is nothing to send.
+        Messages unacked for resend_delay seconds, the RTO by default, are
+        due to be resent.
         '''
-        return self._incoming_ordered_sequence_number == (sequence_number+1)
-
-    def _create_packet(self):
-        packet_size = 0
-        packet_bytes = bytearray()
-
-        sent_messages = []
-
-        self._log.debug('%d packets pending' % len(self._outgoing))
-
-        for message in self._outgoing:
-
+        if now is None:
+            now = time.time()
+        if resend_delay is None:
+            resend_delay = self._rtt.rto
+        mtu = self.MTU
+        packet_size = self._packet_header.size
+        packet_header = bytearray(packet_size)
+        packet_buffers = [packet_header]
+        window_available = self._congestion.window - self._bytes_in_flight
+
+        # Messages awaiting an ack are kept in the order they were last
+        # sent and share one resend delay, so the messages due to be
+        # resent are at the front.
+        # A minimum resend delay is required as with a 0ms latency
+        # connection _do_write would otherwise never run out of packets.
+        resent_messages = []
+        for message in self._awaiting_ack.values():
+            if message.last_send_attempt_timestamp + resend_delay >= now:
+                break
+            length = packet_size + message.length
+            if length > mtu or length > window_available:
+                break
+            packet_size = length
+            packet_buffers.append(message.header_bytes)
+            packet_buffers.append(message.payload_bytes)
+            resent_messages.append(message)
+
+        # New messages are taken from the two unsent queues in the order
+        # they were queued. Once a reliable message doesn't fit in the
+        # congestion window only unreliable messages go ahead of it.
+        new_messages = []
+        window_open = True
+        unsent_reliable = self._unsent_reliable
+        unsent_unreliable = self._unsent_unreliable
+        outgoing = self._outgoing
+        while True:
+            if unsent_reliable and window_open and (not unsent_unreliable or
+              unsent_reliable[0].queue_order <
+              unsent_unreliable[0].queue_order):
+                unsent = unsent_reliable
+            elif unsent_unreliable:
+                unsent = unsent_unreliable
+            else:
+                break
+            message = unsent[0]
+            if outgoing.get(message.message_id) is not message:
+                # Removed from the queue before it was sent.
+                unsent.popleft()
+                continue
+            if message.expires_at is not None and message.expires_at <= now:
+                # A latest value that is too old to be worth sending.
+                unsent.popleft()
+                self._remove_outgoing(message.message_id)
+                continue
+            length = packet_size + message.length
+            if length > mtu:
+                break
+            if message.require_ack and length > window_available:
+                window_open = False
+                continue
+            unsent.popleft()
+            packet_size = length
+            packet_buffers.append(message.header_bytes)
+            packet_buffers.append(message.payload_bytes)
+            new_messages.append(message)
+
+        if not resent_messages and not new_messages:
+            return None
+
+        awaiting_ack = self._awaiting_ack
+        acked_message_ids = []
+        for message in resent_messages:
+            message.last_send_attempt_timestamp = now
+            message.send_count += 1
+            awaiting_ack.move_to_end(message.message_id)
+            acked_message_ids.append(message.message_id)
+        for message in new_messages:
+            message.last_send_attempt_timestamp = now
+            message.send_count += 1
             if message.require_ack:
+                # Only removed from the outgoing queue when acked.
+                awaiting_ack[message.message_id] = message
+                acked_message_ids.append(message.message_id)
+            else:
+                self._remove_outgoing(message.message_id)
 
-                # a minimum resend delay is required for two reasons:
-                # 1. deadlock with a 0ms latency connection causes _do_write
-                #    to never exit as _create_packet always returns data.
-                # 2. resending every 0ms is just plain stupid.
+        self._resent_messages += len(resent_messages)
 
-                t = time.time()
-                resend_delay = max(self.MINIMUM_RESEND_DELAY_MS, self._transport_latency)
+        self._log.debug('Created %d byte packet, %d messages resent' % (
+            packet_size, len(resent_messages)))
 
-                self._log.debug('LSAT: %s' % str(message.last_send_attempt_timestamp))
-                self._log.debug('l8nc: %s' % str(self._transport_latency))
-                self._log.debug('time: %s' % t)
-                self._log.debug('rsnd: %s' % resend_delay)
+        sequence_number = self._next_packet_sequence_number()
+        sent_packet = SentPacket(
+            sequence_number, acked_message_ids, now, packet_size)
+        self._sent_packets[sequence_number] = sent_packet
+        if sent_packet.in_flight:
+            self._in_flight_packets.append(sent_packet)
+            self._bytes_in_flight += packet_size
+        self._pack_packet_header(packet_header, sequence_number)
 
-                if message.last_send_attempt_timestamp is not None:
-                    if ((message.last_send_attempt_timestamp +
-                      resend_delay) >= t):
-                        self._log.debug('Waiting for ack.')
-                        continue
+        return packet_buffers
 
-            if packet_size + message.length <= self.MTU:
-                self._log.debug('Added data message into UDP packet')
-                packet_size += message.length
-                packet_bytes += message.message_bytes
-                message.last_send_attempt_timestamp = time.time()
-                sent_messages.append(message)
-            else:
-                self._log.debug('packet at MTU limit.')
-
-        for sent_message in sent_messages:
-            # Packets that require an ack are only removed
-            # from the outgoing list if an ack is received.
-            if not sent_message.require_ack:
-                self._log.info('Message %d doesnt require ack - removing' %
-                    sent_message.message_id)
-                self._outgoing.remove(sent_message)
-            else:
-                self._log.info(
-                    'Message %d requires ack - waiting for response' %
-                    sent_message.message_id)
-
-        return packet_bytes
-
-    def _do_read(self):
-        unheld_messages = []
-        for held_message in self._incoming_out_of_sequence_messages:
+    def _next_packet_sequence_number(self):
+        '''
+        Returns the sequence number for the next packet sent. Only the most
+        recent SENT_PACKET_HISTORY_SIZE sent packets are kept waiting for an
+        ack, the reliable messages carried by older packets are resent once
+        their resend delay has passed.
+        '''
+        sequence_number = next_sequence_number(
+            self._outgoing_packet_sequence_number)
+        self._outgoing_packet_sequence_number = sequence_number
 
-            if self._can_read_inorder_message(held_message.sequence_number):
-                unheld_messages.append(held_message)
+        if len(self._sent_packets) >= self.SENT_PACKET_HISTORY_SIZE:
+            oldest = self._sent_packets.popitem(last=False)[1]
+            if oldest.in_flight:
+                self._land_packet(oldest)
 
-                self._incoming_inorder_sequence_number = held_message.sequence_number
-                self._incoming_messages.append(held_message)
+        return sequence_number
 
-        for unheld_message in unheld_messages:
-            self._incoming_out_of_sequence_messages.remove(unheld_message)
+    def _pack_packet_header(self, packet_header, sequence_number):
+        '''
+        Write the packet header, with the current acks, into the
+        packet_header bytearray.
+        '''
+        self._packet_header.pack_into(packet_header, 0, sequence_number,
+            self._received_packets.ack, self._received_packets.ack_bits)
+        self._ack_pending = False
+        self._unacked_packet_count = 0
 
-        for message in self._incoming_messages:
-            self._log.debug('Incoming message:')
-            self._log.debug('IsInOrder: %d' % message.is_ordered)
-            self._log.debug('IsReliable:%d' % message.is_reliable)
-            self._log.debug('MessageID :%d' % message.message_id)
-            if message.is_ordered or message.is_reliable:
-                ack_message = messages.MessageAck()
-                ack_message.message_to_ack.value = message.message_id
-                self.send_message(ack_message)
-                self._log.info(
-                  'Informing of reciept of message %d' % message.message_id)
+    def _send_ack_packet(self, address):
+        '''
+        Send a packet that only carries acks. These packets have a
+        sequence number of 0 so they are not acknowledged in turn.
+        '''
+        packet_header = bytearray(self._packet_header.size)
+        self._pack_packet_header(packet_header, 0)
+        self._send_packet(address, [packet_header])
 
+    def _do_read(self):
         read_messages = self._incoming_messages
         self._incoming_messages = []
 
         return read_messages
 
-    def _do_write(self, sock, address):
-        # TODO: combine _create_packet into this method, eg:
-        #   while has_messages:
-        #     add_message_to_packet
-        #     is packet_full?
-        #       send_packet
-        #   is packet_partially_full?
-        #     send_packet
-
-        while True:
-            packet = self._create_packet()
-            if not packet:
+    def _do_write(self, address):
+        # Each packet is filled until the next message doesn't fit, so
+        # only the last packet sent is partly full.
+        now = time.time()
+        self._detect_lost_packets(now)
+        self._release_fragments()
+        self._pacer.set_rate(self.parent.max_send_rate)
+
+        # While the endpoint's socket would block or its backlog is full,
+        # messages and acks stay queued here instead of being built into
+        # packets that can't be sent yet.
+        # Every message due at the start of the call is resent, and the
+        # RTO is backed off once for the timeout rather than once for each
+        # packet it took to resend them.
+        parent = self.parent
+        resend_delay = self._rtt.rto
+        resent_messages = self._resent_messages
+        while self._pacer.can_send(now) and not parent._send_blocked():
+            packet_buffers = self._create_packet(now, resend_delay)
+            if not packet_buffers:
                 break
+            self._send_packet(address, packet_buffers)
+            self._pacer.consume(sum(map(len, packet_buffers)))
+        if self._resent_messages != resent_messages:
+            self._rtt.backoff()
 
-            if ((CONNECTION_LOSS == 0) or (random.randint(1, 100) > CONNECTION_LOSS)):
-                try:
-                    bytes_sent = sock.sendto(packet, 0, address)
-                    self._out_packets += 1
-                except IOError as e:
-                    # HACK: ewouldblocks are ignored and the packet is silently
-                    # discarded. Packet sending should be re-written to
-                    # only remove messages from the send queue if the socket
-                    # operation completes successfully.
-                    errornum = e[0]
-                    if errornum != errno.EWOULDBLOCK:
-                        raise
-            else:
-                self._log.info('Simulated packet loss')
+        # Nothing was sent to carry the acks for received reliable messages.
+        if self._ack_pending and not parent._send_blocked():
+            self._send_ack_packet(address)
 
-            self._log.info('Sent UDP packet %d bytes in length' % len(packet))
+    def _send_packet(self, address, packet_buffers):
+        '''
+        Queue a packet on the endpoint, which sends it at the end of the
+        update.
+        '''
+        if ((CONNECTION_LOSS == 0) or (random.randint(1, 100) > CONNECTION_LOSS)):
+            self.parent._send_datagram(packet_buffers, address)
+            self._out_packets += 1
+        else:
+            self._log.info('Simulated packet loss')
 
     def _insert_message(self, message):
         self._incoming_messages.append(message)
-        self._recent_message_ids.append(message.message_id)
-        if message.is_ordered:
-            self._incoming_ordered_sequence_number = message.sequence_number
+        self._recent_message_ids.add(message.message_id)
 
-    def _truncate_recent_message_list(self):
-        '''
-        Ensures that the recentMessageIDs list length is kept below
-        MAX_RECENT_PACKET_LIST_SIZE. This method is called as part of this class'
-        update method.
-        '''
-        if len(self._recent_message_ids) > self.RECENT_MESSAGE_LIST_SIZE:
-            self._recent_message_ids = \
-                self._recent_message_ids[-self.RECENT_MESSAGE_LIST_SIZE:]
@@ -0,0 +1,95 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+'''
+The output stage of an endpoint. Connections queue their packets as a
+list of buffers - the packet header followed by the transport header and
+payload of each message - and the endpoint sends everything queued once
+per update. Each packet is sent with socket.sendmsg, which gathers the
+buffers in the kernel, so message payloads shared by many connections
+are never copied into a packet. Sockets without sendmsg are sent the
+joined buffers with sendto.
+'''
+
+__docformat__ = 'restructuredtext'
+
+import logging
+from collections import deque
+
+class DatagramQueue(object):
+    '''
+    Packets waiting to be written to a socket. A packet that can't be
+    sent because the socket's send buffer is full stays at the front of
+    the queue until the next flush, and the queue is `blocked` until a
+    flush empties it. Packets are only dropped if they can't be sent at
+    all or if queueing them would exceed max_bytes.
+    '''
+    _log = logging.getLogger('legume.datagrams')
+
+    def __init__(self, sock, max_bytes=None):
+        self._socket = sock
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+        self._datagrams = deque()
+        self._max_bytes = max_bytes
+        self.byte_count = 0
+        self.blocked = False
+        # Times a send would have blocked, and packets dropped.
+        self.blocked_count = 0
+        self.dropped_count = 0
+
+    def __len__(self):
+        return len(self._datagrams)
+
+    def has_room(self, length):
+        '''
+        Returns True if a packet of length bytes can be queued.
+        '''
+        return (self._max_bytes is None or
+            self.byte_count + length <= self._max_bytes)
+
+    def append(self, buffers, address):
+        '''
+        Queue a packet. Returns False if the packet was dropped because the
+        queue is full.
+        '''
+        length = sum(map(len, buffers))
+        if not self.has_room(length):
+            self.dropped_count += 1
+            self._log.warning('Send backlog is full, dropped packet to %s' %
+                str(address))
+            return False
+        self._datagrams.append((buffers, address, length))
+        self.byte_count += length
+        return True
+
+    def flush(self):
+        '''
+        Send the queued packets in order. Returns the number sent, which
+        is less than the number queued if the socket would block.
+        '''
+        datagrams = self._datagrams
+        sent = 0
+        self.blocked = False
+        while datagrams:
+            buffers, address, length = datagrams[0]
+            try:
+                if self._sendmsg is not None:
+                    self._sendmsg(buffers, (), 0, address)
+                else:
+                    self._socket.sendto(b''.join(buffers), 0, address)
+            except BlockingIOError:
+                self.blocked = True
+                self.blocked_count += 1
+                break
+            except OSError as e:
+                # The packet can't be sent, such as to an unreachable
+                # address, so it is dropped rather than retried forever.
+                self.dropped_count += 1
+                self._log.warning('Unable to send packet to %s: %s' % (
+                    str(address), e))
+            else:
+                sent += 1
+            datagrams.popleft()
+            self.byte_count -= length
+        return sent
@@ -0,0 +1,59 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+from legume import messages
+from legume.nevent import Event
+from legume.exceptions import ArgumentError
+
+class MessageDispatcher(object):
+    '''
+    Routes received application messages to the handlers registered for
+    their message class, looked up by MessageTypeID. Handlers are called
+    with the same (sender, message) arguments as OnMessage.
+    '''
+    def __init__(self):
+        self._events = {}
+
+    def on(self, message_class, handler):
+        '''
+        Call handler for every received message of message_class.
+        '''
+        self._check_message_class(message_class)
+        event = self._events.get(message_class.MessageTypeID)
+        if event is None:
+            event = self._events[message_class.MessageTypeID] = Event()
+        event += handler
+
+    def off(self, message_class, handler):
+        '''
+        Stop calling handler for messages of message_class.
+        '''
+        self._check_message_class(message_class)
+        event = self._events.get(message_class.MessageTypeID)
+        if event is not None:
+            event -= handler
+            if not event:
+                del self._events[message_class.MessageTypeID]
+
+    def dispatch(self, sender, message):
+        '''
+        Pass message to its handlers. Returns False if message has no
+        handlers, in which case the caller raises OnMessage instead.
+        '''
+        event = self._events.get(message.MessageTypeID)
+        if not event:
+            return False
+        event(sender, message)
+        return True
+
+    def _check_message_class(self, message_class):
+        if not (isinstance(message_class, type) and
+          issubclass(message_class, messages.BaseMessage)):
+            raise ArgumentError('%r is not a message class' % (message_class,))
+        if message_class.MessageTypeID < messages.BASE_MESSAGETYPEID_USER:
+            raise ArgumentError(
+                '%s is a system message and is handled by the connection' %
+                message_class.__name__)
@@ -0,0 +1,146 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+# Messages too large for a single packet are split into fragments. Each
+# fragment follows its message transport header with a fragment header of
+# group id, fragment index, fragment count and fragment data length.
+FRAGMENT_HEADER = 'HBBH'
+MAX_FRAGMENT_COUNT = 255
+
+def split_message(message_bytes, fragment_size):
+    '''
+    Returns message_bytes split into chunks of at most fragment_size bytes.
+    '''
+    return [message_bytes[offset:offset+fragment_size]
+        for offset in range(0, len(message_bytes), fragment_size)]
+
+class Fragment(object):
+    '''
+    A parsed fragment of a larger message. The transport attributes are
+    set by the Connection in the same way as for a parsed message.
+    '''
+    __slots__ = ['group_id', 'index', 'count', 'data', 'message_id',
+                 'sequence_number', 'is_ordered', 'is_reliable', 'channel']
+
+    def __init__(self, group_id, index, count, data):
+        self.group_id = group_id
+        self.index = index
+        self.count = count
+        self.data = data
+        self.message_id = 0
+        self.sequence_number = 0
+        self.is_ordered = False
+        self.is_reliable = True
+        self.channel = 0
+
+class _PartialMessage(object):
+    __slots__ = ['chunks', 'received', 'byte_count', 'timestamp']
+
+    def __init__(self, count, byte_count, timestamp):
+        self.chunks = [None] * count
+        self.received = 0
+        self.byte_count = byte_count
+        self.timestamp = timestamp
+
+class FragmentReassembler(object):
+    '''
+    Collects fragments by group id until every fragment of a message has
+    arrived. Received fragments are acknowledged, so a partial message is
+    never dropped to make room: a new message is only started if `accepts`
+    returns True, which it does while fewer than max_groups partial
+    messages are held and the bytes reserved for them stay within
+    max_bytes. Partial messages are only dropped when no fragment of
+    theirs has arrived for timeout seconds, which may be changed at any
+    time.
+    '''
+    def __init__(self, max_groups, max_bytes, timeout):
+        self._max_groups = max_groups
+        self._max_bytes = max_bytes
+        self.timeout = timeout
+        self._partial = {}
+        self._byte_count = 0
+        self.dropped_count = 0
+
+    def __len__(self):
+        return len(self._partial)
+
+    @property
+    def byte_count(self):
+        '''The number of bytes reserved for partial messages.'''
+        return self._byte_count
+
+    def accepts(self, fragment, now):
+        '''
+        Returns True if fragment can be added without dropping a partial
+        message. A fragment that isn't accepted must not be acknowledged,
+        so that it is resent.
+        '''
+        self._expire(now)
+        partial = self._partial.get(fragment.group_id)
+        if (fragment.count == 1 or
+          (partial is not None and len(partial.chunks) == fragment.count)):
+            return True
+        if not self._partial:
+            # Any one message can be reassembled, whatever the limits.
+            return True
+        if fragment.index == fragment.count - 1:
+            # Only the other fragments give the size of the message.
+            return False
+        return (len(self._partial) < self._max_groups and
+            self._byte_count + self._reserved_bytes(fragment) <=
+            self._max_bytes)
+
+    def add(self, fragment, now):
+        '''
+        Add a fragment. Returns the reassembled message bytes once the
+        last fragment of a message arrives, otherwise None.
+        '''
+        self._expire(now)
+
+        if fragment.index >= fragment.count:
+            return None
+
+        partial = self._partial.get(fragment.group_id)
+        if partial is not None and len(partial.chunks) != fragment.count:
+            # A stale group whose id has been reused.
+            self._drop(fragment.group_id)
+            partial = None
+
+        if partial is None:
+            if fragment.count == 1:
+                return fragment.data
+            partial = _PartialMessage(
+                fragment.count, self._reserved_bytes(fragment), now)
+            self._partial[fragment.group_id] = partial
+            self._byte_count += partial.byte_count
+
+        partial.timestamp = now
+        if partial.chunks[fragment.index] is not None:
+            return None
+
+        partial.chunks[fragment.index] = fragment.data
+        partial.received += 1
+
+        if partial.received == len(partial.chunks):
+            del self._partial[fragment.group_id]
+            self._byte_count -= partial.byte_count
+            return b''.join(partial.chunks)
+        return None
+
+    def _reserved_bytes(self, fragment):
+        # Every fragment but the last is the same size.
+        return fragment.count * len(fragment.data)
+
+    def _drop(self, group_id):
+        partial = self._partial.pop(group_id)
+        self._byte_count -= partial.byte_count
+        self.dropped_count += 1
+
+    def _expire(self, now):
+        expired = [group_id for group_id, partial in self._partial.items()
+            if partial.timestamp + self.timeout < now]
+        for group_id in expired:
+            self._drop(group_id)
@@ -0,0 +1,133 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+'''
+The stateless connection handshake. A server answers a ConnectRequest
+from an unknown address with a ConnectChallenge carrying a cookie, an
+HMAC of the client address and the current time period. The server only
+creates a Peer once a ConnectRequest echoes a valid cookie back, so
+datagrams from spoofed or junk addresses allocate nothing.
+
+The ConnectRequest cookie field is a fixed size string, so a request is
+never smaller than the challenge sent in reply to it.
+'''
+
+__docformat__ = 'restructuredtext'
+
+import os
+import hmac
+import hashlib
+import struct
+from collections import OrderedDict
+from legume.exceptions import LegumeError
+from legume.bytebuffer import ByteBuffer, compile_struct
+from legume.connection import Connection
+from legume.fragments import FRAGMENT_HEADER
+from legume import messages
+
+COOKIE_LENGTH = 32
+
+_packet_header = compile_struct(Connection.PACKET_HEADER)
+_message_transport_header = compile_struct(Connection.MESSAGE_TRANSPORT_HEADER)
+_fragment_header = compile_struct(FRAGMENT_HEADER)
+_FRAGMENT_FLAG = 1 << 2
+
+class ConnectCookies(object):
+    '''
+    Creates and validates connection cookies. A cookie is valid for
+    between lifetime and twice lifetime seconds. The secret is random
+    unless given, so cookies don't survive a server restart.
+    '''
+    def __init__(self, secret=None, lifetime=10.0):
+        if secret is None:
+            secret = os.urandom(32)
+        self._secret = secret
+        self._lifetime = lifetime
+
+    def _cookie(self, address, period):
+        text = ('%s:%s:%d' % (address[0], address[1], period)).encode('utf-8')
+        digest = hmac.new(self._secret, text, hashlib.sha256).hexdigest()
+        return digest[:COOKIE_LENGTH]
+
+    def create(self, address, now):
+        '''
+        Returns the cookie for address at time now.
+        '''
+        return self._cookie(address, int(now // self._lifetime))
+
+    def validate(self, cookie, address, now):
+        '''
+        Returns True if cookie was created for address during the current
+        or previous time period.
+        '''
+        if len(cookie) != COOKIE_LENGTH:
+            return False
+        period = int(now // self._lifetime)
+        return (hmac.compare_digest(cookie, self._cookie(address, period)) or
+            hmac.compare_digest(cookie, self._cookie(address, period - 1)))
+
+class AttemptLimiter(object):
+    '''
+    Limits connection attempts from each host to rate per second, with
+    bursts of up to burst attempts. At most max_hosts hosts are tracked,
+    the least recently seen host is forgotten to make room.
+    '''
+    def __init__(self, rate=2.0, burst=5, max_hosts=4096):
+        self._rate = rate
+        self._burst = burst
+        self._max_hosts = max_hosts
+        self._hosts = OrderedDict()
+
+    def allow(self, host, now):
+        '''
+        Returns True, and counts the attempt, if host may attempt to
+        connect at time now.
+        '''
+        tokens, timestamp = self._hosts.pop(host, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - timestamp) * self._rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._hosts[host] = (tokens, now)
+        if len(self._hosts) > self._max_hosts:
+            self._hosts.popitem(last=False)
+        return allowed
+
+def read_connect_request(packet_bytes, message_factory):
+    '''
+    Returns the ConnectRequest in a raw packet, or None if the packet
+    doesn't hold one or can't be parsed.
+    '''
+    try:
+        byte_buffer = ByteBuffer(packet_bytes)
+        byte_buffer.read_compiled_struct(_packet_header)
+        while not byte_buffer.is_empty():
+            message_flags = byte_buffer.read_compiled_struct(
+                _message_transport_header)[2]
+            if message_flags & _FRAGMENT_FLAG:
+                length = byte_buffer.read_compiled_struct(_fragment_header)[3]
+                byte_buffer.read_bytes(length)
+                continue
+            message_type_id = \
+                messages.BaseMessage.read_header_from_byte_buffer(byte_buffer)[0]
+            message = message_factory.get_by_id(message_type_id)()
+            message.read_from_byte_buffer(byte_buffer)
+            if isinstance(message, messages.ConnectRequest):
+                return message
+    except (LegumeError, struct.error, UnicodeDecodeError):
+        pass
+    return None
+
+def challenge_packet(cookie):
+    '''
+    Returns a packet holding a ConnectChallenge with cookie. The packet
+    and message are sent outside of a connection, with a packet sequence
+    number and message id of 0, so they are not acked or checked for
+    duplicates.
+    '''
+    challenge = messages.ConnectChallenge()
+    challenge.cookie.value = cookie
+    return (_packet_header.pack(0, 0, 0) +
+        _message_transport_header.pack(0, 0, 0) +
+        challenge.get_packet_bytes())
@@ -63,9 +63,32 @@ from legume.netshared import MessageError, PROTOCOL_VERSION
 BASE_MESSAGETYPEID_SYSTEM = 1
 BASE_MESSAGETYPEID_USER = 20
 
+# struct format characters for the fixed size value types. 'string' values
+# are fixed size but the format depends upon max_length, 'varstring' values
+# are length prefixed.
+VALUE_FORMATS = {
+    'int':'i',
+    'short':'H',
+    'float':'d',
+    'bool':'b',
+    'uchar':'B'
+}
+
 def isValidIdentifier(identifier):
     return not (' ' in identifier or identifier[0] not in string.ascii_letters)
 
+def split_value_type(mvtype):
+    '''
+    Split a MessageValues type name into a (typename, max_length) tuple, eg
+    'string 32' becomes ('string', '32') and 'int' becomes ('int', None).
+    '''
+    if mvtype[:6] == 'string':
+        valuetype, param = mvtype.split(' ')
+    else:
+        valuetype = mvtype
+        param = None
+    return valuetype, param
+
 class MessageValue(object):
     VALID_TYPE_NAMES = ['int', 'string', 'float', 'bool',
                         'uchar', 'char', 'short', 'varstring']
@@ -188,7 +211,7 @@ class MessageValue(object):
 
         elif self.typename == 'varstring':
             length = byteBuffer.read_struct('H')[0]
-            self._value = byteBuffer.read_struct(str(length)+'s')[0].decode('utf-8')
+            self._value = byteBuffer.read_bytes(length).decode('utf-8')
 
         elif self.typename == 'uchar':
             self._value = byteBuffer.read_struct('B')[0]
@@ -223,19 +246,34 @@ class BaseMessage(object):
                 self._add_value(value)
         elif self.MessageValues is not None:
             for mvname, mvtype in self.MessageValues.items():
-                if mvtype[:6] == 'string':
-                    valuetype, param = mvtype.split(' ')
-                else:
-                    valuetype = mvtype
-                    param = None
+                valuetype, param = split_value_type(mvtype)
                 new_value = MessageValue(mvname, valuetype, None, param, self)
                 self._add_value(new_value)
 
+        # Only messages built from the class MessageValues share the
+        # class codec, values passed to the constructor may differ
+        # per instance.
+        if len(values) == 0:
+            self._codec = self.get_codec()
+
         self.set_message_values_to_defaults()
 
+    @classmethod
+    def get_codec(cls):
+        '''
+        Returns the `MessageCodec` for this message class, building it
+        on first use.
+        '''
+        codec = cls.__dict__.get('_message_codec')
+        if codec is None:
+            codec = MessageCodec(cls)
+            cls._message_codec = codec
+        return codec
+
     def _add_value(self, value):
         self.value_names.append(value.name)
         self.__dict__[value.name] = value
+        self._codec = None
 
     def get_header_format(self):
         '''
@@ -288,6 +326,8 @@ class BaseMessage(object):
         Returns a string containing the header and data. This
         string can be passed to .loadFromString(...).
         '''
+        if self._codec is not None:
+            return self._codec.encode(self)
 
         message_values = self.get_message_values()
         
@@ -325,16 +365,145 @@ class BaseMessage(object):
         '''
         Reconstitute the packet from a ByteBuffer instance
         '''
+        if self._codec is not None:
+            self._codec.decode(self, byteBuffer)
+            return
+
         for name in self.value_names:
             self.__dict__[name].read_from_byte_buffer(byteBuffer)
 
+class MessageCodec(object):
+    '''
+    Encodes and decodes the values of one message class. The struct
+    formats are compiled once from the class MessageValues, so a message
+    made up of fixed size values is packed or unpacked with a single
+    struct call. Varstrings split the values into runs of fixed size
+    values with a length prefixed string between each run.
+    '''
+    def __init__(self, message_class):
+        self.message_type_id = message_class.MessageTypeID
+        self.value_names = []
+
+        # Each step is either a (struct, names, string indexes) run of
+        # fixed size values or a varstring value name.
+        self._steps = []
+
+        run_format = []
+        run_names = []
+        run_strings = []
+
+        if message_class.MessageValues is not None:
+            for mvname, mvtype in message_class.MessageValues.items():
+                valuetype, param = split_value_type(mvtype)
+                self.value_names.append(mvname)
+                if valuetype == 'varstring':
+                    self._add_run(run_format, run_names, run_strings)
+                    run_format, run_names, run_strings = [], [], []
+                    self._steps.append(mvname)
+                    continue
+                if valuetype == 'string':
+                    run_strings.append(len(run_names))
+                    run_format.append(str(int(param))+'s')
+                elif valuetype in VALUE_FORMATS:
+                    run_format.append(VALUE_FORMATS[valuetype])
+                else:
+                    raise MessageError(
+                        'Cant get format string for type "%s"' % valuetype)
+                run_names.append(mvname)
+        self._add_run(run_format, run_names, run_strings)
+
+        self.is_fixed_size = all(
+            not isinstance(step, str) for step in self._steps)
+
+    def _add_run(self, run_format, run_names, run_strings):
+        # The message header is packed along with the first run of values.
+        if not self._steps:
+            self._header_struct = struct.Struct(
+                '!'+BaseMessage.HEADER_FORMAT+''.join(run_format))
+            self._header_in_first_run = len(run_names) > 0
+        if run_names:
+            self._steps.append((
+                struct.Struct('!'+''.join(run_format)),
+                tuple(run_names),
+                tuple(run_strings)))
+
+    @staticmethod
+    def _get_values(message, names, strings):
+        try:
+            values = [message.__dict__[name]._value for name in names]
+        except AttributeError:
+            raise MessageError(
+                'Overwritten message value! Use msgval.value = xyz')
+        for index in strings:
+            if type(values[index]) == str:
+                values[index] = values[index].encode('utf-8')
+        return values
+
+    def encode(self, message):
+        '''
+        Returns the header and value bytes for a message instance.
+        '''
+        steps = self._steps
+        if self._header_in_first_run:
+            compiled, names, strings = steps[0]
+            values = self._get_values(message, names, strings)
+            first = self._header_struct.pack(message._message_type_id, *values)
+            if len(steps) == 1:
+                return first
+            parts = [first]
+            steps = steps[1:]
+        else:
+            parts = [self._header_struct.pack(message._message_type_id)]
+
+        for step in steps:
+            if isinstance(step, str):
+                try:
+                    value = message.__dict__[step]._value
+                except AttributeError:
+                    raise MessageError(
+                        'Overwritten message value! Use msgval.value = xyz')
+                if type(value) == str:
+                    value = value.encode('utf-8')
+                parts.append(_VARSTRING_LENGTH.pack(len(value)))
+                parts.append(value)
+            else:
+                compiled, names, strings = step
+                parts.append(compiled.pack(
+                    *self._get_values(message, names, strings)))
+
+        return b''.join(parts)
+
+    def decode(self, message, byteBuffer):
+        '''
+        Read the values of a message instance from a ByteBuffer. The
+        message header must have already been read from the buffer.
+        '''
+        message_values = message.__dict__
+        for step in self._steps:
+            if isinstance(step, str):
+                length = byteBuffer.read_compiled_struct(_VARSTRING_LENGTH)[0]
+                message_values[step]._value = \
+                    byteBuffer.read_bytes(length).decode('utf-8')
+            else:
+                compiled, names, strings = step
+                values = byteBuffer.read_compiled_struct(compiled)
+                for name, value in zip(names, values):
+                    message_values[name]._value = value
+                for index in strings:
+                    message_values[names[index]]._value = \
+                        values[index].replace(b'\0', b'').decode('utf-8')
+
+_VARSTRING_LENGTH = struct.Struct('!H')
+
 class ConnectRequest(BaseMessage):
     '''
-    A connection request packet - sent by a client to the server.
+    A connection request packet - sent by a client to the server. The
+    cookie is empty until the server has answered with a ConnectChallenge.
     '''
     MessageTypeID = BASE_MESSAGETYPEID_SYSTEM+1
     MessageValues = {
-        'protocol':'uchar'
+        'protocol':'uchar',
+        'cookie':'string 32'
     }
 
     def load_default_values(self):
@@ -385,7 +554,8 @@ class Disconnected(BaseMessage):
 class MessageAck(BaseMessage):
     '''
     Sent by either a client or server to acknowledge receipt of an
-    in-order or reliable message.
+    in-order or reliable message. Acks are normally carried in the packet
+    header, this message is still processed if received.
     '''
     MessageTypeID = BASE_MESSAGETYPEID_SYSTEM+7
     MessageValues = {
@@ -404,6 +574,16 @@ class Pong(BaseMessage):
         'id':'short'
     }
 
+class ConnectChallenge(BaseMessage):
+    '''
+    Sent by the server in reply to a ConnectRequest without a valid cookie.
+    The client sends its ConnectRequest again with this cookie.
+    '''
+    MessageTypeID = BASE_MESSAGETYPEID_SYSTEM+10
+    MessageValues = {
+        'cookie':'string 32'
+    }
+
 class MessageFactoryItem(object):
     def __init__(self, message_name, message_type_id, message_factory):
         self.message_name = message_name
@@ -433,6 +613,8 @@ class MessageFactory(object):
                     message_class.__name__,
                     self._factories_by_id[
                       message_class.MessageTypeID].message_name))
+            # Compile the codec now rather than on the first send.
+            message_class.get_codec()
             messsage_factory_item = MessageFactoryItem(
                 message_class.__name__,
                 message_class.MessageTypeID,
@@ -480,7 +662,8 @@ messages = {
     'Disconnected':Disconnected,
     'MessageAck':MessageAck,
     'Pong':Pong,
-    'Ping':Ping
+    'Ping':Ping,
+    'ConnectChallenge':ConnectChallenge
 }
 
 # The default global packet factory.
@@ -12,6 +12,26 @@ class Metrics(object):
         '''Round-trip latency in ms'''
         return 0
 
+    @property
+    def smoothed_rtt(self):
+        '''Smoothed round-trip time in ms.'''
+        return 0
+
+    @property
+    def rtt_variance(self):
+        '''Round-trip time variation in ms.'''
+        return 0
+
+    @property
+    def jitter(self):
+        '''Smoothed difference between consecutive round-trip samples in ms.'''
+        return 0
+
+    @property
+    def rto(self):
+        '''Current resend timeout for reliable messages in ms.'''
+        return 0
+
     @property
     def out_buffer_bytes(self):
         '''Count of bytes waiting to be transmitted on the wire.'''
@@ -7,11 +7,14 @@ __docformat__ = 'restructuredtext'
 
 import socket
 import errno
+import selectors
+from legume import timing as time
+from legume.datagrams import DatagramQueue
 from legume.exceptions import *
 
 USHRT_MAX = 65535
 DEFAULT_TIMEOUT = float(10) # default timeout in seconds
-PROTOCOL_VERSION = 4
+PROTOCOL_VERSION = 8
 
 def isValidPort(port):
     '''
@@ -27,13 +30,38 @@ class NetworkEndpoint(object):
     CONNECTING = 103
     CONNECTED = 104
 
+    # What a connection does with a send that would take its outgoing
+    # queue over max_queued_bytes or max_queued_messages.
+    BACKPRESSURE_DROP_UNRELIABLE = 200
+    BACKPRESSURE_REJECT = 201
+    BACKPRESSURE_DISCONNECT = 202
+
     MTU = 1400
 
+    # Default number of datagrams read by one do_read() call.
+    READ_BUDGET = 256
+    # Bytes of packets that may wait for the socket to become writable.
+    SEND_BACKLOG_LIMIT = 1024 * 1024
+
     def __init__(self, message_factory):
         self._state = self.DISCONNECTED
         self._socket = None
+        self._selector = None
+        self._selector_events = 0
+        self._datagrams = None
         self.message_factory = message_factory
         self._timeout = DEFAULT_TIMEOUT
+        self._max_send_rate = None
+        self._max_queued_bytes = None
+        self._max_queued_messages = None
+        self._backpressure_policy = self.BACKPRESSURE_DROP_UNRELIABLE
+        self._read_budget = self.READ_BUDGET
+        self._receive_buffer_size = None
+        self._send_buffer_size = None
+        # Datagrams are received into this buffer and passed on as
+        # memoryview slices of it, so nothing is allocated per packet.
+        self._receive_buffer = bytearray(self.MTU)
+        self._receive_view = memoryview(self._receive_buffer)
 
     def __del__(self):
         if self._socket is not None:
@@ -47,22 +75,211 @@ class NetworkEndpoint(object):
     def socket(self):
         return self._socket
 
+    @property
+    def max_send_rate(self):
+        '''
+        The maximum number of bytes per second sent on each connection, or
+        None if sending is only limited by congestion control.
+        '''
+        return self._max_send_rate
+
+    @max_send_rate.setter
+    def max_send_rate(self, value):
+        if value is not None and value <= 0:
+            raise ArgumentError('max_send_rate must be None or > 0')
+        self._max_send_rate = value
+
+    @property
+    def max_queued_bytes(self):
+        '''
+        The maximum number of bytes queued on each connection, including
+        reliable messages waiting for an ack, or None for no limit.
+        '''
+        return self._max_queued_bytes
+
+    @max_queued_bytes.setter
+    def max_queued_bytes(self, value):
+        if value is not None and value <= 0:
+            raise ArgumentError('max_queued_bytes must be None or > 0')
+        self._max_queued_bytes = value
+
+    @property
+    def max_queued_messages(self):
+        '''
+        The maximum number of messages queued on each connection, or None
+        for no limit.
+        '''
+        return self._max_queued_messages
+
+    @max_queued_messages.setter
+    def max_queued_messages(self, value):
+        if value is not None and value <= 0:
+            raise ArgumentError('max_queued_messages must be None or > 0')
+        self._max_queued_messages = value
+
+    @property
+    def backpressure_policy(self):
+        '''
+        What happens to a send that would exceed max_queued_bytes or
+        max_queued_messages. System messages, such as the handshake,
+        keep-alives and Disconnected, are always queued and only count
+        towards the limits. OnBackpressure is raised first, then:
+
+        * `BACKPRESSURE_DROP_UNRELIABLE` - The oldest unsent unreliable
+            messages are dropped to make room. If that isn't enough the
+            send is rejected.
+        * `BACKPRESSURE_REJECT` - The message is not queued and the send
+            returns 0.
+        * `BACKPRESSURE_DISCONNECT` - The message is not queued and the
+            connection errors with 'Outgoing queue is full' at the next
+            update.
+        '''
+        return self._backpressure_policy
+
+    @backpressure_policy.setter
+    def backpressure_policy(self, value):
+        if value not in [self.BACKPRESSURE_DROP_UNRELIABLE,
+          self.BACKPRESSURE_REJECT, self.BACKPRESSURE_DISCONNECT]:
+            raise ArgumentError('Invalid backpressure_policy %s' % value)
+        self._backpressure_policy = value
+
+    @property
+    def read_budget(self):
+        '''
+        The maximum number of datagrams read from the socket by one call to
+        update(). Datagrams beyond the budget are left for the next call so
+        a flood of packets cannot stall the rest of the update.
+        '''
+        return self._read_budget
+
+    @read_budget.setter
+    def read_budget(self, value):
+        if value < 1:
+            raise ArgumentError('read_budget must be >= 1')
+        self._read_budget = value
+
+    @property
+    def receive_buffer_size(self):
+        '''
+        The SO_RCVBUF size requested for the socket in bytes, or None to
+        use the operating system default.
+        '''
+        return self._receive_buffer_size
+
+    @receive_buffer_size.setter
+    def receive_buffer_size(self, value):
+        if value is not None and value <= 0:
+            raise ArgumentError('receive_buffer_size must be None or > 0')
+        self._receive_buffer_size = value
+        self._configure_socket_buffers()
+
+    @property
+    def send_buffer_size(self):
+        '''
+        The SO_SNDBUF size requested for the socket in bytes, or None to
+        use the operating system default.
+        '''
+        return self._send_buffer_size
+
+    @send_buffer_size.setter
+    def send_buffer_size(self, value):
+        if value is not None and value <= 0:
+            raise ArgumentError('send_buffer_size must be None or > 0')
+        self._send_buffer_size = value
+        self._configure_socket_buffers()
+
+    @property
+    def send_backlog(self):
+        '''
+        The number of packets waiting for the socket to become writable.
+        '''
+        return len(self._datagrams) if self._datagrams is not None else 0
+
+    @property
+    def send_backlog_bytes(self):
+        '''The size in bytes of the packets in the send backlog.'''
+        return self._datagrams.byte_count if self._datagrams is not None else 0
+
+    @property
+    def blocked_send_count(self):
+        '''
+        The number of times sending a packet would have blocked. The
+        packet is kept and sent when the socket becomes writable.
+        '''
+        return self._datagrams.blocked_count if self._datagrams is not None else 0
+
+    @property
+    def dropped_packet_count(self):
+        '''
+        The number of packets dropped because the send backlog was full or
+        the socket refused them.
+        '''
+        return self._datagrams.dropped_count if self._datagrams is not None else 0
+
     def setTimeout(self, timeout):
         self._timeout = float(timeout)
 
     def _create_socket(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.setblocking(0)
+        self._configure_socket_buffers()
+        self._datagrams = DatagramQueue(self._socket, self.SEND_BACKLOG_LIMIT)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._selector_events = selectors.EVENT_READ
         return self._socket
 
+    def _configure_socket_buffers(self):
+        if self._socket is None:
+            return
+        if self._receive_buffer_size is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                self._receive_buffer_size)
+        if self._send_buffer_size is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                self._send_buffer_size)
+
+    def _send_datagram(self, buffers, address):
+        '''
+        Queue a packet, given as a list of buffers, to be sent by
+        _flush_datagrams at the end of the update.
+        '''
+        self._datagrams.append(buffers, address)
+
+    def _flush_datagrams(self):
+        if self._datagrams is not None:
+            self._datagrams.flush()
+
+    def _send_blocked(self):
+        '''
+        Returns True if packets are waiting for the socket to become
+        writable, or if the backlog has no room for another packet.
+        Connections don't create packets while this is True, so their
+        messages stay queued rather than piling up or being dropped here.
+        '''
+        datagrams = self._datagrams
+        return datagrams is not None and (
+            datagrams.blocked or not datagrams.has_room(self.MTU))
+
     def _shutdown_socket(self):
+        if self._datagrams is not None:
+            self._datagrams.flush()
+            self._datagrams = None
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
         self._socket.close()
 
     def _connect_socket(self, addr):
         self._socket.bind(('', 0))
         pass
 
-    def _bind_socket(self, addr):
+    def _bind_socket(self, addr, reuse_port=False):
+        if reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise NetworkEndpointError(
+                    'SO_REUSEPORT is not supported on this platform')
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind(addr)
 
     def is_active(self):
@@ -70,12 +287,19 @@ class NetworkEndpoint(object):
             self.LISTENING, self.CONNECTING, self.CONNECTED]
 
     def do_read(self, callback):
+        '''
+        Read up to read_budget datagrams, calling callback(data, addr) for
+        each. data is a memoryview of a buffer that is reused for the next
+        datagram, so callback must copy anything it keeps.
+        '''
         if self._state in [self.LISTENING, self.CONNECTED, self.CONNECTING]:
             if self._socket:
+                view = self._receive_view
                 try:
-                    while True:
-                        data, addr = self._socket.recvfrom(self.MTU, 0)
-                        callback(data, addr)
+                    for x in range(self._read_budget):
+                        length, addr = self._socket.recvfrom_into(
+                            self._receive_buffer)
+                        callback(view[:length], addr)
                 except socket.error as e:
                     try:
                         errornum = e.errno
@@ -86,6 +310,60 @@ class NetworkEndpoint(object):
             else:
                 raise NetworkEndpointError('Endpoint is not active')
 
+    def next_deadline(self):
+        '''
+        Returns the time, from legume.timing.time(), at which update() next
+        has work to do if no packets arrive, or None if there is nothing
+        scheduled. Subclasses return the earliest ping, keep-alive, resend
+        or timeout deadline of their connections.
+        '''
+        return None
+
+    def poll(self, timeout=None):
+        '''
+        Wait until a packet arrives, the next deadline is reached or timeout
+        seconds have passed, then call update(). A timeout of None waits
+        without a limit. Returns True if a packet arrived::
+
+            client.connect(('localhost', 9000))
+            while client.state != client.ERRORED:
+                client.poll(0.1)
+        '''
+        if self._selector is None:
+            raise NetworkEndpointError('Endpoint is not active')
+
+        wait = timeout
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until_deadline = max(0.0, deadline - time.time())
+            if wait is None or until_deadline < wait:
+                wait = until_deadline
+
+        # Wait for the socket to become writable while packets are backed
+        # up, so they are sent as soon as possible.
+        events = selectors.EVENT_READ
+        if self.send_backlog:
+            events |= selectors.EVENT_WRITE
+        if events != self._selector_events:
+            self._selector.modify(self._socket, events)
+            self._selector_events = events
+
+        readable = any(mask & selectors.EVENT_READ
+            for key, mask in self._selector.select(wait))
+        self.update()
+        return readable
+
+    def run(self, until=None, timeout=None):
+        '''
+        Call poll() until the endpoint is no longer active or until(), if
+        given, returns True. until is checked at least every timeout
+        seconds if timeout is not None.
+        '''
+        while self.is_active():
+            if until is not None and until():
+                break
+            self.poll(timeout)
+
     def get_state(self):
         return self._state
     state = property(get_state)
@@ -0,0 +1,32 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+from collections import deque
+
+class RecentIdWindow(object):
+    '''
+    Remembers the most recently added message ids. Membership tests
+    are a set lookup and once the window is full each added id evicts
+    the oldest, so memory use is fixed by the window size.
+    '''
+    def __init__(self, size):
+        self._size = size
+        self._ids = deque()
+        self._lookup = set()
+
+    def __contains__(self, message_id):
+        return message_id in self._lookup
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, message_id):
+        if message_id in self._lookup:
+            return
+        if len(self._ids) >= self._size:
+            self._lookup.discard(self._ids.popleft())
+        self._ids.append(message_id)
+        self._lookup.add(message_id)
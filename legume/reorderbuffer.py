@@ -0,0 +1,66 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+# In-order sequence numbers run from 1 to SEQUENCE_NUMBER_MAX and then wrap
+# back to 1. A sequence number of 0 marks a message that is not in-order.
+SEQUENCE_NUMBER_MAX = 65535
+
+def next_sequence_number(sequence_number):
+    '''
+    Returns the sequence number that follows sequence_number.
+    '''
+    return sequence_number % SEQUENCE_NUMBER_MAX + 1
+
+def sequence_distance(sequence_number, from_sequence_number):
+    '''
+    Returns how far sequence_number is ahead of from_sequence_number,
+    allowing for wrap around. The result is negative if sequence_number
+    is behind from_sequence_number.
+    '''
+    distance = (sequence_number - from_sequence_number) % SEQUENCE_NUMBER_MAX
+    if distance > SEQUENCE_NUMBER_MAX // 2:
+        distance -= SEQUENCE_NUMBER_MAX
+    return distance
+
+class ReorderBuffer(object):
+    '''
+    Holds in-order messages that arrived ahead of the next expected sequence
+    number, keyed by sequence number. Adding the message that fills a gap
+    releases it along with every held message that follows on from it.
+    '''
+    def __init__(self):
+        self._next_sequence_number = 1
+        self._held = {}
+
+    def __len__(self):
+        return len(self._held)
+
+    @property
+    def next_sequence_number(self):
+        '''The sequence number of the next message to be released.'''
+        return self._next_sequence_number
+
+    def add(self, message):
+        '''
+        Add an in-order message. Returns a list of the messages that can now
+        be read, in sequence order. Messages that are behind the next expected
+        sequence number or already held are discarded.
+        '''
+        sequence_number = message.sequence_number
+        if sequence_number != self._next_sequence_number:
+            if (sequence_distance(sequence_number, self._next_sequence_number) > 0
+              and sequence_number not in self._held):
+                self._held[sequence_number] = message
+            return []
+
+        released = [message]
+        sequence_number = next_sequence_number(sequence_number)
+        held = self._held
+        while sequence_number in held:
+            released.append(held.pop(sequence_number))
+            sequence_number = next_sequence_number(sequence_number)
+        self._next_sequence_number = sequence_number
+        return released
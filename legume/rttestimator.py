@@ -0,0 +1,84 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+class RttEstimator(object):
+    '''
+    Estimates the round trip time of a connection and the retransmission
+    timeout (RTO) derived from it, as described in RFC 6298. All times are
+    in seconds.
+
+    The RTO doubles each time `backoff` is called after a retransmission,
+    up to maximum_rto, and returns to the estimate when the next sample is
+    added. Under Karn's rule, round trips that can't be matched to a single
+    transmission must not be added as samples.
+    '''
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+    K = 4
+    JITTER_GAIN = 1 / 16.0
+
+    def __init__(self, initial_rto=0.3, minimum_rto=0.01, maximum_rto=2.0):
+        self._minimum_rto = minimum_rto
+        self._maximum_rto = maximum_rto
+        self._srtt = None
+        self._rttvar = 0.0
+        self._jitter = 0.0
+        self._last_sample = None
+        self._base_rto = initial_rto
+        self._backoff = 1
+
+    def has_estimate(self):
+        return self._srtt is not None
+
+    def add_sample(self, rtt):
+        '''
+        Add a measured round trip time. Negative samples are ignored.
+        '''
+        if rtt < 0:
+            return
+
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2.0
+        else:
+            self._rttvar += self.BETA * (abs(self._srtt - rtt) - self._rttvar)
+            self._srtt += self.ALPHA * (rtt - self._srtt)
+
+        if self._last_sample is not None:
+            self._jitter += self.JITTER_GAIN * (
+                abs(rtt - self._last_sample) - self._jitter)
+        self._last_sample = rtt
+
+        self._base_rto = min(self._maximum_rto, max(self._minimum_rto,
+            self._srtt + self.K * self._rttvar))
+        self._backoff = 1
+
+    def backoff(self):
+        '''
+        Double the RTO after a retransmission timeout.
+        '''
+        if self._base_rto * self._backoff < self._maximum_rto:
+            self._backoff *= 2
+
+    @property
+    def srtt(self):
+        '''Smoothed round trip time, 0 until a sample is added.'''
+        return self._srtt or 0.0
+
+    @property
+    def rttvar(self):
+        '''Round trip time variation.'''
+        return self._rttvar
+
+    @property
+    def jitter(self):
+        '''Smoothed difference between consecutive round trip samples.'''
+        return self._jitter
+
+    @property
+    def rto(self):
+        '''Current retransmission timeout, including any backoff.'''
+        return min(self._maximum_rto, self._base_rto * self._backoff)
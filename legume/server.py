@@ -5,8 +5,13 @@
 __docformat__ = 'restructuredtext'
 
 import logging
+from legume import timing as time
 from legume import netshared
+from legume.timers import TimerQueue
+from legume.handshake import ConnectCookies, AttemptLimiter, \
+    read_connect_request, challenge_packet
 from legume import messages
+from legume.dispatch import MessageDispatcher
 from legume.nevent import Event, NEventError
 from legume.servicelocator import Service
 
@@ -32,12 +37,26 @@ class Server(netshared.NetworkEndpoint):
         self._dead_peers = [] # List of peers (by address) to be removed
         self._in_update = False
 
+        # Peers are only updated when a deadline of theirs is due or
+        # when they have been woken by inbound packets or new messages.
+        self._timers = TimerQueue()
+        self._woken_peers = set()
+        # Peers with packets to send while the socket would block. They
+        # are woken once the send backlog has drained.
+        self._write_blocked_peers = set()
+
         self._OnConnectRequest = Event()
         self._OnDisconnect = Event()
         self._OnError = Event()
         self._OnMessage = Event()
+        self._OnBackpressure = Event()
+        self._dispatcher = MessageDispatcher()
         self._accept_new_connections = False
 
+        # Stateless handshake for addresses without a Peer.
+        self._connect_cookies = ConnectCookies()
+        self._connect_attempts = AttemptLimiter()
+
     # ------------- Properties -------------
 
     @property
@@ -82,7 +101,24 @@ class Server(netshared.NetworkEndpoint):
         '''Obtain a ServerPeer instance by specifying the peer's address'''
         return self._peers[peer_address]
 
-    def listen(self, address):
+    def on(self, message_class, handler):
+        '''Call handler(peer, message) for each message of message_class
+        received from any peer, instead of raising OnMessage for it::
+
+            def on_chat(peer, message):
+                server.send_message_to_all(message)
+
+            server.on(ChatMessage, on_chat)
+
+        Handlers added with Peer.on take precedence for that peer.
+        '''
+        self._dispatcher.on(message_class, handler)
+
+    def off(self, message_class, handler):
+        '''Remove a handler added with `on`.'''
+        self._dispatcher.off(message_class, handler)
+
+    def listen(self, address, reuse_port=False):
         '''Begin listening for incoming connections.
         address is a tuple of the format (hostname, port)
         This method change the class state to LISTENING::
@@ -90,12 +126,15 @@ class Server(netshared.NetworkEndpoint):
             # Begin listening on port 4000 on all IP interfaces
             server = legume.Server()
             server.listen(('', 4000))
+
+        With reuse_port the socket is bound with SO_REUSEPORT so several
+        processes can listen on the same port, see `legume.sharding`.
         '''
         if self.is_active():
             raise netshared.ServerError(
                 'Server cannot listen whilst in a LISTENING state')
         self._create_socket()
-        self._bind_socket(address)
+        self._bind_socket(address, reuse_port)
         self._address = address
         self._state = self.LISTENING
         self._accept_new_connections = True
@@ -111,35 +150,101 @@ class Server(netshared.NetworkEndpoint):
                 server.update()
                 # Other update tasks here..
                 time.sleep(0.001)
-        '''
-        self.do_read(self._on_socket_data)
 
-        for peer in self._peers.values():
-            peer.update()
+        Alternatively call poll(), which waits until there is work to do
+        before calling update()::
 
-            if peer._pending_disconnect and not peer.has_packets_to_send():
-                self._dead_peers.append(peer)
+            while True:
+                server.poll(0.05)
+                # Other update tasks here..
+        '''
+        self._flush_datagrams()
+        if self._write_blocked_peers and not self._send_blocked():
+            self._woken_peers |= self._write_blocked_peers
+            self._write_blocked_peers.clear()
 
-        self._removePeers()
+        self.do_read(self._on_socket_data)
+        self._woken_peers.update(self._timers.pop_due(time.time()))
+
+        # Peers woken by another peer's update, such as the recipients of
+        # a broadcast, are updated in the same call. A peer is updated at
+        # most once per call; if woken again it waits for the next call.
+        updated_peers = set()
+        while True:
+            peers = self._woken_peers - updated_peers
+            if not peers:
+                break
+            self._woken_peers -= peers
+            updated_peers |= peers
+            for peer in peers:
+                self._update_peer(peer)
 
-    def send_message_to_all(self, message):
-        '''Send a non-reliable packet to all connected peers.
-        packet is an instance of a legume.message.BaseMessage subclass::
+        self._removePeers()
+        self._flush_datagrams()
+
+    def next_deadline(self):
+        '''The earliest deadline of any connected peer.'''
+        if self._woken_peers or self._dead_peers:
+            return time.time()
+        if self._write_blocked_peers and not self._send_blocked():
+            return time.time()
+        return self._timers.next_deadline()
+
+    def send_message_to_all(self, message, ordered=False, reliable=False,
+                            channel=0, predicate=None):
+        '''Send a packet to all connected peers, non-reliable unless
+        ordered or reliable is set. Ordered packets are ordered within their
+        channel. packet is an instance of a legume.message.BaseMessage
+        subclass::
 
             message = ExampleMessage()
             message.chat_message.value = "Hello!"
             message.sender.value = "@X3"
-            server.send_message_to_all(message)
+            server.send_message_to_all(message, ordered=True, channel=1)
+
+        The message is encoded once and the bytes are shared by every
+        peer. If predicate is given the message is only sent to the peers
+        for which predicate(peer) is true.
         '''
-        for peer in self._peers.values():
-            peer.send_message(message)
+        self.send_encoded_message_to_all(message.get_packet_bytes(),
+            ordered, reliable, channel, predicate)
 
-    def send_reliable_message_to_all(self, message):
-        '''Send a reliable message to all connected peers. message is an
-        instance of a legume.message.BaseMessage subclass.
+    def send_encoded_message_to_all(self, message_bytes, ordered=False,
+                                    reliable=False, channel=0, predicate=None):
+        '''Send a message encoded by BaseMessage.get_packet_bytes to all
+        connected peers. Takes the same options as send_message_to_all.
         '''
         for peer in self._peers.values():
-            peer.send_reliable_message(message)
+            if predicate is None or predicate(peer):
+                peer.send_encoded_message(
+                    message_bytes, ordered, reliable, channel)
+
+    def send_latest_message_to_all(self, message, key, ttl=None,
+                                   predicate=None):
+        '''Send a latest value message to all connected peers, or to the
+        peers for which predicate(peer) is true. A message still queued for
+        a peer with the same class and key is replaced, so only the newest
+        value is sent::
+
+            update = BallUpdate()
+            update.ball_id.value = ball.id
+            update.x.value = ball.x
+            server.send_latest_message_to_all(update, ball.id, ttl=0.5)
+
+        If ttl is given the message is dropped unsent after ttl seconds.
+        '''
+        message_bytes = message.get_packet_bytes()
+        for peer in self._peers.values():
+            if predicate is None or predicate(peer):
+                peer.send_encoded_latest_message(
+                    message_bytes, message.MessageTypeID, key, ttl)
+
+    def send_reliable_message_to_all(self, message, predicate=None):
+        '''Send a reliable message to all connected peers, or to the peers
+        for which predicate(peer) is true. message is an instance of a
+        legume.message.BaseMessage subclass.
+        '''
+        self.send_message_to_all(message, reliable=True, predicate=predicate)
 
     # ------------- Private Methods -------------
     
@@ -152,6 +257,9 @@ class Server(netshared.NetworkEndpoint):
             return
             
         if not addr in self._peers:
+            if not self._check_connect_cookie(data, addr):
+                return
+
             new_peer = Service('Peer', {'parent':self, 'address':addr})
             self._peers[addr] = new_peer
 
@@ -159,12 +267,54 @@ class Server(netshared.NetworkEndpoint):
             new_peer.OnError += self._Peer_OnError
             new_peer.OnMessage += self._Peer_OnMessage
             new_peer.OnConnectRequest += self._Peer_OnConnectRequest
+            new_peer.OnBackpressure += self._Peer_OnBackpressure
 
         self._peers[addr].process_inbound_packet(data)
 
+    def _check_connect_cookie(self, data, addr):
+        '''
+        Returns True if data holds a ConnectRequest with a valid cookie for
+        addr. A ConnectRequest without one is answered with a
+        ConnectChallenge, unless addr has made too many attempts.
+        '''
+        request = read_connect_request(data, self.message_factory)
+        if request is None:
+            return False
+
+        now = time.time()
+        if self._connect_cookies.validate(request.cookie.value, addr, now):
+            return True
+
+        if self._connect_attempts.allow(addr[0], now):
+            cookie = self._connect_cookies.create(addr, now)
+            self._send_datagram([challenge_packet(cookie)], addr)
+        else:
+            self._log.info('Too many connection attempts from %s' % addr[0])
+        return False
+
+    def _wake_peer(self, peer):
+        '''
+        Called by a peer when it has work for the next update().
+        '''
+        self._woken_peers.add(peer)
+
+    def _update_peer(self, peer):
+        peer.update()
+
+        if peer._pending_disconnect and not peer.has_packets_to_send():
+            self._dead_peers.append(peer)
+        else:
+            self._timers.schedule(peer, peer.next_deadline())
+            if self._send_blocked() and peer.has_packets_to_send():
+                self._write_blocked_peers.add(peer)
+
     def _removePeers(self):
         for dead_peer in self._dead_peers:
-            del self._peers[dead_peer.address]
+            if self._peers.get(dead_peer.address) is dead_peer:
+                del self._peers[dead_peer.address]
+            self._timers.cancel(dead_peer)
+            self._woken_peers.discard(dead_peer)
+            self._write_blocked_peers.discard(dead_peer)
         self._dead_peers = []
 
     # ------------- Events -------------
@@ -209,6 +359,16 @@ class Server(netshared.NetworkEndpoint):
     OnDisconnect = property(
         _getOnDisconnect, _setOnDisconnect)
 
+    def _getOnBackpressure(self):
+        return self._OnBackpressure
+    def _setOnBackpressure(self, event):
+        if isinstance(event, Event):
+            self._OnBackpressure = event
+        else:
+            raise NEventError('Event must subclass nevent.Event')
+    OnBackpressure = property(
+        _getOnBackpressure, _setOnBackpressure)
+
     # ------------- Peer Event Handlers -------------
 
     def _Peer_OnConnectRequest(self, peer, event_args):
@@ -219,7 +379,11 @@ class Server(netshared.NetworkEndpoint):
         self.OnError(peer, error_string)
 
     def _Peer_OnMessage(self, peer, message):
-        self.OnMessage(peer, message)
+        if not self._dispatcher.dispatch(peer, message):
+            self.OnMessage(peer, message)
 
     def _Peer_OnDisconnect(self, peer, event_args):
-        self.OnDisconnect(peer, None)
\ No newline at end of file
+        self.OnDisconnect(peer, None)
+
+    def _Peer_OnBackpressure(self, peer, queued_bytes):
+        self.OnBackpressure(peer, queued_bytes)
\ No newline at end of file
@@ -8,6 +8,7 @@ import logging
 from legume import timing as time
 from legume import netshared
 from legume import metrics
+from legume.dispatch import MessageDispatcher
 from legume.servicelocator import Service
 from legume.nevent import Event
 
@@ -30,6 +31,8 @@ class Peer(metrics.Metrics):
         self.OnDisconnect = Event()
         self.OnError = Event()
         self.OnMessage = Event()
+        self.OnBackpressure = Event()
+        self._dispatcher = MessageDispatcher()
 
         self._connection = Service('Connection', {'parent':self})
 
@@ -37,6 +40,7 @@ class Peer(metrics.Metrics):
         self._connection.OnDisconnect += self._Connection_OnDisconnect
         self._connection.OnError += self._Connection_OnError
         self._connection.OnConnectRequest += self._Connection_OnConnectRequest
+        self._connection.OnBackpressure += self._Connection_OnBackpressure
 
     @property
     def address(self):
@@ -58,6 +62,22 @@ class Peer(metrics.Metrics):
     def latency(self):
         return self._connection.latency
 
+    @property
+    def smoothed_rtt(self):
+        return self._connection.smoothed_rtt
+
+    @property
+    def rtt_variance(self):
+        return self._connection.rtt_variance
+
+    @property
+    def jitter(self):
+        return self._connection.jitter
+
+    @property
+    def rto(self):
+        return self._connection.rto
+
     @property
     def message_factory(self):
         return self.parent.message_factory
@@ -74,6 +94,22 @@ class Peer(metrics.Metrics):
     def timeout(self):
         return self.parent.timeout
 
+    @property
+    def max_send_rate(self):
+        return self.parent.max_send_rate
+
+    @property
+    def max_queued_bytes(self):
+        return self.parent.max_queued_bytes
+
+    @property
+    def max_queued_messages(self):
+        return self.parent.max_queued_messages
+
+    @property
+    def backpressure_policy(self):
+        return self.parent.backpressure_policy
+
     @property
     def last_packet_sent_at(self):
         return self._connection.last_packet_sent_at
@@ -81,7 +117,7 @@ class Peer(metrics.Metrics):
     def _Connection_OnMessage(self, sender, event_args):
         if not self._connected:
             self._pending_disconnect = True
-        else:
+        elif not self._dispatcher.dispatch(self, event_args):
             self.OnMessage(self, event_args)
 
     def _Connection_OnConnectRequest(self, sender, event_args):
@@ -97,30 +133,107 @@ class Peer(metrics.Metrics):
     def _Connection_OnDisconnect(self, sender, event_args):
         self.OnDisconnect(self, sender)
 
+    def _Connection_OnBackpressure(self, sender, queued_bytes):
+        self.OnBackpressure(self, queued_bytes)
+
+    def on(self, message_class, handler):
+        '''
+        Call handler(peer, message) for each message of message_class
+        received from this peer. Messages handled here are not passed
+        on to the server's handlers or OnMessage.
+        '''
+        self._dispatcher.on(message_class, handler)
+
+    def off(self, message_class, handler):
+        '''
+        Remove a handler added with `on`.
+        '''
+        self._dispatcher.off(message_class, handler)
+
     def do_read(self, callback):
-        self.parent.do_read(callback)
+        # The server reads its socket once per update and passes each
+        # packet to the peer it came from with process_inbound_packet.
+        pass
+
+    def _send_datagram(self, buffers, address):
+        self.parent._send_datagram(buffers, address)
+
+    def _flush_datagrams(self):
+        self.parent._flush_datagrams()
+
+    def _send_blocked(self):
+        return self.parent._send_blocked()
 
     def process_inbound_packet(self, rawData):
         self._connection.process_inbound_packet(rawData)
+        self.parent._wake_peer(self)
+
+    def can_send(self, length):
+        '''
+        Returns True if a message of length encoded bytes can be queued
+        for this peer without exceeding the server's max_queued_bytes or
+        max_queued_messages.
+        '''
+        return not self._pending_disconnect and self._connection.can_send(length)
 
     def has_packets_to_send(self):
         return self._connection.has_outgoing_packets()
 
-    def send_message(self, packet):
+    def send_message(self, packet, ordered=False, reliable=False, channel=0):
         '''
         Adds a packet to the outgoing buffer to be sent to the client.
-        This does not set the in-order or reliable flags.
+        By default this does not set the in-order or reliable flags.
+        Ordered packets are ordered within their channel.
         packet is an instance of BasePacket.
         Returns the number of bytes added to the output buffer for
         sending this message (header + message bytes)
         '''
         if self._pending_disconnect:
             raise netshared.ServerError('Cannot send_message to a disconnecting peer')
-        return self._connection.send_message(packet)
+        self.parent._wake_peer(self)
+        return self._connection.send_message(packet, ordered, reliable, channel)
+
+    def send_encoded_message(self, message_bytes, ordered=False,
+                             reliable=False, channel=0):
+        '''
+        Adds a message that was encoded by BaseMessage.get_packet_bytes to
+        the outgoing buffer. See send_message.
+        '''
+        if self._pending_disconnect:
+            raise netshared.ServerError('Cannot send_message to a disconnecting peer')
+        self.parent._wake_peer(self)
+        return self._connection.send_encoded_message(
+            message_bytes, ordered, reliable, channel)
+
+    def send_latest_message(self, message, key, ttl=None):
+        '''
+        Adds an unreliable message to the outgoing buffer that replaces
+        any queued message of the same class and key, and is dropped
+        unsent after ttl seconds if given. See
+        Connection.send_latest_message.
+        '''
+        if self._pending_disconnect:
+            raise netshared.ServerError('Cannot send_message to a disconnecting peer')
+        self.parent._wake_peer(self)
+        return self._connection.send_latest_message(message, key, ttl)
+
+    def send_encoded_latest_message(self, message_bytes, message_type_id,
+                                    key, ttl=None):
+        '''
+        Adds a latest value message that was encoded by
+        BaseMessage.get_packet_bytes to the outgoing buffer. See
+        send_latest_message.
+        '''
+        if self._pending_disconnect:
+            raise netshared.ServerError('Cannot send_message to a disconnecting peer')
+        self.parent._wake_peer(self)
+        return self._connection.send_encoded_latest_message(
+            message_bytes, message_type_id, key, ttl)
 
     def send_reliable_message(self, packet):
         if self._pending_disconnect:
             raise netshared.ServerError('Cannot send_reliable_message to a disconnecting peer')
+        self.parent._wake_peer(self)
         self._connection.send_reliable_message(packet)
 
     def disconnect(self):
@@ -133,6 +246,17 @@ class Peer(metrics.Metrics):
         self._connection.send_message(
             self.parent.message_factory.get_by_name('Disconnected')())
         self._pending_disconnect = True
+        self.parent._wake_peer(self)
+
+    def flush(self):
+        '''
+        Send the messages queued for this peer now, without waiting for the
+        next update of the server.
+        '''
+        self._connection.flush()
+
+    def next_deadline(self):
+        return self._connection.next_deadline()
 
     def update(self):
         self._connection.update()
@@ -0,0 +1,226 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+'''
+Run a server as several worker processes that listen on the same port
+with SO_REUSEPORT. The kernel hashes each client address to one worker,
+so every peer is handled by a single shard and peers are updated in
+parallel across cores.
+
+Each worker builds its `Server` by calling server_factory(shard), which
+must be a picklable module level function. The `Shard` passed to it
+broadcasts messages to the peers of every shard::
+
+    def create_server(shard):
+        server = legume.Server()
+        def on_message(peer, message):
+            shard.send_message_to_all(message, reliable=True)
+        server.OnMessage += on_message
+        return server
+
+    sharded = legume.sharding.ShardedServer(create_server, workers=4)
+    sharded.start(('', 4000))
+    sharded.run()
+
+The worker processes report their peer counts and relay broadcasts
+through a control pipe to the parent process.
+'''
+
+__docformat__ = 'restructuredtext'
+
+import os
+import logging
+import multiprocessing
+import multiprocessing.connection
+from legume.exceptions import ServerError
+from legume.handshake import ConnectCookies
+
+# Seconds a worker waits for packets before checking its control pipe.
+CONTROL_INTERVAL = 0.01
+
+class Shard(object):
+    '''
+    The worker side of a sharded server. Messages sent with
+    send_message_to_all go to the peers of this shard straight away and
+    are relayed to the other shards by the parent process.
+    '''
+    def __init__(self, index, shard_count, pipe):
+        self.index = index
+        self.shard_count = shard_count
+        self.server = None
+        self._pipe = pipe
+        self._reported_peercount = None
+        self._stopped = False
+
+    def send_message_to_all(self, message, ordered=False, reliable=False,
+                            channel=0):
+        '''
+        Send a message to the peers of every shard.
+        '''
+        message_bytes = message.get_packet_bytes()
+        self.server.send_encoded_message_to_all(
+            message_bytes, ordered, reliable, channel)
+        self._pipe.send(
+            ('broadcast', self.index, message_bytes, ordered, reliable, channel))
+
+    def _process_control(self):
+        while self._pipe.poll():
+            command = self._pipe.recv()
+            if command[0] == 'broadcast':
+                self.server.send_encoded_message_to_all(*command[2:])
+            elif command[0] == 'stop':
+                self._stopped = True
+
+        peercount = self.server.peercount
+        if peercount != self._reported_peercount:
+            self._reported_peercount = peercount
+            self._pipe.send(('peercount', self.index, peercount))
+
+    def run(self, address):
+        self.server.listen(address, reuse_port=True)
+        self._pipe.send(('listening', self.index))
+        try:
+            while not self._stopped:
+                self.server.poll(CONTROL_INTERVAL)
+                self._process_control()
+        finally:
+            self.server._shutdown_socket()
+
+def _run_shard(index, shard_count, address, server_factory, secret, pipe):
+    shard = Shard(index, shard_count, pipe)
+    shard.server = server_factory(shard)
+    # Every shard must accept cookies issued by the others, the kernel
+    # may hash a client to a different worker once all have bound.
+    shard.server._connect_cookies = ConnectCookies(secret)
+    shard.run(address)
+
+class ShardedServer(object):
+    '''
+    Starts and controls the worker processes of a sharded server.
+    update() must be called regularly, or run() used, to relay broadcasts
+    between shards and collect peer counts.
+    '''
+    _log = logging.getLogger('legume.sharding')
+
+    def __init__(self, server_factory, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ServerError('A sharded server needs at least one worker')
+        self._server_factory = server_factory
+        self._worker_count = workers
+        self._processes = []
+        self._pipes = []
+        self._peercounts = [0] * workers
+
+    @property
+    def peercount(self):
+        '''Number of peers connected to all shards, as last reported.'''
+        return sum(self._peercounts)
+
+    @property
+    def shard_peercounts(self):
+        '''List of the number of peers connected to each shard.'''
+        return list(self._peercounts)
+
+    def is_active(self):
+        return len(self._processes) > 0
+
+    def start(self, address, timeout=5.0):
+        '''
+        Start the worker processes listening on address, a (host, port)
+        tuple. Returns once every worker is listening; the kernel rehashes
+        clients to workers as they bind, so connections made earlier could
+        move to another shard. Raises ServerError if a worker exits or
+        isn't listening within timeout seconds.
+        '''
+        if self.is_active():
+            raise ServerError('Sharded server has already been started')
+        secret = os.urandom(32)
+        for index in range(self._worker_count):
+            parent_pipe, worker_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_shard, args=(
+                index, self._worker_count, address, self._server_factory,
+                secret, worker_pipe))
+            process.daemon = True
+            process.start()
+            # Only the worker holds its end, so recv() fails if it exits.
+            worker_pipe.close()
+            self._processes.append(process)
+            self._pipes.append(parent_pipe)
+
+        for index, pipe in enumerate(self._pipes):
+            try:
+                if not pipe.poll(timeout):
+                    raise ServerError(
+                        'Shard %d did not start listening' % index)
+                pipe.recv()
+            except EOFError:
+                self.stop()
+                raise ServerError('Shard %d has exited' % index)
+            except ServerError:
+                self.stop()
+                raise
+
+    def send_message_to_all(self, message, ordered=False, reliable=False,
+                            channel=0):
+        '''
+        Send a message to the peers of every shard. The message is encoded
+        once in this process.
+        '''
+        message_bytes = message.get_packet_bytes()
+        for pipe in self._pipes:
+            pipe.send(
+                ('broadcast', None, message_bytes, ordered, reliable, channel))
+
+    def update(self, timeout=0):
+        '''
+        Process reports from the workers, waiting up to timeout seconds
+        for the first one.
+        '''
+        for pipe in multiprocessing.connection.wait(self._pipes, timeout):
+            while pipe.poll():
+                try:
+                    command = pipe.recv()
+                except EOFError:
+                    index = self._pipes.index(pipe)
+                    self.stop()
+                    raise ServerError('Shard %d has exited' % index)
+                if command[0] == 'peercount':
+                    self._peercounts[command[1]] = command[2]
+                elif command[0] == 'broadcast':
+                    for index, other_pipe in enumerate(self._pipes):
+                        if index != command[1]:
+                            other_pipe.send(command)
+
+    def run(self, until=None):
+        '''
+        Call update() until stop() is called or until(), if given, returns
+        True.
+        '''
+        while self.is_active():
+            if until is not None and until():
+                break
+            self.update(CONTROL_INTERVAL)
+
+    def stop(self, timeout=5.0):
+        '''
+        Stop the worker processes. Workers that haven't exited after
+        timeout seconds are terminated.
+        '''
+        for pipe in self._pipes:
+            try:
+                pipe.send(('stop',))
+            except (OSError, EOFError):
+                pass
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                self._log.warning('Terminating shard process %s' % process.pid)
+                process.terminate()
+        for pipe in self._pipes:
+            pipe.close()
+        self._processes = []
+        self._pipes = []
+        self._peercounts = [0] * self._worker_count
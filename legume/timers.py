@@ -0,0 +1,71 @@
+﻿# -*- coding: utf-8 -*-
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+__docformat__ = 'restructuredtext'
+
+import heapq
+import itertools
+
+class TimerQueue(object):
+    '''
+    Holds one deadline per key in a heap, so the keys that are due can be
+    found without looking at the others. Rescheduling a key leaves its
+    old heap entry in place; stale entries are skipped when they reach
+    the top of the heap.
+    '''
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        '''
+        Set the deadline of key, replacing any earlier one.
+        '''
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        # The counter breaks ties so keys themselves are never compared.
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._compact()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        '''
+        Returns the earliest deadline, or None if nothing is scheduled.
+        '''
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        '''
+        Remove and return the keys with a deadline at or before now.
+        '''
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            key = heapq.heappop(self._heap)[2]
+            del self._deadlines[key]
+            due.append(key)
+            self._discard_stale()
+        return due
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap
+            if self._deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self._heap)
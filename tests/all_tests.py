@@ -19,6 +19,22 @@ import test_varstring
 import test_reliablemsg
 import test_metrics
 import test_api
+import test_codec
+import test_bytebuffer
+import test_connection
+import test_reorderbuffer
+import test_rttestimator
+import test_congestion
+import test_fragments
+import test_poll
+import test_aio
+import test_sharding
+import test_handshake
+import test_timers
+import test_dispatch
+import test_datagrams
+import test_backpressure
+import test_latest
 
 import logging
 
@@ -42,13 +58,34 @@ if __name__ == '__main__':
     suite_reliablemsg = unittest.TestLoader().loadTestsFromModule(test_reliablemsg)
     suite_metrics = unittest.TestLoader().loadTestsFromModule(test_metrics)
     suite_api = unittest.TestLoader().loadTestsFromModule(test_api)
+    suite_codec = unittest.TestLoader().loadTestsFromModule(test_codec)
+    suite_bytebuffer = unittest.TestLoader().loadTestsFromModule(test_bytebuffer)
+    suite_connection = unittest.TestLoader().loadTestsFromModule(test_connection)
+    suite_reorderbuffer = unittest.TestLoader().loadTestsFromModule(test_reorderbuffer)
+    suite_rttestimator = unittest.TestLoader().loadTestsFromModule(test_rttestimator)
+    suite_congestion = unittest.TestLoader().loadTestsFromModule(test_congestion)
+    suite_fragments = unittest.TestLoader().loadTestsFromModule(test_fragments)
+    suite_poll = unittest.TestLoader().loadTestsFromModule(test_poll)
+    suite_aio = unittest.TestLoader().loadTestsFromModule(test_aio)
+    suite_sharding = unittest.TestLoader().loadTestsFromModule(test_sharding)
+    suite_handshake = unittest.TestLoader().loadTestsFromModule(test_handshake)
+    suite_timers = unittest.TestLoader().loadTestsFromModule(test_timers)
+    suite_dispatch = unittest.TestLoader().loadTestsFromModule(test_dispatch)
+    suite_datagrams = unittest.TestLoader().loadTestsFromModule(test_datagrams)
+    suite_backpressure = unittest.TestLoader().loadTestsFromModule(test_backpressure)
+    suite_latest = unittest.TestLoader().loadTestsFromModule(test_latest)
 
     all_suites = unittest.TestSuite()
     all_suites.addTests([
         suite_udp, suite_keepalive, suite_events,
         suite_nevent, suite_pingsampler, suite_newmsg,
         suite_latency, suite_varstring, suite_reliablemsg,
-        suite_metrics, suite_api
+        suite_metrics, suite_api, suite_codec,
+        suite_bytebuffer, suite_connection, suite_reorderbuffer,
+        suite_rttestimator, suite_congestion, suite_fragments,
+        suite_poll, suite_aio, suite_sharding, suite_handshake,
+        suite_timers, suite_dispatch, suite_datagrams, suite_backpressure,
+        suite_latest
     ])
 
     if len(sys.argv) > 1:
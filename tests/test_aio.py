@@ -0,0 +1,71 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import asyncio
+import unittest
+import legume
+from legume.aio import AsyncClient, AsyncServer
+from greenbar import GreenBarRunner
+
+class ChatMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'text':'varstring'}
+
+class TestAsyncEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ChatMessage)
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10.0))
+
+    def testClientServerExchangeMessages(self):
+        async def exchange():
+            server = AsyncServer(self.mf)
+            await server.listen(('127.0.0.1', 0))
+
+            async def echo():
+                async for peer, message in server:
+                    reply = ChatMessage()
+                    reply.text.value = message.text.value.upper()
+                    peer.send_reliable_message(reply)
+
+            echo_task = asyncio.ensure_future(echo())
+
+            client = AsyncClient(self.mf)
+            await client.connect(server.address, timeout=5.0)
+            self.assertTrue(client.endpoint.connected)
+
+            message = ChatMessage()
+            message.text.value = 'hello'
+            client.send_message(message, reliable=True)
+            reply = await client.__anext__()
+
+            client.close()
+            server.close()
+            await echo_task
+            return reply.text.value
+
+        self.assertEqual(self.run_async(exchange()), 'HELLO')
+
+    def testConnectTimesOut(self):
+        async def connect():
+            # Nothing answers on this port.
+            server = AsyncServer(self.mf)
+            await server.listen(('127.0.0.1', 0))
+            address = server.address
+            server.close()
+            client = AsyncClient(self.mf)
+            try:
+                await client.connect(address, timeout=0.2)
+            finally:
+                client.close()
+
+        self.assertRaises(asyncio.TimeoutError, self.run_async, connect())
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
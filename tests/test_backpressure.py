@@ -0,0 +1,122 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+import legume
+import legume.timing as time
+from legume.connection import Connection
+from legume.netshared import NetworkEndpoint
+from test_connection import FakeEndpoint, ExampleMessage
+from greenbar import GreenBarRunner
+
+class TestBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.endpoint = FakeEndpoint(self.mf)
+        self.endpoint.max_queued_messages = 2
+        self.connection = Connection(self.endpoint)
+        self.backpressure = []
+        self.errors = []
+        self.sent = {}
+        self.connection.OnBackpressure += self.onBackpressure
+        self.connection.OnError += self.onError
+
+    def onBackpressure(self, sender, queued_bytes):
+        self.backpressure.append(queued_bytes)
+
+    def onError(self, sender, error_string):
+        self.errors.append(error_string)
+
+    def send(self, value, **options):
+        message = ExampleMessage()
+        message.param1.value = value
+        length = self.connection.send_message(message, **options)
+        if length:
+            self.sent[self.connection._outgoing_message_id] = value
+        return length
+
+    def queuedValues(self):
+        return [self.sent[message_id]
+            for message_id in self.connection._outgoing]
+
+    def testOldestUnreliableMessageIsDropped(self):
+        self.send(1)
+        self.send(2, reliable=True)
+        self.assertTrue(self.send(3) > 0)
+        self.assertEqual(self.queuedValues(), [2, 3])
+        self.assertEqual(len(self.backpressure), 1)
+
+    def testDropSkipsQueuedReliableMessages(self):
+        self.endpoint.max_queued_messages = 4
+        self.send(1, reliable=True)
+        self.send(2, reliable=True)
+        self.send(3)
+        self.send(4)
+        self.assertTrue(self.send(5) > 0)
+        self.assertEqual(self.queuedValues(), [1, 2, 4, 5])
+        self.assertEqual(len(self.connection._unsent_unreliable), 2)
+
+    def testReliableMessagesAreNotDropped(self):
+        self.send(1, reliable=True)
+        self.send(2, reliable=True)
+        self.assertEqual(self.send(3), 0)
+        self.assertEqual(self.queuedValues(), [1, 2])
+
+    def testRejectedOrderedMessageKeepsChannelSequence(self):
+        self.endpoint.backpressure_policy = \
+            NetworkEndpoint.BACKPRESSURE_REJECT
+        self.send(1, ordered=True)
+        self.send(2)
+        self.assertEqual(self.send(3, ordered=True), 0)
+        self.assertEqual(self.queuedValues(), [1, 2])
+        self.assertEqual(self.connection._outgoing_ordered_sequence_numbers[0], 1)
+
+    def testDisconnectPolicyErrorsAtNextUpdate(self):
+        self.endpoint.backpressure_policy = \
+            NetworkEndpoint.BACKPRESSURE_DISCONNECT
+        self.send(1)
+        self.send(2)
+        self.assertEqual(self.send(3), 0)
+        self.assertEqual(self.errors, [])
+        self.assertFalse(self.connection.can_send(6))
+        self.assertTrue(self.connection.next_deadline() <= time.time())
+        self.connection.update()
+        self.assertEqual(self.errors, ['Outgoing queue is full'])
+
+    def testSystemMessagesAreAlwaysQueued(self):
+        self.endpoint.backpressure_policy = \
+            NetworkEndpoint.BACKPRESSURE_REJECT
+        self.send(1, reliable=True)
+        self.send(2)
+        disconnected = self.mf.get_by_name('Disconnected')()
+        self.assertTrue(self.connection.send_message(disconnected) > 0)
+        self.connection._send_pong(1)
+        self.assertEqual(len(self.connection._outgoing), 4)
+        self.assertEqual(self.backpressure, [])
+        self.assertEqual(self.send(3), 0)
+
+    def testCanSendChecksByteLimit(self):
+        self.endpoint.max_queued_messages = None
+        self.endpoint.max_queued_bytes = 30
+        length = self.send(1)
+        self.assertTrue(self.connection.can_send(30 - 2 * length))
+        self.assertFalse(self.connection.can_send(30 - length))
+
+    def testFragmentsCountAgainstMessageLimit(self):
+        self.assertTrue(self.connection.can_send(Connection.MTU))
+        self.assertFalse(self.connection.can_send(Connection.MTU * 2))
+
+    def testLimitsAreValidated(self):
+        endpoint = legume.Client()
+        self.assertRaises(legume.exceptions.ArgumentError,
+            setattr, endpoint, 'max_queued_bytes', 0)
+        self.assertRaises(legume.exceptions.ArgumentError,
+            setattr, endpoint, 'backpressure_policy', 'drop')
+        self.assertFalse(endpoint.can_send(10))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,53 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import struct
+import unittest
+from legume.bytebuffer import ByteBuffer
+from legume.exceptions import BufferError
+from greenbar import GreenBarRunner
+
+class TestByteBuffer(unittest.TestCase):
+    def setUp(self):
+        self.data = struct.pack('!HHB', 1, 2, 3) + b'abcdef'
+        self.bb = ByteBuffer(self.data)
+
+    def testReadStructAdvances(self):
+        self.assertEqual(self.bb.read_struct('HHB'), (1, 2, 3))
+        self.assertEqual(self.bb.length, 6)
+        self.assertEqual(self.bb.read_bytes(6), b'abcdef')
+        self.assertTrue(self.bb.is_empty())
+
+    def testPeekDoesNotAdvance(self):
+        self.assertEqual(self.bb.peek_struct('H'), (1,))
+        self.assertEqual(self.bb.peek_bytes(2), b'\x00\x01')
+        self.assertEqual(self.bb.length, len(self.data))
+
+    def testReadFromMemoryview(self):
+        bb = ByteBuffer(memoryview(bytearray(self.data))[5:])
+        self.assertEqual(bb.read_bytes(3), b'abc')
+        self.assertEqual(bb.length, 3)
+
+    def testPushBytesAppendsAfterUnreadData(self):
+        self.bb.read_struct('HHB')
+        self.bb.read_bytes(3)
+        self.bb.push_bytes(b'ghi')
+        self.assertEqual(self.bb.length, 6)
+        self.assertEqual(self.bb.read_bytes(6), b'defghi')
+
+    def testReadPastEndRaisesBufferError(self):
+        self.bb.read_bytes(len(self.data))
+        self.assertRaises(BufferError, self.bb.read_struct, 'H')
+        self.assertRaises(BufferError, self.bb.read_bytes, 1)
+        self.assertRaises(BufferError, self.bb.peek_struct, 'B')
+
+    def testFailedReadDoesNotAdvance(self):
+        self.bb.read_bytes(9)
+        self.assertRaises(BufferError, self.bb.read_struct, 'HH')
+        self.assertEqual(self.bb.read_struct('H'), (25958,))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,144 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import struct
+import unittest
+import legume
+from legume.bytebuffer import ByteBuffer
+from greenbar import GreenBarRunner
+
+class FixedMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'ball_id' : 'int',
+        'x' : 'float',
+        'name' : 'string 8',
+        'flag' : 'bool'}
+
+class MixedMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+2
+    MessageValues = {
+        'text' : 'varstring',
+        'num' : 'int',
+        'other' : 'varstring',
+        'id' : 'short'}
+
+class ExplicitValueMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+3
+    def __init__(self):
+        legume.messages.BaseMessage.__init__(self,
+            legume.messages.MessageValue(
+                'message', 'string', 'Hello World!', max_length=32))
+
+def decode(message_class, packet_bytes):
+    byte_buffer = ByteBuffer(packet_bytes)
+    message_type_id = legume.messages.BaseMessage.read_header_from_byte_buffer(
+        byte_buffer)[0]
+    message = message_class()
+    message.read_from_byte_buffer(byte_buffer)
+    return message_type_id, message, byte_buffer
+
+class TestMessageCodec(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(FixedMessage, MixedMessage)
+
+    def testCodecIsBuiltOncePerClass(self):
+        self.assertTrue(FixedMessage.get_codec() is FixedMessage.get_codec())
+        self.assertTrue(FixedMessage().get_codec() is FixedMessage.get_codec())
+
+    def testCodecIsNotInherited(self):
+        class DerivedMessage(FixedMessage):
+            MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+4
+            MessageValues = {'y' : 'int'}
+        self.assertFalse(DerivedMessage.get_codec() is FixedMessage.get_codec())
+        self.assertEqual(DerivedMessage.get_codec().value_names, ['y'])
+
+    def testFixedMessageIsFixedSize(self):
+        self.assertTrue(FixedMessage.get_codec().is_fixed_size)
+        self.assertFalse(MixedMessage.get_codec().is_fixed_size)
+
+    def testFixedMessageMatchesMessageFormat(self):
+        message = FixedMessage()
+        message.ball_id.value = 12
+        message.x.value = 1.5
+        message.name.value = 'ball'
+        message.flag.value = True
+        expected = struct.pack('!'+message.get_message_format(),
+            FixedMessage.MessageTypeID, 12, 1.5, b'ball', True)
+        self.assertEqual(message.get_packet_bytes(), expected)
+
+    def testFixedMessageRoundTrip(self):
+        message = FixedMessage()
+        message.ball_id.value = -7
+        message.x.value = 3.25
+        message.name.value = 'ball'
+        message.flag.value = True
+
+        type_id, decoded, byte_buffer = decode(
+            FixedMessage, message.get_packet_bytes())
+        self.assertEqual(type_id, FixedMessage.MessageTypeID)
+        self.assertEqual(decoded.ball_id.value, -7)
+        self.assertEqual(decoded.x.value, 3.25)
+        self.assertEqual(decoded.name.value, 'ball')
+        self.assertTrue(decoded.flag.value)
+        self.assertTrue(byte_buffer.is_empty())
+
+    def testMixedMessageRoundTrip(self):
+        message = MixedMessage()
+        message.text.value = 'Hello'
+        message.num.value = 100
+        message.other.value = ''
+        message.id.value = 65535
+
+        type_id, decoded, byte_buffer = decode(
+            MixedMessage, message.get_packet_bytes())
+        self.assertEqual(decoded.text.value, 'Hello')
+        self.assertEqual(decoded.num.value, 100)
+        self.assertEqual(decoded.other.value, '')
+        self.assertEqual(decoded.id.value, 65535)
+        self.assertTrue(byte_buffer.is_empty())
+
+    def testMixedMessageMatchesMessageFormat(self):
+        message = MixedMessage()
+        message.text.value = 'Hello'
+        message.num.value = 100
+        message.other.value = 'abc'
+        message.id.value = 3
+        expected = struct.pack('!'+message.get_message_format(),
+            MixedMessage.MessageTypeID, 5, b'Hello', 100, 3, b'abc', 3)
+        self.assertEqual(message.get_packet_bytes(), expected)
+
+    def testExplicitValueMessageRoundTrip(self):
+        message = ExplicitValueMessage()
+        message.message.value = 'Changed'
+        type_id, decoded, byte_buffer = decode(
+            ExplicitValueMessage, message.get_packet_bytes())
+        self.assertEqual(decoded.message.value, 'Changed')
+
+    def testOverwrittenValueRaisesMessageError(self):
+        message = FixedMessage()
+        message.ball_id = 5
+        self.assertRaises(
+            legume.messages.MessageError, message.get_packet_bytes)
+
+    def testOverwrittenVarstringRaisesMessageError(self):
+        message = MixedMessage()
+        message.num.value = 1
+        message.id.value = 1
+        message.other.value = ''
+        message.text = 'Hello'
+        self.assertRaises(
+            legume.messages.MessageError, message.get_packet_bytes)
+
+    def testInvalidTypeNameRaisesMessageErrorOnAdd(self):
+        class BadMessage(legume.messages.BaseMessage):
+            MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+5
+            MessageValues = {'bad' : 'complex'}
+        self.assertRaises(legume.messages.MessageError, self.mf.add, BadMessage)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,143 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+import legume
+import legume.timing as time
+from legume.connection import Connection
+from legume.congestion import TokenBucket, CongestionWindow
+from test_connection import FakeEndpoint
+from greenbar import GreenBarRunner
+
+class BulkMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'data':'varstring'}
+
+class TestTokenBucket(unittest.TestCase):
+    def testNoRateNeverLimits(self):
+        bucket = TokenBucket()
+        bucket.consume(1000000)
+        self.assertTrue(bucket.can_send(0))
+        self.assertEqual(bucket.time_until_send(0), 0)
+
+    def testSendingStopsWhenTokensRunOut(self):
+        bucket = TokenBucket(1000)
+        self.assertTrue(bucket.can_send(0))
+        bucket.consume(150)
+        self.assertFalse(bucket.can_send(0))
+        self.assertAlmostEqual(bucket.time_until_send(0), 0.05)
+
+    def testTokensRefillAtRate(self):
+        bucket = TokenBucket(1000)
+        bucket.can_send(0)
+        bucket.consume(150)
+        self.assertFalse(bucket.can_send(0.04))
+        self.assertTrue(bucket.can_send(0.06))
+
+    def testBurstIsCapped(self):
+        bucket = TokenBucket(1000, minimum_burst=200)
+        bucket.can_send(0)
+        bucket.can_send(100)
+        bucket.consume(201)
+        self.assertFalse(bucket.can_send(100))
+
+class TestCongestionWindow(unittest.TestCase):
+    def setUp(self):
+        self.window = CongestionWindow(100, 1000, 200, 4000)
+
+    def testSlowStartGrowsByAckedBytes(self):
+        self.window.on_ack(500)
+        self.assertEqual(self.window.window, 1500)
+
+    def testWindowIsCapped(self):
+        self.window.on_ack(10000)
+        self.assertEqual(self.window.window, 4000)
+
+    def testLossHalvesWindowOncePerRoundTrip(self):
+        self.window.on_loss(1.0, 0.1)
+        self.window.on_loss(1.05, 0.1)
+        self.assertEqual(self.window.window, 500)
+        self.window.on_loss(1.2, 0.1)
+        self.assertEqual(self.window.window, 250)
+        self.window.on_loss(2.0, 0.1)
+        self.assertEqual(self.window.window, 200)
+        self.assertEqual(self.window.loss_count, 4)
+
+    def testCongestionAvoidanceGrowsSlowly(self):
+        self.window.on_loss(1.0, 0.1)
+        self.window.on_ack(500)
+        self.assertEqual(self.window.window, 600)
+
+class TestConnectionSending(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(BulkMessage)
+        self.endpoint = FakeEndpoint(self.mf)
+        self.connection = Connection(self.endpoint)
+
+    def send(self, count, reliable=True):
+        for x in range(count):
+            msg = BulkMessage()
+            msg.data.value = 'x' * 1000
+            self.connection.send_message(msg, reliable=reliable)
+
+    def testReliableDataIsLimitedByWindow(self):
+        self.send(100)
+        self.connection._do_write(None)
+        sent_bytes = sum(len(p) for p in self.endpoint._socket.sent)
+        self.assertTrue(sent_bytes <= self.connection.congestion_window)
+        self.assertEqual(self.connection.bytes_in_flight, sent_bytes)
+        self.assertTrue(self.connection.has_outgoing_packets())
+
+    def testAcksOpenTheWindow(self):
+        self.send(20)
+        self.connection._do_write(None)
+        window = self.connection.congestion_window
+        self.connection._process_packet_ack(
+            self.connection._outgoing_packet_sequence_number, 0xffffffff)
+        self.assertEqual(self.connection.bytes_in_flight, 0)
+        self.assertTrue(self.connection.congestion_window > window)
+
+    def testUnreliableDataIsNotInFlight(self):
+        self.send(5, reliable=False)
+        self.connection._do_write(None)
+        self.assertEqual(len(self.endpoint._socket.sent), 5)
+        self.assertEqual(self.connection.bytes_in_flight, 0)
+
+    def testEarlyLossesHalveWindowOnce(self):
+        # Before the first round trip sample the resend delay is the
+        # recovery period.
+        self.send(5)
+        self.connection._do_write(None)
+        window = self.connection.congestion_window
+        now = time.time() + 1.0
+        self.connection._detect_lost_packets(now)
+        self.connection._detect_lost_packets(now + 0.1)
+        self.assertEqual(self.connection.congestion_window, window / 2.0)
+        self.assertEqual(self.connection.bytes_in_flight, 0)
+
+    def testDueMessagesAreResentInOneUpdate(self):
+        self.send(6)
+        self.connection._do_write(None)
+        self.assertEqual(len(self.endpoint._socket.sent), 6)
+        del self.endpoint._socket.sent[:]
+        rto = self.connection.rto
+
+        time.sleep(rto + 0.5)
+        self.connection._do_write(None)
+        self.assertEqual(len(self.endpoint._socket.sent), 6)
+        self.assertAlmostEqual(self.connection.rto, rto * 2)
+
+    def testMaxSendRatePacesPackets(self):
+        self.endpoint.max_send_rate = 10000
+        self.send(5, reliable=False)
+        self.connection._do_write(None)
+        self.assertEqual(len(self.endpoint._socket.sent), 2)
+        self.assertEqual(len(self.connection._outgoing), 3)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
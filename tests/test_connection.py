@@ -0,0 +1,397 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import legume.timing as time
+time.test_mode(True)
+
+import sys
+import unittest
+import legume
+from legume.connection import Connection
+from legume.netshared import NetworkEndpoint
+from legume.recentids import RecentIdWindow
+from legume.acks import ReceivedPackets, acked_sequence_numbers
+from greenbar import GreenBarRunner
+
+class ExampleMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'param1':'int'}
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, flags, address):
+        self.sent.append(bytes(packet))
+        return len(packet)
+
+    def close(self):
+        pass
+
+class FakeEndpoint(object):
+    '''
+    Stands in for the Client or Peer that owns a Connection.
+    '''
+    is_server = False
+    timeout = 10.0
+    max_send_rate = None
+    max_queued_bytes = None
+    max_queued_messages = None
+    backpressure_policy = NetworkEndpoint.BACKPRESSURE_DROP_UNRELIABLE
+
+    def __init__(self, message_factory):
+        self.message_factory = message_factory
+        self._socket = FakeSocket()
+        self._address = ('127.0.0.1', 9000)
+
+    def do_read(self, callback):
+        pass
+
+    def _send_datagram(self, buffers, address):
+        self._socket.sendto(b''.join(buffers), 0, address)
+
+    def _flush_datagrams(self):
+        pass
+
+    def _send_blocked(self):
+        return False
+
+class TestOutgoingQueue(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.connection = Connection(FakeEndpoint(self.mf))
+
+    def send(self, count, reliable):
+        for x in range(count):
+            msg = ExampleMessage()
+            msg.param1.value = x
+            self.connection.send_message(msg, reliable=reliable)
+
+    def testAckRemovesOnlyAckedMessage(self):
+        self.send(5, True)
+        message_ids = list(self.connection._outgoing)
+        self.connection._process_message_ack(message_ids[2])
+        self.assertEqual(
+            list(self.connection._outgoing),
+            message_ids[:2] + message_ids[3:])
+
+    def testOutBufferBytesFollowsQueue(self):
+        self.send(3, True)
+        total = sum(m.length for m in self.connection._outgoing.values())
+        self.assertEqual(self.connection.out_buffer_bytes, total)
+        for message_id in list(self.connection._outgoing):
+            self.connection._process_message_ack(message_id)
+        self.assertEqual(self.connection.out_buffer_bytes, 0)
+
+    def testDuplicateAckIsIgnored(self):
+        self.send(1, True)
+        message_id = list(self.connection._outgoing)[0]
+        self.connection._process_message_ack(message_id)
+        self.connection._process_message_ack(message_id)
+        self.assertFalse(self.connection.has_outgoing_packets())
+
+    def testUnreliableMessagesLeaveQueueWhenSent(self):
+        self.send(10, False)
+        self.send(2, True)
+        self.connection._create_packet()
+        self.assertEqual(len(self.connection._outgoing), 2)
+        self.assertTrue(all(
+            m.require_ack for m in self.connection._outgoing.values()))
+
+class TestPacketBuilder(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.endpoint = FakeEndpoint(self.mf)
+        self.connection = Connection(self.endpoint)
+
+    def send(self, count, reliable):
+        for x in range(count):
+            msg = ExampleMessage()
+            msg.param1.value = x
+            self.connection.send_message(msg, reliable=reliable)
+
+    def messageIds(self):
+        sequence_number = self.connection._outgoing_packet_sequence_number
+        return self.connection._sent_packets[sequence_number].message_ids
+
+    def testPacketsAreFilledToMTU(self):
+        self.send(500, False)
+        message_length = list(self.connection._outgoing.values())[0].length
+        self.connection.flush()
+        sent = self.endpoint._socket.sent
+        self.assertTrue(len(sent) > 1)
+        for packet in sent[:-1]:
+            self.assertTrue(len(packet) > Connection.MTU - message_length)
+        self.assertFalse(self.connection.has_outgoing_packets())
+
+    def testDueResendsGoFirst(self):
+        self.send(2, True)
+        self.connection._create_packet(100.0)
+        resent_ids = self.messageIds()
+        self.send(1, True)
+
+        self.connection._create_packet(100.0 + self.connection._rtt.rto + 1)
+        message_ids = self.messageIds()
+        self.assertEqual(message_ids[:2], resent_ids)
+        self.assertEqual(len(message_ids), 3)
+        self.assertEqual(
+            list(self.connection._awaiting_ack), message_ids)
+
+    def testMessagesWaitingForAckAreNotResentEarly(self):
+        self.send(2, True)
+        self.connection._create_packet(100.0)
+        self.assertEqual(self.connection._create_packet(100.01), None)
+
+    def testUnreliableMessagesPassWindowBlockedMessages(self):
+        self.connection._bytes_in_flight = self.connection.congestion_window
+        self.send(2, True)
+        self.send(1, False)
+        self.assertTrue(self.connection._create_packet(100.0))
+        self.assertEqual(self.messageIds(), [])
+        self.assertEqual(len(self.connection._outgoing), 2)
+        self.assertEqual(list(self.connection._unsent_reliable),
+            list(self.connection._outgoing.values()))
+        self.assertEqual(len(self.connection._unsent_unreliable), 0)
+
+class TestRecentIdWindow(unittest.TestCase):
+    def setUp(self):
+        self.window = RecentIdWindow(3)
+
+    def testContainsAddedIds(self):
+        self.window.add(1)
+        self.window.add(2)
+        self.assertTrue(1 in self.window)
+        self.assertTrue(2 in self.window)
+        self.assertFalse(3 in self.window)
+
+    def testOldestIdIsEvicted(self):
+        for message_id in range(1, 5):
+            self.window.add(message_id)
+        self.assertEqual(len(self.window), 3)
+        self.assertFalse(1 in self.window)
+        self.assertTrue(4 in self.window)
+
+    def testReaddingIdDoesNotGrowWindow(self):
+        self.window.add(1)
+        self.window.add(1)
+        self.window.add(2)
+        self.window.add(3)
+        self.assertEqual(len(self.window), 3)
+        self.assertTrue(1 in self.window)
+
+    def testDuplicateInboundMessageIsDropped(self):
+        connection = Connection(FakeEndpoint(legume.messages.MessageFactory()))
+        sender = Connection(FakeEndpoint(legume.messages.MessageFactory()))
+        ping = legume.messages.Ping()
+        ping.id.value = 1
+        sender.send_message(ping)
+        packet = b''.join(sender._create_packet())
+        connection.process_inbound_packet(packet)
+        connection.process_inbound_packet(packet)
+        self.assertEqual(len(connection._do_read()), 1)
+
+class TestInOrderMessages(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.sender = Connection(FakeEndpoint(self.mf))
+        self.receiver = Connection(FakeEndpoint(self.mf))
+
+    def testOutOfOrderPacketsAreReadInOrder(self):
+        packets = []
+        for x in range(5):
+            msg = ExampleMessage()
+            msg.param1.value = x
+            self.sender.send_inorder_message(msg)
+            packets.append(b''.join(self.sender._create_packet()))
+
+        for packet in reversed(packets[1:]):
+            self.receiver.process_inbound_packet(packet)
+        self.assertEqual(self.receiver._do_read(), [])
+        self.assertEqual(self.receiver.reorder_queue, 4)
+
+        self.receiver.process_inbound_packet(packets[0])
+        read = self.receiver._do_read()
+        self.assertEqual([m.param1.value for m in read], list(range(5)))
+        self.assertEqual(self.receiver.reorder_queue, 0)
+
+    def testLossOnOneChannelDoesNotBlockAnother(self):
+        packets = []
+        for channel in [1, 1, 2]:
+            msg = ExampleMessage()
+            msg.param1.value = channel
+            self.sender.send_message(msg, ordered=True, channel=channel)
+            packets.append(b''.join(self.sender._create_packet()))
+
+        self.receiver.process_inbound_packet(packets[1])
+        self.receiver.process_inbound_packet(packets[2])
+        read = self.receiver._do_read()
+        self.assertEqual([m.param1.value for m in read], [2])
+        self.assertEqual(read[0].channel, 2)
+        self.assertEqual(self.receiver.reorder_queue, 1)
+
+        self.receiver.process_inbound_packet(packets[0])
+        self.assertEqual(
+            [m.param1.value for m in self.receiver._do_read()], [1, 1])
+
+    def testInvalidChannelRaises(self):
+        self.assertRaises(legume.exceptions.ArgumentError,
+            self.sender.send_message, ExampleMessage(), True, False,
+            Connection.ORDERED_CHANNEL_COUNT)
+
+class TestPacketAcks(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.sender_endpoint = FakeEndpoint(self.mf)
+        self.receiver_endpoint = FakeEndpoint(self.mf)
+        self.sender = Connection(self.sender_endpoint)
+        self.receiver = Connection(self.receiver_endpoint)
+
+    def sendReliable(self, count):
+        packets = []
+        for x in range(count):
+            msg = ExampleMessage()
+            msg.param1.value = x
+            self.sender.send_reliable_message(msg)
+            packets.append(b''.join(self.sender._create_packet()))
+        return packets
+
+    def testReceivedPacketsBitfield(self):
+        received = ReceivedPackets()
+        for sequence_number in [1, 2, 4, 3, 7]:
+            received.add(sequence_number)
+        self.assertEqual(received.ack, 7)
+        self.assertEqual(
+            sorted(acked_sequence_numbers(received.ack, received.ack_bits)),
+            [1, 2, 3, 4, 7])
+
+    def testNothingReceivedAcksNothing(self):
+        self.assertEqual(list(acked_sequence_numbers(0, 0)), [])
+
+    def testAckPacketRetiresManyMessages(self):
+        for packet in self.sendReliable(10):
+            self.receiver.process_inbound_packet(packet)
+        self.assertEqual(len(self.sender._outgoing), 10)
+
+        self.receiver._do_write(None)
+        ack_packets = self.receiver_endpoint._socket.sent
+        self.assertEqual(len(ack_packets), 1)
+
+        self.sender.process_inbound_packet(ack_packets[0])
+        self.assertFalse(self.sender.has_outgoing_packets())
+
+    def testAcksArePiggybackedOnData(self):
+        for packet in self.sendReliable(3):
+            self.receiver.process_inbound_packet(packet)
+        msg = ExampleMessage()
+        msg.param1.value = 1
+        self.receiver.send_message(msg)
+        self.receiver._do_write(None)
+        self.assertEqual(len(self.receiver_endpoint._socket.sent), 1)
+
+        self.sender.process_inbound_packet(self.receiver_endpoint._socket.sent[0])
+        self.assertFalse(self.sender.has_outgoing_packets())
+        self.assertEqual(len(self.sender._do_read()), 1)
+
+    def testDuplicateReliableMessageIsAckedAgain(self):
+        packet = self.sendReliable(1)[0]
+        self.receiver.process_inbound_packet(packet)
+        self.receiver._do_write(None)
+        self.receiver.process_inbound_packet(packet)
+        self.receiver._do_write(None)
+        self.assertEqual(len(self.receiver_endpoint._socket.sent), 2)
+        self.assertEqual(len(self.receiver._do_read()), 1)
+
+    def testAckOnlyPacketsAreNotAcked(self):
+        for packet in self.sendReliable(1):
+            self.receiver.process_inbound_packet(packet)
+        self.receiver._do_write(None)
+        self.sender.process_inbound_packet(self.receiver_endpoint._socket.sent[0])
+        self.sender._do_write(None)
+        self.assertEqual(self.sender_endpoint._socket.sent, [])
+
+    def testOnlyPacketsAckedAtOnceAreSampled(self):
+        for x in range(10):
+            msg = ExampleMessage()
+            msg.param1.value = x
+            self.sender.send_message(msg)
+            self.receiver.process_inbound_packet(
+                b''.join(self.sender._create_packet()))
+            # An unreliable packet is only acked by the receiver's next
+            # packet, whenever that is sent.
+            time.sleep(0.5)
+            self.receiver.send_message(msg)
+            self.receiver._do_write(None)
+            for packet in self.receiver_endpoint._socket.sent:
+                self.sender.process_inbound_packet(packet)
+            del self.receiver_endpoint._socket.sent[:]
+        self.assertFalse(self.sender._rtt.has_estimate())
+
+        self.receiver.process_inbound_packet(self.sendReliable(1)[0])
+        time.sleep(0.01)
+        self.receiver._do_write(None)
+        self.sender.process_inbound_packet(
+            self.receiver_endpoint._socket.sent[0])
+        self.assertAlmostEqual(self.sender._rtt.srtt, 0.01)
+
+    def testFullAckWindowSendsAckPacket(self):
+        for packet in self.sendReliable(40):
+            self.receiver.process_inbound_packet(packet)
+        self.assertEqual(len(self.receiver_endpoint._socket.sent), 1)
+        self.sender.process_inbound_packet(self.receiver_endpoint._socket.sent[0])
+        self.assertEqual(len(self.sender._outgoing), 8)
+
+class CountingMessage(ExampleMessage):
+    encode_count = 0
+
+    def get_packet_bytes(self):
+        CountingMessage.encode_count += 1
+        return ExampleMessage.get_packet_bytes(self)
+
+class TestBroadcast(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.server = legume.Server(self.mf)
+        for port in range(5):
+            address = ('127.0.0.1', 9000 + port)
+            self.server._peers[address] = legume.serverpeer.Peer(
+                self.server, address)
+
+    def queued(self, peer):
+        return list(peer._connection._outgoing.values())
+
+    def testMessageIsEncodedOnce(self):
+        CountingMessage.encode_count = 0
+        self.server.send_reliable_message_to_all(CountingMessage())
+        self.assertEqual(CountingMessage.encode_count, 1)
+
+        payloads = [self.queued(peer)[0].payload_bytes
+            for peer in self.server._peers.values()]
+        self.assertTrue(all(payload is payloads[0] for payload in payloads))
+
+    def testPredicateSelectsPeers(self):
+        message = ExampleMessage()
+        self.server.send_message_to_all(message,
+            predicate=lambda peer: peer.address[1] % 2 == 0)
+        sent_ports = [peer.address[1] for peer in self.server._peers.values()
+            if self.queued(peer)]
+        self.assertEqual(sorted(sent_ports), [9000, 9002, 9004])
+
+    def testEncodedMessageIsReadByReceiver(self):
+        message = ExampleMessage()
+        message.param1.value = 42
+        sender = Connection(FakeEndpoint(self.mf))
+        receiver = Connection(FakeEndpoint(self.mf))
+        sender.send_encoded_message(message.get_packet_bytes(), reliable=True)
+        receiver.process_inbound_packet(b''.join(sender._create_packet()))
+        self.assertEqual(receiver._do_read()[0].param1.value, 42)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,177 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import socket
+import unittest
+import legume
+import legume.timing as time
+from legume.connection import Connection
+from legume.datagrams import DatagramQueue
+from legume.netshared import NetworkEndpoint
+from test_connection import FakeEndpoint, FakeSocket, ExampleMessage
+from greenbar import GreenBarRunner
+
+ADDRESS = ('127.0.0.1', 9000)
+
+class GatheringSocket(object):
+    def __init__(self, blocked=0):
+        self.sent = []
+        self.blocked = blocked
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        if self.blocked:
+            self.blocked -= 1
+            raise BlockingIOError()
+        if address is None:
+            raise OSError('unreachable')
+        self.sent.append(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+class TestDatagramQueue(unittest.TestCase):
+    def testBuffersAreGatheredNotCopied(self):
+        sock = GatheringSocket()
+        queue = DatagramQueue(sock)
+        payload = b'payload'
+        queue.append([b'header', payload], ADDRESS)
+        self.assertEqual(queue.flush(), 1)
+        self.assertTrue(sock.sent[0][1] is payload)
+        self.assertEqual(len(queue), 0)
+
+    def testSendtoIsUsedWithoutSendmsg(self):
+        sock = FakeSocket()
+        queue = DatagramQueue(sock)
+        queue.append([b'ab', memoryview(b'cd')], ADDRESS)
+        queue.flush()
+        self.assertEqual(sock.sent, [b'abcd'])
+
+    def testBlockedPacketIsKeptInOrder(self):
+        sock = GatheringSocket(blocked=1)
+        queue = DatagramQueue(sock)
+        queue.append([b'first'], ADDRESS)
+        queue.append([b'second'], ADDRESS)
+        self.assertEqual(queue.flush(), 0)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(sock.sent, [[b'first'], [b'second']])
+
+    def testFailedPacketIsDropped(self):
+        sock = GatheringSocket()
+        queue = DatagramQueue(sock)
+        queue.append([b'first'], None)
+        queue.append([b'second'], ADDRESS)
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(sock.sent, [[b'second']])
+        self.assertEqual(queue.dropped_count, 1)
+
+    def testBlockedStateAndCounters(self):
+        sock = GatheringSocket(blocked=1)
+        queue = DatagramQueue(sock)
+        queue.append([b'abc', b'de'], ADDRESS)
+        self.assertEqual(queue.byte_count, 5)
+        queue.flush()
+        self.assertTrue(queue.blocked)
+        self.assertEqual(queue.blocked_count, 1)
+        self.assertEqual(queue.byte_count, 5)
+        queue.flush()
+        self.assertFalse(queue.blocked)
+        self.assertEqual(queue.byte_count, 0)
+
+    def testPacketIsDroppedWhenBacklogIsFull(self):
+        queue = DatagramQueue(GatheringSocket(), max_bytes=8)
+        self.assertTrue(queue.append([b'12345'], ADDRESS))
+        self.assertFalse(queue.append([b'6789'], ADDRESS))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.dropped_count, 1)
+
+class BlockedEndpoint(FakeEndpoint):
+    blocked = True
+
+    def _send_blocked(self):
+        return self.blocked
+
+class TestBlockedConnection(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.endpoint = BlockedEndpoint(self.mf)
+        self.connection = Connection(self.endpoint)
+
+    def testMessagesStayQueuedWhileBlocked(self):
+        message = ExampleMessage()
+        message.param1.value = 1
+        self.connection.send_reliable_message(message)
+        self.connection._do_write(None)
+        self.assertEqual(self.endpoint._socket.sent, [])
+        self.assertTrue(self.connection.has_outgoing_packets())
+        self.assertTrue(self.connection.next_deadline() > time.time())
+
+        self.endpoint.blocked = False
+        self.connection._do_write(None)
+        self.assertEqual(len(self.endpoint._socket.sent), 1)
+
+class BacklogEndpoint(FakeEndpoint):
+    '''
+    Queues packets in a DatagramQueue on a socket that would block.
+    '''
+    MTU = Connection.MTU
+    _send_datagram = NetworkEndpoint._send_datagram
+    _send_blocked = NetworkEndpoint._send_blocked
+
+    def __init__(self, message_factory, max_bytes):
+        FakeEndpoint.__init__(self, message_factory)
+        self._socket = GatheringSocket(blocked=1000)
+        self._datagrams = DatagramQueue(self._socket, max_bytes)
+
+class TestFullBacklog(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.endpoint = BacklogEndpoint(self.mf, 2 * Connection.MTU)
+        self.connection = Connection(self.endpoint)
+
+    def testBurstStopsAtFullBacklog(self):
+        for x in range(500):
+            message = ExampleMessage()
+            message.param1.value = x
+            self.connection.send_message(message)
+        self.connection._do_write(ADDRESS)
+        queue = self.endpoint._datagrams
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.dropped_count, 0)
+        self.assertTrue(self.connection.has_outgoing_packets())
+
+        self.endpoint._socket.blocked = 0
+        while self.connection.has_outgoing_packets():
+            queue.flush()
+            self.connection._do_write(ADDRESS)
+        queue.flush()
+        self.assertEqual(queue.dropped_count, 0)
+        self.assertEqual(
+            sum(len(b''.join(buffers)) for buffers in self.endpoint._socket.sent),
+            self.connection.out_bytes + 8 * len(self.endpoint._socket.sent))
+
+class TestBatchedSends(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.setblocking(0)
+        self.server = legume.Server()
+        self.server.listen(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.receiver.close()
+        self.server._shutdown_socket()
+
+    def testPacketsAreSentAtEndOfUpdate(self):
+        address = self.receiver.getsockname()
+        self.server._send_datagram([b'abc', b'def'], address)
+        self.assertRaises(BlockingIOError, self.receiver.recvfrom, 100)
+        self.server.update()
+        self.assertEqual(self.receiver.recvfrom(100)[0], b'abcdef')
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
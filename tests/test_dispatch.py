@@ -0,0 +1,91 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+import legume
+from legume.dispatch import MessageDispatcher
+from greenbar import GreenBarRunner
+
+class ChatMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'text':'varstring'}
+
+class MoveMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+2
+    MessageValues = {
+        'x':'int'}
+
+class Recorder(object):
+    def __init__(self):
+        self.received = []
+
+    def handler(self, sender, message):
+        self.received.append((sender, message))
+
+class TestMessageDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = MessageDispatcher()
+        self.recorder = Recorder()
+
+    def testHandlerReceivesItsMessageClass(self):
+        self.dispatcher.on(ChatMessage, self.recorder.handler)
+        message = ChatMessage()
+        self.assertTrue(self.dispatcher.dispatch('sender', message))
+        self.assertFalse(self.dispatcher.dispatch('sender', MoveMessage()))
+        self.assertEqual(self.recorder.received, [('sender', message)])
+
+    def testRemovedHandlerIsNotCalled(self):
+        self.dispatcher.on(ChatMessage, self.recorder.handler)
+        self.dispatcher.off(ChatMessage, self.recorder.handler)
+        self.assertFalse(self.dispatcher.dispatch('sender', ChatMessage()))
+
+    def testSystemMessageRaises(self):
+        self.assertRaises(legume.exceptions.ArgumentError,
+            self.dispatcher.on, legume.messages.Ping, self.recorder.handler)
+        self.assertRaises(legume.exceptions.ArgumentError,
+            self.dispatcher.on, object, self.recorder.handler)
+
+class TestServerDispatch(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ChatMessage, MoveMessage)
+        self.server = legume.Server(self.mf)
+        self.peer = legume.serverpeer.Peer(self.server, ('127.0.0.1', 9000))
+        self.peer._connected = True
+        self.peer.OnMessage += self.server._Peer_OnMessage
+        self.on_message = Recorder()
+        self.server.OnMessage += self.on_message.handler
+
+    def receive(self, message):
+        self.peer._Connection_OnMessage(self.peer._connection, message)
+
+    def testUnhandledMessageRaisesOnMessage(self):
+        self.server.on(ChatMessage, Recorder().handler)
+        message = MoveMessage()
+        self.receive(message)
+        self.assertEqual(self.on_message.received, [(self.peer, message)])
+
+    def testServerHandlerReplacesOnMessage(self):
+        chat = Recorder()
+        self.server.on(ChatMessage, chat.handler)
+        message = ChatMessage()
+        self.receive(message)
+        self.assertEqual(chat.received, [(self.peer, message)])
+        self.assertEqual(self.on_message.received, [])
+
+    def testPeerHandlerTakesPrecedence(self):
+        server_chat = Recorder()
+        peer_chat = Recorder()
+        self.server.on(ChatMessage, server_chat.handler)
+        self.peer.on(ChatMessage, peer_chat.handler)
+        message = ChatMessage()
+        self.receive(message)
+        self.assertEqual(peer_chat.received, [(self.peer, message)])
+        self.assertEqual(server_chat.received, [])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,218 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import legume.timing as time
+time.test_mode(True)
+
+import sys
+import unittest
+import legume
+from legume.connection import Connection
+from legume.fragments import Fragment, FragmentReassembler, split_message
+from test_connection import FakeEndpoint
+from greenbar import GreenBarRunner
+
+class BulkMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'data':'varstring'}
+
+class SmallMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+2
+    MessageValues = {
+        'param1':'int'}
+
+class HugeMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+3
+    MessageValues = dict(('data%d' % x, 'varstring') for x in range(5))
+
+def fragments(group_id, data, fragment_size):
+    chunks = split_message(data, fragment_size)
+    return [Fragment(group_id, index, len(chunks), chunk)
+        for index, chunk in enumerate(chunks)]
+
+class TestFragmentReassembler(unittest.TestCase):
+    def setUp(self):
+        self.reassembler = FragmentReassembler(2, 100, 5.0)
+
+    def testFragmentsAreJoinedInIndexOrder(self):
+        parts = fragments(1, b'abcdefghij', 3)
+        self.assertEqual(len(parts), 4)
+        for part in reversed(parts[1:]):
+            self.assertEqual(self.reassembler.add(part, 0), None)
+        self.assertEqual(self.reassembler.add(parts[0], 0), b'abcdefghij')
+        self.assertEqual(len(self.reassembler), 0)
+        self.assertEqual(self.reassembler.byte_count, 0)
+
+    def testDuplicateFragmentIsIgnored(self):
+        parts = fragments(1, b'abcdef', 3)
+        self.reassembler.add(parts[0], 0)
+        self.reassembler.add(parts[0], 0)
+        self.assertEqual(self.reassembler.byte_count, 6)
+        self.assertEqual(self.reassembler.add(parts[1], 0), b'abcdef')
+
+    def testPartialMessageTimesOut(self):
+        parts = fragments(1, b'abcdef', 3)
+        self.reassembler.add(parts[0], 0)
+        self.assertEqual(self.reassembler.add(parts[1], 6.0), None)
+        self.assertEqual(self.reassembler.dropped_count, 1)
+
+    def testActiveMessageDoesNotTimeOut(self):
+        parts = fragments(1, b'abcdefghi', 3)
+        self.reassembler.add(parts[0], 0)
+        self.reassembler.add(parts[1], 4.0)
+        self.assertEqual(self.reassembler.add(parts[2], 8.0), b'abcdefghi')
+        self.assertEqual(self.reassembler.dropped_count, 0)
+
+    def testNewGroupIsRefusedWhenFull(self):
+        for group_id in range(1, 3):
+            part = fragments(group_id, b'abcdef', 3)[0]
+            self.assertTrue(self.reassembler.accepts(part, 0))
+            self.reassembler.add(part, 0)
+        self.assertFalse(
+            self.reassembler.accepts(fragments(3, b'abcdef', 3)[0], 0))
+        last = fragments(1, b'abcdef', 3)[1]
+        self.assertTrue(self.reassembler.accepts(last, 0))
+        self.assertEqual(self.reassembler.add(last, 0), b'abcdef')
+        self.assertEqual(self.reassembler.dropped_count, 0)
+
+    def testByteLimitRefusesNewGroups(self):
+        self.reassembler.add(fragments(1, b'x' * 120, 60)[0], 0)
+        self.assertFalse(
+            self.reassembler.accepts(fragments(2, b'x' * 40, 20)[0], 0))
+        self.assertEqual(len(self.reassembler), 1)
+
+    def testMessageIsNotStartedFromItsLastFragment(self):
+        self.reassembler.add(fragments(1, b'abcdef', 3)[0], 0)
+        self.assertFalse(
+            self.reassembler.accepts(fragments(2, b'abcdef', 3)[1], 0))
+
+class TestFragmentedMessages(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(BulkMessage, SmallMessage, HugeMessage)
+        self.sender_endpoint = FakeEndpoint(self.mf)
+        self.sender = Connection(self.sender_endpoint)
+        self.receiver = Connection(FakeEndpoint(self.mf))
+
+    def sendBulk(self, size, ordered=False):
+        message = BulkMessage()
+        message.data.value = ''.join(chr(65 + x % 26) for x in range(size))
+        self.sender.send_message(message, ordered=ordered)
+        return message.data.value
+
+    def deliver(self):
+        sent = self.sender_endpoint._socket.sent
+        while self.sender.has_outgoing_packets():
+            self.sender._do_write(None)
+            for packet in sent:
+                self.receiver.process_inbound_packet(packet)
+                self.assertTrue(len(packet) <= Connection.MTU)
+            del sent[:]
+            self.receiver._do_write(None)
+            for packet in self.receiver.parent._socket.sent:
+                self.sender.process_inbound_packet(packet)
+            del self.receiver.parent._socket.sent[:]
+        return self.receiver._do_read()
+
+    def testLargeMessageIsReadAsOneMessage(self):
+        data = self.sendBulk(20000)
+        read = self.deliver()
+        self.assertEqual(len(read), 1)
+        self.assertEqual(read[0].data.value, data)
+        self.assertEqual(len(self.receiver._reassembler), 0)
+
+    def testFragmentsArePaced(self):
+        self.sendBulk(20000)
+        small = SmallMessage()
+        small.param1.value = 7
+        self.sender.send_message(small)
+        self.sender._do_write(None)
+
+        for packet in self.sender_endpoint._socket.sent:
+            self.receiver.process_inbound_packet(packet)
+        read = self.receiver._do_read()
+        self.assertEqual([m.param1.value for m in read], [7])
+        self.assertEqual(len(self.receiver._reassembler), 1)
+        self.assertTrue(len(self.sender._pending_fragments) > 0)
+
+    def testOrderedLargeMessageKeepsItsPlace(self):
+        first = self.sendBulk(5000, ordered=True)
+        small = SmallMessage()
+        small.param1.value = 1
+        self.sender.send_message(small, ordered=True)
+        read = self.deliver()
+        self.assertEqual(read[0].data.value, first)
+        self.assertEqual(read[1].param1.value, 1)
+
+    def testRateLimitedLargeOrderedMessageIsDelivered(self):
+        # Sending takes longer than the connection timeout, partial messages
+        # only time out when no fragments arrive.
+        self.sender_endpoint.max_send_rate = 20000
+        huge = HugeMessage()
+        for x in range(5):
+            getattr(huge, 'data%d' % x).value = chr(65 + x) * 60000
+        self.sender.send_message(huge, ordered=True)
+        small = SmallMessage()
+        small.param1.value = 1
+        self.sender.send_message(small, ordered=True)
+
+        read = []
+        for x in range(1000):
+            time.sleep(0.05)
+            self.sender._do_write(None)
+            for packet in self.sender_endpoint._socket.sent:
+                self.receiver.process_inbound_packet(packet)
+            del self.sender_endpoint._socket.sent[:]
+            self.receiver._do_write(None)
+            for packet in self.receiver.parent._socket.sent:
+                self.sender.process_inbound_packet(packet)
+            del self.receiver.parent._socket.sent[:]
+            read.extend(self.receiver._do_read())
+            if len(read) == 2:
+                break
+
+        self.assertEqual(len(read), 2)
+        self.assertEqual(read[0].data4.value, 'E' * 60000)
+        self.assertEqual(read[1].param1.value, 1)
+        self.assertEqual(self.receiver._reassembler.dropped_count, 0)
+
+    def testRefusedFragmentIsResent(self):
+        self.receiver._reassembler = FragmentReassembler(1, 100000, 10.0)
+        self.receiver._reassembler.add(
+            fragments(9, b'abcdef', 3)[0], time.time())
+        data = self.sendBulk(5000)
+        self.sender._do_write(None)
+        for packet in self.sender_endpoint._socket.sent:
+            self.receiver.process_inbound_packet(packet)
+        del self.sender_endpoint._socket.sent[:]
+        self.receiver._do_write(None)
+        self.assertEqual(self.receiver.parent._socket.sent, [])
+
+        self.receiver._reassembler = FragmentReassembler(1, 100000, 10.0)
+        time.sleep(1.0)
+        self.assertEqual(self.deliver()[0].data.value, data)
+
+    def testPartialMessageTimeoutIsTheConnectionTimeout(self):
+        self.receiver._reassembler = FragmentReassembler(1, 100000, 10.0)
+        self.receiver._reassembler.add(
+            fragments(9, b'abcdef', 3)[0], time.time())
+        self.receiver.parent.timeout = 2.0
+        time.sleep(3.0)
+        data = self.sendBulk(5000)
+        self.sender._do_write(None)
+        for packet in self.sender_endpoint._socket.sent:
+            self.receiver.process_inbound_packet(packet)
+        self.assertEqual(self.receiver._reassembler.dropped_count, 1)
+        self.assertEqual(self.receiver._do_read()[0].data.value, data)
+
+    def testOversizedMessageRaises(self):
+        message = BulkMessage()
+        message.data.value = 'x' * 65000
+        self.sender.MTU = 200
+        self.assertRaises(BufferError, self.sender.send_message, message)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,114 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+import legume
+from legume import timing as time
+from legume.connection import Connection
+from legume.datagrams import DatagramQueue
+from legume.handshake import ConnectCookies, AttemptLimiter, \
+    read_connect_request, challenge_packet
+from test_connection import FakeEndpoint, FakeSocket
+from greenbar import GreenBarRunner
+
+ADDRESS = ('10.0.0.1', 5000)
+
+class TestConnectCookies(unittest.TestCase):
+    def setUp(self):
+        self.cookies = ConnectCookies(b'secret', lifetime=10.0)
+
+    def testCookieIsValidForAddress(self):
+        cookie = self.cookies.create(ADDRESS, 100.0)
+        self.assertEqual(len(cookie), legume.handshake.COOKIE_LENGTH)
+        self.assertTrue(self.cookies.validate(cookie, ADDRESS, 105.0))
+        self.assertFalse(self.cookies.validate(cookie, ('10.0.0.1', 5001), 105.0))
+        self.assertFalse(self.cookies.validate('', ADDRESS, 105.0))
+
+    def testCookieExpires(self):
+        cookie = self.cookies.create(ADDRESS, 100.0)
+        self.assertTrue(self.cookies.validate(cookie, ADDRESS, 119.0))
+        self.assertFalse(self.cookies.validate(cookie, ADDRESS, 120.0))
+
+    def testCookieDependsOnSecret(self):
+        other = ConnectCookies(b'other secret')
+        cookie = self.cookies.create(ADDRESS, 100.0)
+        self.assertFalse(other.validate(cookie, ADDRESS, 100.0))
+
+class TestAttemptLimiter(unittest.TestCase):
+    def testBurstThenRate(self):
+        limiter = AttemptLimiter(rate=1.0, burst=2)
+        self.assertTrue(limiter.allow('a', 0))
+        self.assertTrue(limiter.allow('a', 0))
+        self.assertFalse(limiter.allow('a', 0))
+        self.assertTrue(limiter.allow('b', 0))
+        self.assertTrue(limiter.allow('a', 1.0))
+
+    def testHostsAreBounded(self):
+        limiter = AttemptLimiter(rate=1.0, burst=1, max_hosts=2)
+        for host in ['a', 'b', 'c']:
+            limiter.allow(host, 0)
+        # 'a' was forgotten so it starts with a full burst again.
+        self.assertTrue(limiter.allow('a', 0))
+
+class TestServerHandshake(unittest.TestCase):
+    def setUp(self):
+        self.server = legume.Server()
+        self.server._socket = FakeSocket()
+        self.server._datagrams = DatagramQueue(self.server._socket)
+        self.server._state = self.server.LISTENING
+        self.server.accept_new_connections = True
+
+    def receive(self, packet):
+        self.server._on_socket_data(packet, ADDRESS)
+        self.server._flush_datagrams()
+
+    def requestPacket(self, cookie=''):
+        client = Connection(FakeEndpoint(legume.messages.message_factory))
+        client.send_connect_request(cookie)
+        return client, b''.join(client._create_packet())
+
+    def testJunkDoesNotAllocatePeer(self):
+        for data in [b'', b'\x00' * 3, b'\xff' * 40]:
+            self.receive(data)
+        self.assertEqual(len(self.server._peers), 0)
+        self.assertEqual(self.server._socket.sent, [])
+
+    def testRequestWithoutCookieIsChallenged(self):
+        client, packet = self.requestPacket()
+        self.receive(packet)
+        self.assertEqual(len(self.server._peers), 0)
+        self.assertEqual(len(self.server._socket.sent), 1)
+        self.assertTrue(len(self.server._socket.sent[0]) <= len(packet))
+
+    def testChallengedClientIsAccepted(self):
+        client, packet = self.requestPacket()
+        self.receive(packet)
+
+        client.process_inbound_packet(self.server._socket.sent[0])
+        client.update()
+        self.assertEqual(len(client._outgoing), 1)
+        client._do_write(ADDRESS)
+        request = read_connect_request(
+            client.parent._socket.sent[-1], legume.messages.message_factory)
+        self.assertEqual(len(request.cookie.value), 32)
+
+        self.receive(client.parent._socket.sent[-1])
+        self.assertEqual(len(self.server._peers), 1)
+
+    def testChallengesAreRateLimited(self):
+        client, packet = self.requestPacket()
+        for x in range(20):
+            self.receive(packet)
+        self.assertEqual(len(self.server._socket.sent), 5)
+
+    def testUnsolicitedChallengeIsIgnored(self):
+        connection = Connection(FakeEndpoint(legume.messages.message_factory))
+        connection.process_inbound_packet(challenge_packet('x' * 32))
+        connection.update()
+        self.assertFalse(connection.has_outgoing_packets())
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,112 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import legume.timing as time
+time.test_mode(True)
+
+import sys
+import unittest
+import legume
+from legume.connection import Connection
+from legume.netshared import NetworkEndpoint
+from test_connection import FakeEndpoint
+from greenbar import GreenBarRunner
+
+class BallUpdate(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'ball_id' : 'int',
+        'x' : 'int'}
+
+class BallCreated(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+2
+    MessageValues = {
+        'ball_id' : 'int',
+        'x' : 'int'}
+
+class BallName(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+3
+    MessageValues = {
+        'ball_id' : 'int',
+        'name' : 'varstring'}
+
+class TestLatestMessages(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(BallUpdate, BallCreated, BallName)
+        self.sender = Connection(FakeEndpoint(self.mf))
+        self.receiver = Connection(FakeEndpoint(self.mf))
+
+    def send(self, ball_id, x, message_class=BallUpdate, ttl=None):
+        message = message_class()
+        message.ball_id.value = ball_id
+        message.x.value = x
+        return self.sender.send_latest_message(message, ball_id, ttl)
+
+    def deliver(self):
+        packet = self.sender._create_packet()
+        if packet is None:
+            return []
+        self.receiver.process_inbound_packet(b''.join(packet))
+        return [(m.__class__, m.ball_id.value, m.x.value)
+            for m in self.receiver._do_read()]
+
+    def testNewerMessageReplacesQueuedMessageInPlace(self):
+        self.send(1, 10)
+        self.send(2, 20)
+        self.send(1, 11)
+        self.assertEqual(len(self.sender._outgoing), 2)
+        self.assertEqual(self.deliver(),
+            [(BallUpdate, 1, 11), (BallUpdate, 2, 20)])
+        self.assertEqual(self.sender.out_buffer_bytes, 0)
+        self.assertEqual(self.sender._latest, {})
+
+    def testMessageClassIsPartOfTheKey(self):
+        self.send(1, 10)
+        self.send(1, 11, BallCreated)
+        self.assertEqual(self.deliver(),
+            [(BallUpdate, 1, 10), (BallCreated, 1, 11)])
+
+    def testSentMessageIsNotReplaced(self):
+        self.send(1, 10)
+        self.deliver()
+        self.send(1, 11)
+        self.assertEqual(self.deliver(), [(BallUpdate, 1, 11)])
+
+    def testExpiredMessageIsDroppedUnsent(self):
+        self.send(1, 10, ttl=0.5)
+        self.send(2, 20)
+        time.sleep(1.0)
+        self.assertEqual(self.deliver(), [(BallUpdate, 2, 20)])
+        self.assertEqual(self.sender.out_buffer_bytes, 0)
+
+    def testReplacementResetsTtl(self):
+        self.send(1, 10, ttl=0.5)
+        time.sleep(0.4)
+        self.send(1, 11, ttl=0.5)
+        time.sleep(0.4)
+        self.assertEqual(self.deliver(), [(BallUpdate, 1, 11)])
+
+    def testLargerReplacementIsSubjectToByteLimit(self):
+        self.sender.parent.max_queued_bytes = 40
+        self.sender.parent.backpressure_policy = \
+            NetworkEndpoint.BACKPRESSURE_REJECT
+        backpressure = []
+        self.sender.OnBackpressure += \
+            lambda sender, queued_bytes: backpressure.append(queued_bytes)
+
+        message = BallName()
+        message.ball_id.value = 1
+        message.name.value = 'a'
+        length = self.sender.send_latest_message(message, 1)
+        message.name.value = 'a' * 40
+        self.assertEqual(self.sender.send_latest_message(message, 1), 0)
+        self.assertEqual(backpressure, [40 - 1])
+        self.assertEqual(self.sender.out_buffer_bytes, length)
+        message.name.value = 'b'
+        self.assertEqual(self.sender.send_latest_message(message, 1), length)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -43,6 +43,12 @@ class TestClientMetricsInterface(unittest.TestCase):
     def testKeepAliveInterface(self):
         self.assert_(self.client.keepalive_count >= 0)
 
+    def testRttInterface(self):
+        self.assert_(self.client.smoothed_rtt >= 0)
+        self.assert_(self.client.rtt_variance >= 0)
+        self.assert_(self.client.jitter >= 0)
+        self.assert_(self.client.rto >= 0)
+
 class ExampleMessage(legume.messages.BaseMessage):
     MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
     MessageValues = {
@@ -22,6 +22,13 @@ class Handler(object):
 
 HANDLER = Handler()
 
+class Recorder(object):
+    def __init__(self):
+        self.received = []
+
+    def handler(self, sender, event):
+        self.received.append(event)
+
 class NEventTests(unittest.TestCase):
     def setUp(self):
         self.ne = legume.nevent.Event()
@@ -53,6 +60,30 @@ class NEventTests(unittest.TestCase):
         self.ne(self, None)
         self.assertTrue(FIRED)
 
+    def testCollectedHandlerIsRemoved(self):
+        handler = Recorder()
+        self.ne += handler.handler
+        self.assertEqual(len(self.ne), 1)
+        del handler
+        self.assertEqual(len(self.ne), 0)
+        self.assertEqual(self.ne._handlers, ())
+
+    def testReturnsResultOfLastHandler(self):
+        self.ne += lambda sender, event: 1
+        self.ne += lambda sender, event: 2
+        self.assertEqual(self.ne(self, None), 2)
+
+    def testHandlerMayRemoveItselfWhileRaised(self):
+        handler = Recorder()
+        def remove(sender, event):
+            self.ne -= remove
+        self.ne += remove
+        self.ne += handler.handler
+        self.ne(self, 'first')
+        self.ne(self, 'second')
+        self.assertEqual(handler.received, ['first', 'second'])
+        self.assertFalse(self.ne.is_handled_by(remove))
+
 
 if __name__ == '__main__':
     mytests = unittest.TestLoader().loadTestsFromTestCase(NEventTests)
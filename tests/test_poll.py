@@ -0,0 +1,149 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import random
+import socket
+import unittest
+import legume
+from legume import timing as time
+from legume.connection import Connection
+from test_connection import FakeEndpoint, ExampleMessage
+from greenbar import GreenBarRunner
+
+def getRandomPort():
+    return random.randint(16000, 50000)
+
+class TestNextDeadline(unittest.TestCase):
+    def setUp(self):
+        self.mf = legume.messages.MessageFactory()
+        self.mf.add(ExampleMessage)
+        self.connection = Connection(FakeEndpoint(self.mf))
+
+    def testIdleConnectionWaitsForPing(self):
+        self.assertEqual(self.connection.next_deadline(),
+            self.connection._ping_send_timestamp +
+            legume.connection.PING_REQUEST_FREQUENCY)
+
+    def testQueuedMessageIsDueNow(self):
+        self.connection.send_message(ExampleMessage())
+        self.assertTrue(self.connection.next_deadline() <= time.time())
+
+    def testSentReliableMessageWaitsForResend(self):
+        self.connection.send_reliable_message(ExampleMessage())
+        self.connection._create_packet()
+        message = list(self.connection._outgoing.values())[0]
+        self.assertEqual(self.connection.next_deadline(),
+            message.last_send_attempt_timestamp + self.connection._rtt.rto)
+
+    def testWindowBlockedMessageWaitsForAck(self):
+        self.connection._bytes_in_flight = self.connection.congestion_window
+        self.connection.send_reliable_message(ExampleMessage())
+        self.assertEqual(self.connection.next_deadline(),
+            self.connection._ping_send_timestamp +
+            legume.connection.PING_REQUEST_FREQUENCY)
+        self.connection.send_message(ExampleMessage())
+        self.assertTrue(self.connection.next_deadline() <= time.time())
+
+class TestPoll(unittest.TestCase):
+    def setUp(self):
+        self.port = getRandomPort()
+        self.server = legume.Server()
+        self.server.listen(('', self.port))
+
+    def tearDown(self):
+        self.server._shutdown_socket()
+
+    def testPollInactiveEndpointRaises(self):
+        self.assertRaises(legume.exceptions.NetworkEndpointError,
+            legume.Client().poll, 0)
+
+    def testIdleServerPollTimesOut(self):
+        self.assertEqual(self.server.next_deadline(), None)
+        self.assertFalse(self.server.poll(0.01))
+
+    def testClientConnectsWithPoll(self):
+        client = legume.Client()
+        client.connect(('localhost', self.port))
+        for x in range(50):
+            client.poll(0.01)
+            self.server.poll(0.01)
+            if client.connected:
+                break
+        self.assertTrue(client.connected)
+        self.assertEqual(self.server.peercount, 1)
+        client.disconnect()
+        client.run(timeout=0.01)
+        self.assertFalse(client.is_active())
+
+    def testSocketIsReadOncePerUpdate(self):
+        clients = [legume.Client() for x in range(3)]
+        for client in clients:
+            client.connect(('localhost', self.port))
+        for x in range(50):
+            for client in clients:
+                client.update()
+            self.server.poll(0.01)
+            if all(client.connected for client in clients):
+                break
+        self.assertEqual(self.server.peercount, 3)
+
+        reads = []
+        do_read = self.server.do_read
+        def counting_do_read(callback):
+            reads.append(callback)
+            do_read(callback)
+        self.server.do_read = counting_do_read
+        for client in clients:
+            client.send_message(legume.messages.Ping())
+            client.update()
+        time.sleep(0.05)
+        self.server.update()
+        self.assertEqual(len(reads), 1)
+        for client in clients:
+            client.disconnect()
+
+class TestReceive(unittest.TestCase):
+    def setUp(self):
+        self.port = getRandomPort()
+        self.server = legume.Server()
+        self.server.listen(('127.0.0.1', self.port))
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server._shutdown_socket()
+
+    def read(self):
+        received = []
+        self.server.do_read(
+            lambda data, addr: received.append(bytes(data)))
+        return received
+
+    def testReadBudgetLeavesDatagramsForNextRead(self):
+        self.server.read_budget = 3
+        for x in range(5):
+            self.sender.sendto(bytes([x]) * (x + 1),
+                ('127.0.0.1', self.port))
+        time.sleep(0.05)
+        self.assertEqual(self.read(), [b'\x00', b'\x01' * 2, b'\x02' * 3])
+        self.assertEqual(self.read(), [b'\x03' * 4, b'\x04' * 5])
+
+    def testInvalidReadBudgetRaises(self):
+        def set_budget():
+            self.server.read_budget = 0
+        self.assertRaises(legume.exceptions.ArgumentError, set_budget)
+
+    def testSocketBufferSizesAreApplied(self):
+        self.server.receive_buffer_size = 65536
+        self.server.send_buffer_size = 32768
+        sock = self.server.socket
+        self.assertTrue(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536)
+        self.assertTrue(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 32768)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
@@ -0,0 +1,65 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+from legume.reorderbuffer import ReorderBuffer, next_sequence_number, \
+    sequence_distance, SEQUENCE_NUMBER_MAX
+from greenbar import GreenBarRunner
+
+class HeldMessage(object):
+    def __init__(self, sequence_number):
+        self.sequence_number = sequence_number
+
+class TestReorderBuffer(unittest.TestCase):
+    def setUp(self):
+        self.rb = ReorderBuffer()
+
+    def add(self, sequence_number):
+        return [m.sequence_number for m in
+            self.rb.add(HeldMessage(sequence_number))]
+
+    def testInSequenceMessagesAreReleased(self):
+        self.assertEqual(self.add(1), [1])
+        self.assertEqual(self.add(2), [2])
+        self.assertEqual(len(self.rb), 0)
+
+    def testEarlyMessagesAreHeld(self):
+        self.assertEqual(self.add(3), [])
+        self.assertEqual(self.add(2), [])
+        self.assertEqual(len(self.rb), 2)
+
+    def testFillingGapReleasesWholeRun(self):
+        for sequence_number in range(2, 101):
+            self.assertEqual(self.add(sequence_number), [])
+        self.assertEqual(self.add(1), list(range(1, 101)))
+        self.assertEqual(len(self.rb), 0)
+        self.assertEqual(self.rb.next_sequence_number, 101)
+
+    def testRunStopsAtNextGap(self):
+        self.add(2)
+        self.add(4)
+        self.assertEqual(self.add(1), [1, 2])
+        self.assertEqual(len(self.rb), 1)
+        self.assertEqual(self.add(3), [3, 4])
+
+    def testOldAndDuplicateMessagesAreDiscarded(self):
+        self.add(1)
+        self.assertEqual(self.add(1), [])
+        self.add(3)
+        self.add(3)
+        self.assertEqual(len(self.rb), 1)
+
+    def testSequenceNumbersWrap(self):
+        self.assertEqual(next_sequence_number(SEQUENCE_NUMBER_MAX), 1)
+        self.assertEqual(sequence_distance(2, SEQUENCE_NUMBER_MAX), 2)
+        self.assertEqual(sequence_distance(SEQUENCE_NUMBER_MAX, 2), -2)
+
+        self.rb._next_sequence_number = SEQUENCE_NUMBER_MAX
+        self.assertEqual(self.add(1), [])
+        self.assertEqual(self.add(SEQUENCE_NUMBER_MAX), [SEQUENCE_NUMBER_MAX, 1])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
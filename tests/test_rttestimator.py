@@ -0,0 +1,65 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import unittest
+import legume
+from greenbar import GreenBarRunner
+
+class RttEstimatorTests(unittest.TestCase):
+    def setUp(self):
+        self.rtt = legume.rttestimator.RttEstimator(
+            initial_rto=0.3, minimum_rto=0.01, maximum_rto=2.0)
+
+    def testInitialRto(self):
+        self.assertFalse(self.rtt.has_estimate())
+        self.assertEqual(self.rtt.srtt, 0)
+        self.assertAlmostEqual(self.rtt.rto, 0.3)
+
+    def testFirstSample(self):
+        self.rtt.add_sample(0.1)
+        self.assertTrue(self.rtt.has_estimate())
+        self.assertAlmostEqual(self.rtt.srtt, 0.1)
+        self.assertAlmostEqual(self.rtt.rttvar, 0.05)
+        self.assertAlmostEqual(self.rtt.rto, 0.3)
+
+    def testSteadySamplesConverge(self):
+        for x in range(100):
+            self.rtt.add_sample(0.05)
+        self.assertAlmostEqual(self.rtt.srtt, 0.05)
+        self.assertAlmostEqual(self.rtt.jitter, 0)
+        self.assertTrue(self.rtt.rto < 0.051)
+
+    def testJitterRaisesRto(self):
+        for x in range(100):
+            self.rtt.add_sample(0.05 if x % 2 else 0.15)
+        self.assertTrue(self.rtt.jitter > 0.05)
+        self.assertTrue(self.rtt.rto > self.rtt.srtt + self.rtt.jitter)
+
+    def testRtoIsClamped(self):
+        for x in range(10):
+            self.rtt.add_sample(0)
+        self.assertAlmostEqual(self.rtt.rto, 0.01)
+        self.rtt.add_sample(100)
+        self.assertAlmostEqual(self.rtt.rto, 2.0)
+
+    def testBackoffDoublesRtoUntilSample(self):
+        self.rtt.add_sample(0.1)
+        self.rtt.backoff()
+        self.assertAlmostEqual(self.rtt.rto, 0.6)
+        self.rtt.backoff()
+        self.assertAlmostEqual(self.rtt.rto, 1.2)
+        for x in range(5):
+            self.rtt.backoff()
+        self.assertAlmostEqual(self.rtt.rto, 2.0)
+        self.rtt.add_sample(0.1)
+        self.assertTrue(self.rtt.rto < 0.3)
+
+    def testIgnoresNegativeSamples(self):
+        self.rtt.add_sample(-1)
+        self.assertFalse(self.rtt.has_estimate())
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
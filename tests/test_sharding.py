@@ -0,0 +1,126 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import sys
+import socket
+import random
+import unittest
+import legume
+from legume.sharding import ShardedServer
+from greenbar import GreenBarRunner
+
+class ChatMessage(legume.messages.BaseMessage):
+    MessageTypeID = legume.messages.BASE_MESSAGETYPEID_USER+1
+    MessageValues = {
+        'text':'varstring'}
+
+def create_message_factory():
+    mf = legume.messages.MessageFactory()
+    mf.add(ChatMessage)
+    return mf
+
+def create_chat_server(shard):
+    server = legume.Server(create_message_factory())
+    def on_message(peer, message):
+        shard.send_message_to_all(message, reliable=True)
+    server.OnMessage += on_message
+    return server
+
+def getRandomPort():
+    return random.randint(16000, 50000)
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'requires SO_REUSEPORT')
+class TestShardedServer(unittest.TestCase):
+    def setUp(self):
+        self.sharded = ShardedServer(create_chat_server, workers=2)
+        for attempt in range(5):
+            # The random port may already be bound by another test.
+            self.port = getRandomPort()
+            try:
+                self.sharded.start(('127.0.0.1', self.port))
+                break
+            except legume.exceptions.ServerError:
+                if attempt == 4:
+                    raise
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            if client.is_active():
+                client._disconnect(raise_event=False)
+        self.sharded.stop()
+
+    def pump(self, done, iterations=300):
+        for x in range(iterations):
+            for client in self.clients:
+                if client.is_active():
+                    client.poll(0.005)
+            self.sharded.update(0.005)
+            if done():
+                return True
+        return False
+
+    def connect(self, count):
+        for x in range(count):
+            client = legume.Client(create_message_factory())
+            client.received = []
+            client.OnMessage += lambda sender, message: \
+                sender.received.append(message.text.value)
+            client.connect(('127.0.0.1', self.port))
+            self.clients.append(client)
+        self.assertTrue(self.pump(
+            lambda: all(client.connected for client in self.clients) and
+                self.sharded.peercount == len(self.clients)))
+
+    def testPeersAreCountedAcrossShards(self):
+        self.connect(3)
+        self.assertEqual(self.sharded.peercount, 3)
+        self.assertEqual(len(self.sharded.shard_peercounts), 2)
+
+    def testParentBroadcastReachesEveryPeer(self):
+        self.connect(3)
+        message = ChatMessage()
+        message.text.value = 'hello'
+        self.sharded.send_message_to_all(message, reliable=True)
+        self.assertTrue(self.pump(lambda: all(
+            client.received == ['hello'] for client in self.clients)))
+
+    def testShardBroadcastIsRelayed(self):
+        # The kernel picks the shard for each client, connect clients until
+        # both shards have one.
+        self.connect(2)
+        while 0 in self.sharded.shard_peercounts and len(self.clients) < 16:
+            self.connect(1)
+        self.assertFalse(0 in self.sharded.shard_peercounts)
+        message = ChatMessage()
+        message.text.value = 'relay'
+        self.clients[0].send_reliable_message(message)
+        self.assertTrue(self.pump(lambda: all(
+            client.received == ['relay'] for client in self.clients)))
+
+    def testExitedShardStopsServer(self):
+        process = self.sharded._processes[0]
+        process.terminate()
+        process.join()
+        self.assertRaises(legume.exceptions.ServerError,
+            self.pump, lambda: False)
+        self.assertFalse(self.sharded.is_active())
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'requires SO_REUSEPORT')
+class TestReusePort(unittest.TestCase):
+    def testServersShareReusedPort(self):
+        first = legume.Server()
+        first.listen(('127.0.0.1', 0), reuse_port=True)
+        address = first._socket.getsockname()
+        second = legume.Server()
+        try:
+            second.listen(address, reuse_port=True)
+            self.assertTrue(second.is_active())
+        finally:
+            second._shutdown_socket()
+            first._shutdown_socket()
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
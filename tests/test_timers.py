@@ -0,0 +1,88 @@
+# legume. Copyright 2009-2013 Dale Reidy. All rights reserved.
+# See LICENSE for details.
+
+import legume.timing as time
+time.test_mode(True)
+
+import sys
+import unittest
+import legume
+from legume.timers import TimerQueue
+from greenbar import GreenBarRunner
+
+class TestTimerQueue(unittest.TestCase):
+    def setUp(self):
+        self.timers = TimerQueue()
+
+    def testDueKeysArePoppedInDeadlineOrder(self):
+        self.timers.schedule('b', 2.0)
+        self.timers.schedule('a', 1.0)
+        self.timers.schedule('c', 3.0)
+        self.assertEqual(self.timers.next_deadline(), 1.0)
+        self.assertEqual(self.timers.pop_due(2.0), ['a', 'b'])
+        self.assertEqual(len(self.timers), 1)
+        self.assertEqual(self.timers.next_deadline(), 3.0)
+
+    def testRescheduleReplacesDeadline(self):
+        self.timers.schedule('a', 1.0)
+        self.timers.schedule('a', 5.0)
+        self.assertEqual(self.timers.pop_due(2.0), [])
+        self.assertEqual(self.timers.next_deadline(), 5.0)
+        self.assertEqual(self.timers.pop_due(5.0), ['a'])
+        self.assertEqual(self.timers.next_deadline(), None)
+
+    def testCancelledKeyIsNotDue(self):
+        self.timers.schedule('a', 1.0)
+        self.timers.cancel('a')
+        self.assertFalse('a' in self.timers)
+        self.assertEqual(self.timers.pop_due(2.0), [])
+
+    def testStaleEntriesAreCompacted(self):
+        for x in range(1000):
+            self.timers.schedule('a', float(x))
+        self.assertTrue(len(self.timers._heap) < 100)
+        self.assertEqual(self.timers.pop_due(1000.0), ['a'])
+
+class TestServerTimers(unittest.TestCase):
+    def setUp(self):
+        self.server = legume.Server()
+        self.updated = []
+        self.peers = [self.addPeer(port) for port in range(3)]
+
+    def addPeer(self, port):
+        address = ('127.0.0.1', 9000 + port)
+        peer = legume.serverpeer.Peer(self.server, address)
+        peer.update = lambda: self.updated.append(peer)
+        peer.deadline = time.time() + 10.0
+        peer.next_deadline = lambda: peer.deadline
+        self.server._peers[address] = peer
+        return peer
+
+    def testOnlyWokenPeersAreUpdated(self):
+        self.server._wake_peer(self.peers[1])
+        self.server.update()
+        self.assertEqual(self.updated, [self.peers[1]])
+        self.server.update()
+        self.assertEqual(self.updated, [self.peers[1]])
+
+    def testPeerIsUpdatedWhenDeadlineIsDue(self):
+        self.peers[2].deadline = time.time() + 1.0
+        self.server._wake_peer(self.peers[2])
+        self.server.update()
+        self.assertEqual(self.server.next_deadline(), self.peers[2].deadline)
+
+        del self.updated[:]
+        time.sleep(1.5)
+        self.server.update()
+        self.assertEqual(self.updated, [self.peers[2]])
+
+    def testSendingWakesPeer(self):
+        self.peers[0].send_message(legume.messages.Ping())
+        self.assertEqual(self.server.next_deadline(), time.time())
+        self.server.update()
+        self.assertEqual(self.updated, [self.peers[0]])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    GreenBarRunner(verbosity=2).run(suite)
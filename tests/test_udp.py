@@ -102,7 +102,7 @@ class TestPacket(unittest.TestCase):
         self.assertEquals(
             values,
             [legume.messages.ConnectRequest.MessageTypeID,
-            legume.netshared.PROTOCOL_VERSION])
+            legume.netshared.PROTOCOL_VERSION, ''])
 
 
 class TestPacket1(legume.messages.BaseMessage):